@@ -1 +1 @@
-drop table image, ingredient, ingredient_unit_conversion, recipe, recipe_ingredient, step, substitution, unit, unit_conversion, recipe_embeddings
+drop table image, ingredient, ingredient_unit_conversion, recipe, recipe_ingredient, step, substitution, unit, unit_conversion, recipe_embeddings, recipe_embeddings_version, image_embeddings_version, embedding_queue
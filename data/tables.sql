@@ -2,6 +2,7 @@
 -- so we suppress it by setting client_min_messages to WARNING
 SET client_min_messages TO WARNING;
 CREATE EXTENSION IF NOT EXISTS vector;
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
 RESET client_min_messages;
 
 -- Creates an enumeration type for unit types if it doesn't already exist
@@ -98,9 +99,8 @@ CREATE TABLE IF NOT EXISTS image (
   UNIQUE (recipeId, imageLocation),
   FOREIGN KEY (recipeId) REFERENCES recipe(id));
 
-CREATE INDEX IF NOT EXISTS hnsw_embedding_idx ON image
-USING hnsw (embedding vector_cosine_ops)
-WITH (m = 16, ef_construction = 64);
+-- The HNSW index on embedding is created further down, with the other
+-- vector indexes, according to recipes.vector_index.
 
 
 CREATE TABLE IF NOT EXISTS recipe_embeddings(
@@ -108,5 +108,229 @@ CREATE TABLE IF NOT EXISTS recipe_embeddings(
   description_embedding vector(768) NOT NULL,
   FOREIGN KEY (recipeId) REFERENCES recipe(id));
 
-CREATE INDEX ON recipe_embeddings USING hnsw (description_embedding vector_cosine_ops);
+-- Its HNSW index is created with the other vector indexes below.
 
+
+-- Text search indexes for /advanced_search. The full-text expressions must
+-- match queries.py exactly for the planner to use them; the trigram indexes
+-- serve the ILIKE '%...%' substring matches.
+CREATE INDEX IF NOT EXISTS recipe_name_fts_idx ON recipe
+USING gin (to_tsvector('english', name));
+
+CREATE INDEX IF NOT EXISTS recipe_description_fts_idx ON recipe
+USING gin (to_tsvector('english', description));
+
+CREATE INDEX IF NOT EXISTS step_description_fts_idx ON step
+USING gin (to_tsvector('english', description));
+
+-- Combined name + description document for the hybrid /recipe_search.
+CREATE INDEX IF NOT EXISTS recipe_fts_idx ON recipe
+USING gin (to_tsvector('english', name || ' ' || description));
+
+CREATE INDEX IF NOT EXISTS recipe_name_trgm_idx ON recipe
+USING gin (name gin_trgm_ops);
+
+CREATE INDEX IF NOT EXISTS recipe_description_trgm_idx ON recipe
+USING gin (description gin_trgm_ops);
+
+CREATE INDEX IF NOT EXISTS step_description_trgm_idx ON step
+USING gin (description gin_trgm_ops);
+
+CREATE INDEX IF NOT EXISTS ingredient_name_trgm_idx ON ingredient
+USING gin (name gin_trgm_ops);
+
+-- The EXISTS lookups from recipe into its children go through these.
+-- (recipe_ingredient and step already lead their UNIQUE keys with recipeId.)
+CREATE INDEX IF NOT EXISTS recipe_ingredient_ingredient_idx ON recipe_ingredient (ingredientId);
+
+-- Single-row counter bumped whenever recipe_embeddings changes, so the web app
+-- can tell when its cached search results are out of date.
+CREATE TABLE IF NOT EXISTS recipe_embeddings_version (
+  id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+  version BIGINT NOT NULL DEFAULT 0);
+
+INSERT INTO recipe_embeddings_version (id, version) VALUES (TRUE, 0) ON CONFLICT DO NOTHING;
+
+CREATE OR REPLACE FUNCTION bump_recipe_embeddings_version() RETURNS trigger AS $$
+BEGIN
+  UPDATE recipe_embeddings_version SET version = version + 1;
+  RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER recipe_embeddings_version_trigger
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON recipe_embeddings
+FOR EACH STATEMENT EXECUTE FUNCTION bump_recipe_embeddings_version();
+
+-- Same for image, read by the in-process image index (flask/image_index.py)
+-- to tell when its copy of the embeddings needs syncing.
+CREATE TABLE IF NOT EXISTS image_embeddings_version (
+  id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+  version BIGINT NOT NULL DEFAULT 0);
+
+INSERT INTO image_embeddings_version (id, version) VALUES (TRUE, 0) ON CONFLICT DO NOTHING;
+
+CREATE OR REPLACE FUNCTION bump_image_embeddings_version() RETURNS trigger AS $$
+BEGIN
+  UPDATE image_embeddings_version SET version = version + 1;
+  RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER image_embeddings_version_trigger
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON image
+FOR EACH STATEMENT EXECUTE FUNCTION bump_image_embeddings_version();
+
+-- Recipes whose embeddings are out of date. Triggers below add a recipe when
+-- it, its steps, its ingredients or its images change, and the embedding
+-- worker (python embeddings.py --watch) re-embeds just those recipes.
+CREATE TABLE IF NOT EXISTS embedding_queue (
+  recipeId BIGINT NOT NULL PRIMARY KEY,
+  queuedAt TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp());
+
+-- Failed refreshes of the entry: the worker skips a recipe after
+-- REFRESH_MAX_ATTEMPTS failures, until the next edit queues it afresh.
+ALTER TABLE embedding_queue
+  ADD COLUMN IF NOT EXISTS attempts INT NOT NULL DEFAULT 0,
+  ADD COLUMN IF NOT EXISTS lastError TEXT;
+
+-- TG_ARGV[0] names the column holding the recipe id on the triggering table.
+-- The embedding pipeline sets recipes.skip_embedding_queue for its own writes
+-- to the image table, so they do not queue the recipe all over again.
+CREATE OR REPLACE FUNCTION queue_recipe_embedding() RETURNS trigger AS $$
+BEGIN
+  IF current_setting('recipes.skip_embedding_queue', true) = 'on' THEN
+    RETURN NULL;
+  END IF;
+  IF TG_OP IN ('INSERT', 'UPDATE') THEN
+    INSERT INTO embedding_queue (recipeId) VALUES ((to_jsonb(NEW) ->> TG_ARGV[0])::bigint)
+    ON CONFLICT (recipeId) DO UPDATE SET queuedAt = clock_timestamp(), attempts = 0, lastError = NULL;
+  END IF;
+  IF TG_OP IN ('UPDATE', 'DELETE') THEN
+    INSERT INTO embedding_queue (recipeId) VALUES ((to_jsonb(OLD) ->> TG_ARGV[0])::bigint)
+    ON CONFLICT (recipeId) DO UPDATE SET queuedAt = clock_timestamp(), attempts = 0, lastError = NULL;
+  END IF;
+  PERFORM pg_notify('embedding_queue', '');
+  RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER recipe_embedding_queue_trigger
+AFTER INSERT OR UPDATE OR DELETE ON recipe
+FOR EACH ROW EXECUTE FUNCTION queue_recipe_embedding('id');
+
+CREATE OR REPLACE TRIGGER step_embedding_queue_trigger
+AFTER INSERT OR UPDATE OR DELETE ON step
+FOR EACH ROW EXECUTE FUNCTION queue_recipe_embedding('recipeid');
+
+CREATE OR REPLACE TRIGGER recipe_ingredient_embedding_queue_trigger
+AFTER INSERT OR UPDATE OR DELETE ON recipe_ingredient
+FOR EACH ROW EXECUTE FUNCTION queue_recipe_embedding('recipeid');
+
+CREATE OR REPLACE TRIGGER image_embedding_queue_trigger
+AFTER INSERT OR UPDATE OR DELETE ON image
+FOR EACH ROW EXECUTE FUNCTION queue_recipe_embedding('recipeid');
+
+-- Renaming an ingredient changes the text of every recipe that uses it.
+CREATE OR REPLACE FUNCTION queue_ingredient_recipes() RETURNS trigger AS $$
+BEGIN
+  INSERT INTO embedding_queue (recipeId)
+  SELECT DISTINCT recipeId FROM recipe_ingredient WHERE ingredientId = NEW.id
+  ON CONFLICT (recipeId) DO UPDATE SET queuedAt = clock_timestamp(), attempts = 0, lastError = NULL;
+  PERFORM pg_notify('embedding_queue', '');
+  RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER ingredient_embedding_queue_trigger
+AFTER UPDATE OF name ON ingredient
+FOR EACH ROW EXECUTE FUNCTION queue_ingredient_recipes();
+
+-- What each stored embedding was made from: a hash of the exact text or image
+-- bytes that were embedded, and the model that embedded them. embeddings.py
+-- skips rows whose hash and model are unchanged, so reruns only embed what
+-- changed since the last run.
+ALTER TABLE recipe_embeddings
+  ADD COLUMN IF NOT EXISTS contentHash TEXT,
+  ADD COLUMN IF NOT EXISTS modelVersion TEXT;
+
+ALTER TABLE image
+  ADD COLUMN IF NOT EXISTS contentHash TEXT,
+  ADD COLUMN IF NOT EXISTS modelVersion TEXT;
+
+-- Hash of the rows tx.py --load last wrote for each recipe, so reloading a
+-- crawl skips the recipes that have not changed.
+ALTER TABLE recipe
+  ADD COLUMN IF NOT EXISTS sourceHash TEXT;
+
+-- Compact ANN indexes (pgvector 0.7 or later). HNSW index memory is what
+-- limits how large a catalog the database host can keep in RAM, so instead of
+-- float32 (vector, the default) the embeddings can be indexed as
+--   halfvec: cast to half precision, half the index size;
+--   bit:     binary_quantize()d, 1 bit per dimension (1/32 of the size), for a
+--            Hamming-distance first pass that the app re-ranks by exact
+--            distance on the float32 columns, which are kept as they are.
+-- Choose with the recipes.vector_index setting when running this file, e.g.
+--   PGOPTIONS='-c recipes.vector_index=bit' psql -f tables.sql
+-- and give the app the same value in VECTOR_INDEX. Only the chosen kind's
+-- indexes are built; those of the other kinds are dropped.
+DO $$
+DECLARE
+  kind TEXT := coalesce(nullif(current_setting('recipes.vector_index', true), ''), 'vector');
+  legacy TEXT;
+BEGIN
+  IF kind NOT IN ('vector', 'halfvec', 'bit') THEN
+    RAISE EXCEPTION 'recipes.vector_index must be vector, halfvec or bit, not %', kind;
+  END IF;
+
+  -- Earlier versions of this file created the recipe_embeddings index
+  -- without a name, so every rerun added another copy
+  -- (recipe_embeddings_description_embedding_idx, ..._idx1, ...). Keep the
+  -- first one under its proper name and drop the rest.
+  FOR legacy IN
+    SELECT indexname FROM pg_indexes
+     WHERE tablename = 'recipe_embeddings'
+       AND indexname ~ '^recipe_embeddings_description_embedding_idx[0-9]*$'
+     ORDER BY length(indexname), indexname
+  LOOP
+    IF kind = 'vector' AND to_regclass('recipe_embeddings_hnsw_idx') IS NULL THEN
+      EXECUTE format('ALTER INDEX %I RENAME TO recipe_embeddings_hnsw_idx', legacy);
+    ELSE
+      EXECUTE format('DROP INDEX %I', legacy);
+    END IF;
+  END LOOP;
+
+  IF kind = 'vector' THEN
+    CREATE INDEX IF NOT EXISTS hnsw_embedding_idx ON image
+    USING hnsw (embedding vector_cosine_ops)
+    WITH (m = 16, ef_construction = 64);
+    CREATE INDEX IF NOT EXISTS recipe_embeddings_hnsw_idx ON recipe_embeddings
+    USING hnsw (description_embedding vector_cosine_ops);
+  ELSIF kind = 'halfvec' THEN
+    CREATE INDEX IF NOT EXISTS image_embedding_halfvec_idx ON image
+    USING hnsw ((embedding::halfvec(512)) halfvec_cosine_ops)
+    WITH (m = 16, ef_construction = 64);
+    CREATE INDEX IF NOT EXISTS recipe_embeddings_halfvec_idx ON recipe_embeddings
+    USING hnsw ((description_embedding::halfvec(768)) halfvec_cosine_ops);
+  ELSIF kind = 'bit' THEN
+    CREATE INDEX IF NOT EXISTS image_embedding_bit_idx ON image
+    USING hnsw ((binary_quantize(embedding)::bit(512)) bit_hamming_ops)
+    WITH (m = 16, ef_construction = 64);
+    CREATE INDEX IF NOT EXISTS recipe_embeddings_bit_idx ON recipe_embeddings
+    USING hnsw ((binary_quantize(description_embedding)::bit(768)) bit_hamming_ops);
+  END IF;
+  -- Indexes of the kinds not chosen would only slow down writes.
+  IF kind <> 'vector' THEN
+    DROP INDEX IF EXISTS hnsw_embedding_idx;
+    DROP INDEX IF EXISTS recipe_embeddings_hnsw_idx;
+  END IF;
+  IF kind <> 'halfvec' THEN
+    DROP INDEX IF EXISTS image_embedding_halfvec_idx;
+    DROP INDEX IF EXISTS recipe_embeddings_halfvec_idx;
+  END IF;
+  IF kind <> 'bit' THEN
+    DROP INDEX IF EXISTS image_embedding_bit_idx;
+    DROP INDEX IF EXISTS recipe_embeddings_bit_idx;
+  END IF;
+END
+$$;
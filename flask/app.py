@@ -1,43 +1,116 @@
 import os
-import imghdr
-import psycopg2
+import base64
+import csv
+import hashlib
+import io
+import itertools
 import psycopg2.extras
-from flask import Flask, render_template, flash, request, redirect, url_for
+from flask import Flask, Response, render_template, stream_template, flash, get_flashed_messages, request, redirect, url_for, jsonify
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
-from PIL import Image
-from embeddings import init_CLIP, create_embedding, create_text_embedding
+from PIL import Image, UnidentifiedImageError
+from embeddings import create_embedding, create_text_embedding, decode_image, warm_up
 import queries as query
+import db
+import image_index
+from cache import LRUCache, MISSING, normalize_query
+from batching import MicroBatcher
 
 UPLOAD_FOLDER = 'static/uploads'
 ALLOWED_EXTENSIONS = ['png', 'jpg', 'jpeg', 'gif']
 TABLES_TO_MANAGE = ['recipe', 'ingredient', 'unit', 'step']
-DEFAULT_DB_PORT = 5432
+DEFAULT_PAGE_SIZE = 24
+SEARCH_MODES = ['semantic', 'hybrid', 'exact']
+SEARCH_RESULTS = 10
+ADMIN_PAGE_SIZE = 100
+ADMIN_MAX_PAGE_SIZE = 1000
+ADMIN_CURSOR_ITERSIZE = 500
+MAX_PAGE_SIZE = 100
 
 load_dotenv(override=True)
 
-if not os.path.exists(UPLOAD_FOLDER):
+# Uploads are decoded in memory; SAVE_UPLOADS=1 also keeps a copy on disk.
+SAVE_UPLOADS = os.getenv("SAVE_UPLOADS", "0") == "1"
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_MB", 10)) * 1024 * 1024
+
+# Kind of HNSW index vector searches are answered from (vector, halfvec or
+# bit); it must match the indexes init/01-tables.sql built. See queries.ann_sql().
+VECTOR_INDEX = os.getenv("VECTOR_INDEX", "vector")
+if VECTOR_INDEX not in query.VECTOR_INDEXES:
+    raise ValueError(f"VECTOR_INDEX must be one of {', '.join(query.VECTOR_INDEXES)}, not {VECTOR_INDEX!r}")
+IMAGE_RESULTS = 5
+IMAGE_SIMILARITY_SQL = query.image_similarity_sql(VECTOR_INDEX)
+RECIPE_SEMANTIC_SQL = query.recipe_semantic_search_sql(index=VECTOR_INDEX)
+RECIPE_HYBRID_SQL = query.recipe_hybrid_search_sql(index=VECTOR_INDEX)
+# IMAGE_INDEX=1 answers image searches from an in-process, memory-mapped copy
+# of the image embeddings (image_index.py), falling back to pgvector until it
+# has loaded.
+IMAGE_INDEX_ENABLED = os.getenv("IMAGE_INDEX", "0") == "1"
+
+if SAVE_UPLOADS and not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
 app.secret_key = 'supersecretkey'
 
-MODEL, PROCESSOR = init_CLIP()
+# Query text -> mpnet embedding, and query text -> (embeddings version, top-k ids).
+# SEARCH_RESULT_CACHE_SIZE=0 turns the result cache off.
+QUERY_EMBEDDING_CACHE = LRUCache(maxsize=int(os.getenv("QUERY_CACHE_SIZE", 1024)),
+                                 ttl=float(os.getenv("QUERY_CACHE_TTL", 3600)))
+SEARCH_RESULT_CACHE = LRUCache(maxsize=int(os.getenv("SEARCH_RESULT_CACHE_SIZE", 1024)),
+                               ttl=float(os.getenv("SEARCH_RESULT_CACHE_TTL", 600)))
+# Column names and types of each admin table.
+TABLE_COLUMNS_CACHE = LRUCache(maxsize=len(TABLES_TO_MANAGE), ttl=float(os.getenv("ADMIN_METADATA_TTL", 300)))
+# SHA-256 of uploaded image bytes -> CLIP embedding, so re-uploads of the same
+# photo skip decoding and the forward pass.
+IMAGE_EMBEDDING_CACHE = LRUCache(maxsize=int(os.getenv("IMAGE_CACHE_SIZE", 256)))
+
+# Concurrent searches in one worker share batched forward passes. The window is
+# how long to wait for more requests after the first (0 = only batch requests
+# that are already queued, adding no latency).
+INFERENCE_MAX_BATCH = int(os.getenv("INFERENCE_MAX_BATCH", 16))
+INFERENCE_BATCH_WINDOW_MS = float(os.getenv("INFERENCE_BATCH_WINDOW_MS", 0))
+# Longest a request waits for its embedding (model loading included).
+INFERENCE_TIMEOUT = float(os.getenv("INFERENCE_TIMEOUT", 60))
+IMAGE_BATCHER = MicroBatcher(lambda imgs: list(create_embedding(imgs)), max_batch=INFERENCE_MAX_BATCH,
+                             max_wait_ms=INFERENCE_BATCH_WINDOW_MS, name="clip-batcher")
+TEXT_BATCHER = MicroBatcher(create_text_embedding, max_batch=INFERENCE_MAX_BATCH,
+                            max_wait_ms=INFERENCE_BATCH_WINDOW_MS, name="mpnet-batcher")
+
+# Models are loaded lazily on first use; set WARMUP_MODELS=1 to load them
+# (once per worker) at boot instead of on the first search request.
+if os.getenv("WARMUP_MODELS", "0") == "1":
+    warm_up()
+if IMAGE_INDEX_ENABLED:
+    image_index.get_image_index()
 
 def allowed_file(filename):
     return '.' in filename and \
         filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def get_db_connection():
-    conn = psycopg2.connect(
-        host=os.getenv("HOST"),
-        database=os.getenv("DATABASE"),
-        port=os.getenv("PORT", DEFAULT_DB_PORT),
-        user=os.getenv("USER"),
-        password=os.getenv("PASSWORD")
-    )
-    return conn
+@app.route('/metrics')
+def metrics():
+    """
+    Per-worker counters for scraping. Each gunicorn worker answers for itself,
+    so the pid is included to tell them apart.
+    """
+    return jsonify(db_pool=db.pool_stats(),
+                   query_embedding_cache=QUERY_EMBEDDING_CACHE.stats(),
+                   search_result_cache=SEARCH_RESULT_CACHE.stats(),
+                   image_embedding_cache=IMAGE_EMBEDDING_CACHE.stats(),
+                   clip_batcher=IMAGE_BATCHER.stats(),
+                   mpnet_batcher=TEXT_BATCHER.stats(),
+                   image_index=image_index.get_image_index().stats() if IMAGE_INDEX_ENABLED else None)
+
+def thumbnail_data_uri(img):
+    """
+    Inline JPEG of an uploaded image, for showing it back without saving it.
+    """
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=85)
+    return "data:image/jpeg;base64," + base64.b64encode(buffer.getvalue()).decode("ascii")
 
 @app.route('/image_search', methods=['GET', 'POST'])
 def image_search():
@@ -60,26 +133,43 @@ def image_search():
         # If valid file and has image file extension like .jpg
         if file and allowed_file(file.filename):
             filename = secure_filename(file.filename)
-            img_filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            print(f"[DEBUG] Saving file to: {img_filepath}")
-            file.save(img_filepath)
-
-            # If given filepath is valid image
-            if imghdr.what(img_filepath):
-                img = Image.open(img_filepath).convert("RGB").resize(size=[256, 256])
-                img_embedding = create_embedding([img], MODEL, PROCESSOR)[0].tolist()
-                conn = get_db_connection()
-                cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-                cur.execute(query.image_similarity_query, (img_embedding, img_embedding))
-                results = cur.fetchall()
-                print(results)
-                cur.close()
-                conn.close()
-                return render_template('image_result.html', filename=filename, similar_images=results)
-            else:
-                os.remove(img_filepath)
+            data = file.read(MAX_UPLOAD_BYTES + 1)
+            if len(data) > MAX_UPLOAD_BYTES:
+                flash('Uploaded file is too large')
+                return redirect(request.url)
+
+            # If given bytes are a valid image
+            try:
+                img = decode_image(data)
+            except (UnidentifiedImageError, Image.DecompressionBombError, OSError):
                 flash('Uploaded file is not a valid image')
                 return redirect(request.url)
+
+            content_hash = hashlib.sha256(data).hexdigest()
+            img_embedding = IMAGE_EMBEDDING_CACHE.get(content_hash)
+            if img_embedding is MISSING:
+                img_embedding = IMAGE_BATCHER(img, timeout=INFERENCE_TIMEOUT).tolist()
+                IMAGE_EMBEDDING_CACHE.put(content_hash, img_embedding)
+
+            if SAVE_UPLOADS:
+                img_filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+                print(f"[DEBUG] Saving file to: {img_filepath}")
+                with open(img_filepath, 'wb') as f:
+                    f.write(data)
+                image_src = url_for('static', filename='uploads/' + filename)
+            else:
+                image_src = thumbnail_data_uri(img)
+
+            nearest = nearest_images(img_embedding)
+            with db.cursor() as cur:
+                if nearest is None:
+                    results = vector_search(cur, IMAGE_SIMILARITY_SQL, {"embedding": img_embedding, "k": IMAGE_RESULTS},
+                                            requested_ef_search(request.values))
+                else:
+                    cur.execute(query.images_by_ids_query, nearest)
+                    results = cur.fetchall()
+            print(results)
+            return render_template('image_result.html', image_src=image_src, similar_images=results)
         else:
             flash('File type not allowed!')
             return redirect(request.url)
@@ -91,72 +181,138 @@ def image_search():
 def recipe(id=None):
     if id is None:
         return render_template('recipe.html', recipe_id=None)
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    cur.execute(f"SELECT * FROM recipe WHERE id = %s;", (id,))
-    recipe = cur.fetchone()
-    cur.execute(query.recipe_ingredients_query, (id,))
-    ingredients = cur.fetchall()
-    for ingredient in ingredients:
-        if ingredient['denominator'] is not None:
-            whole = ingredient['quantity'] // ingredient['denominator']
-            if whole > 0:
-                ingredient['quantity'] = f"{whole} {ingredient['quantity'] % ingredient['denominator']}/{ingredient['denominator']}"
-            else:
-                ingredient['quantity'] = f"{ingredient['quantity']} / {ingredient['denominator']}"
-        elif ingredient['quantity'] == 1 and ingredient['unittype'] == 'use' and ingredient['notation'] == '':
-            ingredient['quantity'] = ""
-    cur.execute(query.recipe_steps_query, (id,))
-    steps = cur.fetchall()
-    cur.close()
-    conn.close()
+    with db.cursor() as cur:
+        cur.execute(query.recipe_detail_query, (id,))
+        recipe = cur.fetchone()
+    if recipe is None:
+        return render_template('recipe.html', recipe=None)
 
-    return render_template('recipe.html', recipe=recipe, ingredients=ingredients, steps=steps)
+    return render_template('recipe.html', recipe=recipe, ingredients=recipe['ingredients'], steps=recipe['steps'])
 
 @app.route('/')
 def index():
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    cur.execute("SELECT * FROM recipe ORDER BY id ;")
-    recipes = cur.fetchall()
-    cur.close()
-    conn.close()
-    return render_template('index.html', recipes=recipes)
+    """
+    Keyset-paginated recipe list: ?after=<id> for the next page,
+    ?before=<id> for the previous one, and ?limit= capped at MAX_PAGE_SIZE.
+    """
+    page_size = max(1, min(request.args.get('limit', DEFAULT_PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    after = request.args.get('after', type=int)
+    before = request.args.get('before', type=int)
+    with db.cursor() as cur:
+        if before is not None:
+            cur.execute(query.recipe_page_before_query, (before, page_size + 1))
+        else:
+            cur.execute(query.recipe_page_after_query, (after or 0, page_size + 1))
+        recipes = cur.fetchall()
+    more = len(recipes) > page_size
+    recipes = recipes[:page_size]
+    if before is not None:
+        recipes.reverse()
+        has_next, has_prev = True, more
+    else:
+        has_next, has_prev = more, after is not None
+    next_after = recipes[-1]['id'] if recipes and has_next else None
+    prev_before = recipes[0]['id'] if recipes and has_prev else None
+    return render_template('index.html', recipes=recipes, limit=page_size,
+                           next_after=next_after, prev_before=prev_before)
 
 
 @app.route('/admin')
 def admin_panel():
     return render_template('admin.html', tables=TABLES_TO_MANAGE)
 
+def table_columns(cur, table_name):
+    """
+    Column names and types of an admin table, cached per worker. The cache is
+    checked against live query results (see check_table_columns) and entries
+    also expire after ADMIN_METADATA_TTL seconds.
+    """
+    columns_info = TABLE_COLUMNS_CACHE.get(table_name)
+    if columns_info is MISSING:
+        cur.execute(query.table_columns_query, (table_name,))
+        columns_info = [{'name': col['column_name'], 'type': col['data_type']} for col in cur.fetchall()] # Get column name and type
+        TABLE_COLUMNS_CACHE.put(table_name, columns_info)
+    return columns_info
+
+def check_table_columns(table_name, columns_info, live_columns):
+    """
+    Drops the cached columns of a table if a query just returned different
+    ones, i.e. the table was altered since they were cached.
+    """
+    if [col['name'] for col in columns_info] != list(live_columns):
+        TABLE_COLUMNS_CACHE.invalidate(table_name)
+
 @app.route('/admin/<table_name>')
 def admin_list(table_name):
+    """
+    One page of a table, read through a server-side cursor and streamed into
+    the template. Sorting (?sort=, ?dir=), filtering (?column=, ?q=) and
+    paging (?page=, ?limit=) all happen in SQL.
+    """
     if table_name not in TABLES_TO_MANAGE:
         flash('Invalid table name', 'error')
         return redirect(url_for('admin_panel'))
 
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
     try:
-        # Get column names dynamically
-        cur.execute(f"SELECT column_name FROM information_schema.columns WHERE table_name = '{table_name}' ORDER BY ordinal_position;")
-        columns_result = cur.fetchall()
-        column_names = [col['column_name'] for col in columns_result]
-        if 'recipeid' in column_names:
-            cur.execute(f"SELECT * FROM {table_name} ORDER BY recipeid, id;")
-        else:
-        # Fetch data from the table
-            cur.execute(f"SELECT * FROM {table_name} ORDER BY id;") # No ordering for generic list for now, can add later
-        data = cur.fetchall()
+        with db.cursor() as cur:
+            # Get column names dynamically
+            columns_info = table_columns(cur, table_name)
     except Exception as e:
-        cur.close()
-        conn.close()
         flash(f'Error fetching data for table {table_name}: {e}', 'error')
         return redirect(url_for('admin_panel'))
-    finally:
-        cur.close()
-        conn.close()
+    column_names = [col['name'] for col in columns_info]
+
+    page = max(0, request.args.get('page', 0, type=int))
+    page_size = max(1, min(request.args.get('limit', ADMIN_PAGE_SIZE, type=int), ADMIN_MAX_PAGE_SIZE))
+    sort = request.args.get('sort')
+    if sort not in column_names:
+        sort = 'recipeid' if 'recipeid' in column_names else 'id'
+    direction = 'desc' if request.args.get('dir') == 'desc' else 'asc'
+    filter_column = request.args.get('column', '')
+    filter_text = request.args.get('q', '').strip()
+    where, params = "", []
+    if filter_text and filter_column in column_names:
+        where = f"WHERE {filter_column}::text ILIKE %s"
+        params.append(query.like_pattern(filter_text))
+    order = f"{sort} {direction}" if sort == 'id' else f"{sort} {direction}, id {direction}"
+    list_query = f"SELECT * FROM {table_name} {where} ORDER BY {order};"
+
+    pager = {'has_next': False}
+
+    def rows():
+        with db.connection() as conn:
+            cur = conn.cursor(name=f"admin_list_{table_name}", cursor_factory=psycopg2.extras.DictCursor)
+            cur.itersize = min(page_size + 1, ADMIN_CURSOR_ITERSIZE)
+            cur.execute(list_query, params)
+            if page:
+                cur.scroll(page * page_size) # MOVE on the server; skipped rows are never sent
+            for i, row in enumerate(cur):
+                if i == 0:
+                    check_table_columns(table_name, columns_info, [col.name for col in cur.description])
+                if i == page_size:
+                    pager['has_next'] = True
+                    break
+                yield row
+            cur.close()
+
+    # Run the query and fetch the first batch before streaming, so a bad
+    # filter or a database error still redirects with a message.
+    data = rows()
+    try:
+        first = next(data, None)
+    except Exception as e:
+        flash(f'Error fetching data for table {table_name}: {e}', 'error')
+        return redirect(url_for('admin_panel'))
+    if first is not None:
+        data = itertools.chain([first], data)
 
-    return render_template('admin_list.html', table_name=table_name, columns=column_names, data=data)
+    # The session is saved before a streamed body is rendered, so flashed
+    # messages must be popped here for the removal to stick.
+    messages = get_flashed_messages(with_categories=True)
+    args = {key: value for key, value in request.args.items() if key != 'page'}
+    return stream_template('admin_list.html', table_name=table_name, columns=column_names, data=data,
+                           pager=pager, page=page, args=args, sort=sort, direction=direction,
+                           filter_column=filter_column, filter_text=filter_text, messages=messages)
 
 @app.route('/admin/<table_name>/add', methods=['GET', 'POST'])
 def admin_add(table_name):
@@ -164,41 +320,33 @@ def admin_add(table_name):
         flash('Invalid table name', 'error')
         return redirect(url_for('admin_panel'))
 
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-
     try:
-        # Get column names for form generation (excluding serial/id columns if needed)
-        cur.execute(f"SELECT column_name, data_type FROM information_schema.columns WHERE table_name = '{table_name}' ORDER BY ordinal_position;")
-        columns_info_result = cur.fetchall()
-        columns_info = [{'name': col['column_name'], 'type': col['data_type']} for col in columns_info_result] # Get column name and type
-
-        if request.method == 'POST':
-            column_names = [col_info['name'] for col_info in columns_info if col_info['name'] not in ['id']] # Exclude 'id' for INSERT
-            values = [request.form.get(col) for col in column_names] # Get values from form
-
-            placeholders = ', '.join(['%s'] * len(column_names))
-            columns_str = ', '.join(column_names)
-            insert_query = f"INSERT INTO {table_name} ({columns_str}) VALUES ({placeholders});"
-
-            try:
-                cur.execute(insert_query, tuple(values))
-                conn.commit()
-                flash(f'{table_name.capitalize()} added successfully!', 'success')
-                return redirect(url_for('admin_list', table_name=table_name))
-            except Exception as e:
-                conn.rollback()
-                flash(f'Error adding {table_name.capitalize()}: {e}', 'error')
+        with db.connection() as conn:
+            cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+            # Get column names for form generation (excluding serial/id columns if needed)
+            columns_info = table_columns(cur, table_name)
+
+            if request.method == 'POST':
+                column_names = [col_info['name'] for col_info in columns_info if col_info['name'] not in ['id']] # Exclude 'id' for INSERT
+                values = [request.form.get(col) for col in column_names] # Get values from form
+
+                placeholders = ', '.join(['%s'] * len(column_names))
+                columns_str = ', '.join(column_names)
+                insert_query = f"INSERT INTO {table_name} ({columns_str}) VALUES ({placeholders});"
+
+                try:
+                    cur.execute(insert_query, tuple(values))
+                    conn.commit()
+                    flash(f'{table_name.capitalize()} added successfully!', 'success')
+                    return redirect(url_for('admin_list', table_name=table_name))
+                except Exception as e:
+                    conn.rollback()
+                    TABLE_COLUMNS_CACHE.invalidate(table_name) # In case the failure came from a stale column list
+                    flash(f'Error adding {table_name.capitalize()}: {e}', 'error')
 
     except Exception as e:
-        cur.close()
-        conn.close()
         flash(f'Error preparing add form for {table_name.capitalize()}: {e}', 'error')
         return redirect(url_for('admin_panel'))
-    finally:
-        if request.method == 'GET': # Only close connection if it's a GET request, POST path handles closing in its own scope
-            cur.close()
-            conn.close()
 
 
     return render_template('admin_add.html', table_name=table_name, columns_info=columns_info)
@@ -209,111 +357,254 @@ def admin_edit(table_name, id):
         flash('Invalid table name', 'error')
         return redirect(url_for('admin_panel'))
 
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
     data_item = None
 
     try:
-        # Get column names and data types for form generation
-        cur.execute(f"SELECT column_name, data_type FROM information_schema.columns WHERE table_name = '{table_name}' ORDER BY ordinal_position;")
-        columns_info_result = cur.fetchall()
-        columns_info = [{'name': col['column_name'], 'type': col['data_type']} for col in columns_info_result]
-
-        if request.method == 'POST':
-            set_clauses = []
-            update_values = []
-            for col_info in columns_info:
-                col_name = col_info['name']
-                if col_name != 'id': # Don't update ID column
-                    set_clauses.append(f"{col_name} = %s")
-                    update_values.append(request.form.get(col_name))
-
-            update_values.append(id) # Add ID for WHERE clause
-            set_clause_str = ', '.join(set_clauses)
-            update_query = f"UPDATE {table_name} SET {set_clause_str} WHERE id = %s;"
-
-            try:
-                cur.execute(update_query, tuple(update_values))
-                conn.commit()
-                flash(f'{table_name.capitalize()} updated successfully!', 'success')
-                return redirect(url_for('admin_list', table_name=table_name))
-            except Exception as e:
-                conn.rollback()
-                flash(f'Error updating {table_name.capitalize()}: {e}', 'error')
-
-        else: # GET request to display edit form
-            cur.execute(f"SELECT * FROM {table_name} WHERE id = %s;", (id,))
-            data_item = cur.fetchone()
-            if data_item is None:
-                flash(f'{table_name.capitalize()} not found', 'error')
-                return redirect(url_for('admin_list', table_name=table_name))
+        with db.connection() as conn:
+            cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+            # Get column names and data types for form generation
+            columns_info = table_columns(cur, table_name)
+
+            if request.method == 'POST':
+                set_clauses = []
+                update_values = []
+                for col_info in columns_info:
+                    col_name = col_info['name']
+                    if col_name != 'id': # Don't update ID column
+                        set_clauses.append(f"{col_name} = %s")
+                        update_values.append(request.form.get(col_name))
+
+                update_values.append(id) # Add ID for WHERE clause
+                set_clause_str = ', '.join(set_clauses)
+                update_query = f"UPDATE {table_name} SET {set_clause_str} WHERE id = %s;"
+
+                try:
+                    cur.execute(update_query, tuple(update_values))
+                    conn.commit()
+                    flash(f'{table_name.capitalize()} updated successfully!', 'success')
+                    return redirect(url_for('admin_list', table_name=table_name))
+                except Exception as e:
+                    conn.rollback()
+                    TABLE_COLUMNS_CACHE.invalidate(table_name) # In case the failure came from a stale column list
+                    flash(f'Error updating {table_name.capitalize()}: {e}', 'error')
+
+            else: # GET request to display edit form
+                cur.execute(f"SELECT * FROM {table_name} WHERE id = %s;", (id,))
+                data_item = cur.fetchone()
+                if data_item is None:
+                    flash(f'{table_name.capitalize()} not found', 'error')
+                    return redirect(url_for('admin_list', table_name=table_name))
+                check_table_columns(table_name, columns_info, [col.name for col in cur.description])
 
     except Exception as e:
-        cur.close()
-        conn.close()
         flash(f'Error preparing edit form for {table_name.capitalize()}: {e}', 'error')
         return redirect(url_for('admin_list', table_name=table_name))
-    finally:
-        if request.method == 'GET': # Only close connection if GET, POST path handles closing in its own scope
-            cur.close()
-            conn.close()
 
 
     return render_template('admin_edit.html', table_name=table_name, columns_info=columns_info, data_item=data_item, item_id=id)
 
+@app.route('/admin/<table_name>/export')
+def admin_export(table_name):
+    """
+    Streams the whole table as CSV straight out of COPY TO STDOUT.
+    """
+    if table_name not in TABLES_TO_MANAGE:
+        flash('Invalid table name', 'error')
+        return redirect(url_for('admin_panel'))
+
+    copy_query = f"COPY (SELECT * FROM {table_name} ORDER BY id) TO STDOUT WITH (FORMAT csv, HEADER true);"
+    return Response(db.copy_out_stream(copy_query), mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename={table_name}.csv'})
+
+@app.route('/admin/<table_name>/import', methods=['POST'])
+def admin_import(table_name):
+    """
+    Bulk-loads a CSV file whose header names columns of the table.
+    The file is COPYed into a temporary staging table shaped like the target,
+    which checks types and NOT NULL columns, then merged in with one INSERT
+    (rows with an existing id are updated). Everything happens in one
+    transaction, so a bad row rejects the whole file.
+    """
+    if table_name not in TABLES_TO_MANAGE:
+        flash('Invalid table name', 'error')
+        return redirect(url_for('admin_panel'))
+
+    file = request.files.get('file')
+    if file is None or file.filename == "":
+        flash('No selected file', 'error')
+        return redirect(url_for('admin_list', table_name=table_name))
+    header = next(csv.reader([file.stream.readline().decode('utf-8-sig')]), [])
+    header = [col.strip().lower() for col in header]
+    file.stream.seek(0)
+
+    try:
+        with db.connection() as conn:
+            cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+            column_names = [col['name'] for col in table_columns(cur, table_name)]
+            if not header or len(set(header)) != len(header) or any(col not in column_names for col in header):
+                flash(f'CSV header must list columns of {table_name}: {", ".join(column_names)}', 'error')
+                return redirect(url_for('admin_list', table_name=table_name))
+
+            staging = f"staging_{table_name}"
+            columns_str = ', '.join(header)
+            cur.execute(f"CREATE TEMP TABLE {staging} (LIKE {table_name} INCLUDING DEFAULTS) ON COMMIT DROP;")
+            cur.copy_expert(f"COPY {staging} ({columns_str}) FROM STDIN WITH (FORMAT csv, HEADER true);", file.stream)
+            conflict = ""
+            if 'id' in header:
+                updates = ', '.join(f"{col} = EXCLUDED.{col}" for col in header if col != 'id')
+                conflict = f"ON CONFLICT (id) DO UPDATE SET {updates}" if updates else "ON CONFLICT (id) DO NOTHING"
+            cur.execute(f"INSERT INTO {table_name} ({columns_str}) SELECT {columns_str} FROM {staging} {conflict};")
+            merged = cur.rowcount
+            if 'id' in header:
+                # Explicit ids bypass the sequence, so move it past them.
+                cur.execute(f"SELECT setval(pg_get_serial_sequence('{table_name}', 'id'), GREATEST((SELECT max(id) FROM {table_name}), 1));")
+        flash(f'Imported {merged} {table_name} rows', 'success')
+    except Exception as e:
+        flash(f'Error importing {table_name.capitalize()}: {e}', 'error')
+    return redirect(url_for('admin_list', table_name=table_name))
+
 @app.route('/admin/<table_name>/delete/<id>')
 def admin_delete(table_name, id):
     if table_name not in TABLES_TO_MANAGE:
         flash('Invalid table name', 'error')
         return redirect(url_for('admin_panel'))
 
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
     try:
-        cur.execute(f"DELETE FROM {table_name} WHERE id = %s;", (id,))
-        conn.commit()
+        with db.cursor() as cur:
+            cur.execute(f"DELETE FROM {table_name} WHERE id = %s;", (id,))
         flash(f'{table_name.capitalize()} deleted successfully!', 'success')
     except Exception as e:
-        conn.rollback()
         flash(f'Error deleting {table_name.capitalize()}: {e}', 'error')
-    finally:
-        cur.close()
-        conn.close()
     return redirect(url_for('admin_list', table_name=table_name))
 
 
 
+def cached_search_results(cache_key):
+    """
+    Returns the recipes cached for this query, or None if there is no entry or
+    recipe_embeddings has changed since it was cached.
+    A hit costs one primary-key lookup instead of an embedding plus ANN query.
+    """
+    cached = SEARCH_RESULT_CACHE.get(cache_key)
+    if cached is MISSING:
+        return None
+    version, ids = cached
+    with db.cursor() as cur:
+        cur.execute(query.recipes_by_ids_query, (ids, ids))
+        rows = cur.fetchall()
+    if rows[0]['version'] != version:
+        # Embeddings were rewritten, so every cached ranking is suspect.
+        SEARCH_RESULT_CACHE.clear()
+        return None
+    return [row for row in rows if row['id'] is not None]
+
+def requested_ef_search(values):
+    """
+    hnsw.ef_search for this request, from ?ef_search= / the form, falling back
+    to HNSW_EF_SEARCH. Higher values trade latency for recall.
+    """
+    value = values.get('ef_search', os.getenv("HNSW_EF_SEARCH", query.DEFAULT_EF_SEARCH))
+    try:
+        return max(1, min(int(value), query.MAX_EF_SEARCH))
+    except (TypeError, ValueError):
+        return query.DEFAULT_EF_SEARCH
+
+def vector_search(cur, sql, params, ef_search):
+    """
+    Runs an ANN query with hnsw.ef_search set for this transaction only, so the
+    setting never leaks to the next user of the pooled connection.
+    """
+    cur.execute(query.set_ef_search_query, (str(query.ann_ef_search(ef_search, VECTOR_INDEX)),))
+    cur.execute(sql, params)
+    return cur.fetchall()
+
+def nearest_images(embedding):
+    """
+    Parameters for query.images_by_ids_query naming the IMAGE_RESULTS images
+    nearest to a CLIP embedding, from the in-process index, or None when it is
+    off or not loaded yet and pgvector should be asked instead.
+    """
+    if not IMAGE_INDEX_ENABLED:
+        return None
+    nearest = image_index.get_image_index().search(embedding, IMAGE_RESULTS)
+    if nearest is None:
+        return None
+    ids, distances = nearest
+    return {"ids": ids.tolist(), "distances": distances.tolist()}
+
+def query_text_embedding(cache_key, search_query):
+    embedding = QUERY_EMBEDDING_CACHE.get(cache_key)
+    if embedding is MISSING:
+        embedding = TEXT_BATCHER(search_query, timeout=INFERENCE_TIMEOUT).astype(float).tolist()
+        QUERY_EMBEDDING_CACHE.put(cache_key, embedding)
+    return embedding
+
+def requested_weight(values, name, default=1.0):
+    """
+    Non-negative rank-fusion weight from the request, e.g. ?lexical_weight=0.5
+    """
+    try:
+        return max(0.0, float(values.get(name, default)))
+    except ValueError:
+        return default
+
+def recipe_search_sql(mode, search_query, embedding, ef_search, weights):
+    """
+    Returns (sql, params) for a semantic or hybrid recipe search.
+    """
+    if mode == 'hybrid':
+        params = dict(embedding=embedding, text=search_query, candidates=max(ef_search, SEARCH_RESULTS),
+                      semantic_weight=weights[0], lexical_weight=weights[1], rrf_k=query.RRF_K, k=SEARCH_RESULTS)
+        return RECIPE_HYBRID_SQL, params
+    return RECIPE_SEMANTIC_SQL, dict(embedding=embedding, k=SEARCH_RESULTS)
+
+def advanced_search_params(form):
+    """
+    Returns (sql, params) for the non-empty fields of the advanced search form.
+    """
+    fields = {
+        'name': form.get('query_name', '').strip(),
+        'ingredients': form.get('query_ingredients', '').strip(),
+        'steps': form.get('query_steps', '').strip(),
+        'description': form.get('query_description', '').strip(),
+    }
+    fields = {field: text for field, text in fields.items() if text}
+    params = dict(fields)
+    params.update({f"{field}_pattern": query.like_pattern(text) for field, text in fields.items()})
+    return query.advanced_search_sql(fields), params
+
 @app.route('/recipe_search', methods=['GET', 'POST'])
 def recipe_search():
     if request.method == 'POST':
-        query = request.form.get('search_query')
-
-        # Fuzzy search:
-        embedding = create_text_embedding([query])[0].astype(float).tolist()
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        cur.execute(f"SELECT id, name, mainimage, description from recipe INNER JOIN recipe_embeddings on recipe.id=recipe_embeddings.recipeid ORDER BY description_embedding <#> %s::vector ASC LIMIT 10", (embedding,))
-        recipes = cur.fetchall()
-        cur.close()
-        conn.close()
-        if len(recipes) > 0:
-            return render_template('recipe_search.html', search_results=recipes, query=query, text="")
+        search_query = request.form.get('search_query')
+        mode = request.form.get('mode', 'semantic')
+        if mode not in SEARCH_MODES:
+            mode = 'semantic'
+        cache_key = normalize_query(search_query)
+
+        if mode == 'exact':
+            # Exact search:
+            pattern = query.like_pattern(search_query)
+            with db.cursor() as cur:
+                cur.execute(query.recipe_exact_search_query, (pattern, pattern))
+                recipes = cur.fetchall()
         else:
-            return render_template('recipe_search.html', search_results=recipes, query=query, text="No results found")
-        
-
-        # Exact search:
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        cur.execute(f"SELECT id, name, mainimage, description from recipe WHERE LOWER(name) LIKE '%%' || LOWER(%s) || '%%' OR LOWER(description) LIKE '%%' || LOWER(%s) || '%%' ;", (query, query))
-        recipes = cur.fetchall()
-        cur.close()
-        conn.close()
+            # Fuzzy search, optionally fused with full-text ranking:
+            ef_search = requested_ef_search(request.values)
+            weights = (requested_weight(request.values, 'semantic_weight'), requested_weight(request.values, 'lexical_weight'))
+            result_key = (cache_key, mode, ef_search, weights)
+            recipes = cached_search_results(result_key)
+            if recipes is None:
+                embedding = query_text_embedding(cache_key, search_query)
+                with db.cursor() as cur:
+                    recipes = vector_search(cur, *recipe_search_sql(mode, search_query, embedding, ef_search, weights), ef_search)
+                if len(recipes) > 0:
+                    SEARCH_RESULT_CACHE.put(result_key, (recipes[0]['version'], [r['id'] for r in recipes]))
         if len(recipes) > 0:
-            return render_template('recipe_search.html', search_results=recipes, query=query, text="")
+            return render_template('recipe_search.html', search_results=recipes, query=search_query, mode=mode, text="")
         else:
-            return render_template('recipe_search.html', search_results=recipes, query=query, text="No results found")
-    return render_template('recipe_search.html', search_results=[], query='', text="")
+            return render_template('recipe_search.html', search_results=recipes, query=search_query, mode=mode, text="No results found")
+    return render_template('recipe_search.html', search_results=[], query='', mode='semantic', text="")
 
 
 
@@ -321,18 +612,12 @@ def recipe_search():
 @app.route('/advanced_search', methods=['GET', 'POST'])
 def advanced_search():
     if request.method == 'POST':
-        query_name = request.form.get('query_name')
-        query_ingredients = request.form.get('query_ingredients')
-        query_steps = request.form.get('query_steps')
-        query_description = request.form.get('query_description')
+        sql, params = advanced_search_params(request.form)
 
         # Exact search:
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        cur.execute(f"SELECT DISTINCT r.id, r.name, r.mainimage, r.description from recipe r inner join step s on r.id = s.recipeid inner join recipe_ingredient ri on ri.recipeid = r.id inner join ingredient i on i.id = ri.ingredientid WHERE LOWER(r.name) LIKE '%%' || LOWER(%s) || '%%' AND LOWER(r.description) LIKE '%%' || LOWER(%s) || '%%' AND LOWER(s.description) LIKE '%%' || LOWER(%s) || '%%' AND LOWER(i.name) LIKE '%%' || LOWER(%s) || '%%';", (query_name, query_description, query_steps, query_ingredients))
-        recipes = cur.fetchall()
-        cur.close()
-        conn.close()
+        with db.cursor() as cur:
+            cur.execute(sql, params)
+            recipes = cur.fetchall()
         if len(recipes) > 0:
             return render_template('advanced_search.html', search_results=recipes, query=query, text="")
         else:
@@ -0,0 +1,241 @@
+"""
+Async (ASGI) serving mode for the search endpoints.
+
+/recipe_search, /image_search, /advanced_search and /metrics are served by a
+Quart app that talks to Postgres through an async connection pool and hands
+model inference to the per-process micro-batchers, so a single process can
+have many searches in flight while holding one copy of each model.
+Every other route is passed through to the regular Flask app.
+
+Run from the flask folder with:
+    uvicorn asgi:application --host 0.0.0.0 --port 5000
+
+INFERENCE_CONCURRENCY bounds how many requests may wait on inference at once,
+and PREPROCESS_WORKERS sizes the thread pool used for image decoding.
+"""
+import asyncio
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.wsgi import WsgiToAsgi
+from PIL import Image, UnidentifiedImageError
+from quart import Quart, render_template, flash, request, redirect, url_for, jsonify
+from werkzeug.utils import secure_filename
+
+import app as wsgi
+import db
+import queries as query
+from cache import MISSING, normalize_query
+from embeddings import decode_image
+
+ASYNC_PATHS = {'/recipe_search', '/image_search', '/advanced_search', '/metrics'}
+INFERENCE_CONCURRENCY = int(os.getenv("INFERENCE_CONCURRENCY", 32))
+PREPROCESS_WORKERS = int(os.getenv("PREPROCESS_WORKERS", 4))
+
+quart_app = Quart(__name__)
+quart_app.secret_key = wsgi.app.secret_key
+quart_app.config['MAX_CONTENT_LENGTH'] = wsgi.MAX_UPLOAD_BYTES
+
+_executor = ThreadPoolExecutor(max_workers=PREPROCESS_WORKERS, thread_name_prefix="preprocess")
+_inference_slots = None
+
+
+@quart_app.before_serving
+async def startup():
+    global _inference_slots
+    _inference_slots = asyncio.Semaphore(INFERENCE_CONCURRENCY)
+    await db.open_async_pool()
+
+
+@quart_app.after_serving
+async def shutdown():
+    await db.close_async_pool()
+    _executor.shutdown(wait=False)
+
+
+async def run_blocking(fn, *args):
+    """
+    Runs CPU-bound work (image decoding, JPEG encoding, in-process image
+    search) on the bounded pool.
+    """
+    return await asyncio.get_running_loop().run_in_executor(_executor, fn, *args)
+
+
+async def embed(batcher, item):
+    """
+    Queues one item on a micro-batcher and awaits its embedding without
+    blocking the event loop. If the request is cancelled (client gone,
+    timeout) the batcher drops the item, or finishes it if its batch has
+    already started; the rest of the batch is unaffected.
+    """
+    async with _inference_slots:
+        return await asyncio.wait_for(asyncio.wrap_future(batcher.submit(item)), wsgi.INFERENCE_TIMEOUT)
+
+
+async def vector_search(cur, sql, params, ef_search):
+    await cur.execute(query.set_ef_search_query, (str(query.ann_ef_search(ef_search, wsgi.VECTOR_INDEX)),))
+    await cur.execute(sql, params)
+    return await cur.fetchall()
+
+
+async def cached_search_results(cache_key):
+    """
+    Async counterpart of app.cached_search_results(); shares its cache.
+    """
+    cached = wsgi.SEARCH_RESULT_CACHE.get(cache_key)
+    if cached is MISSING:
+        return None
+    version, ids = cached
+    async with db.async_cursor() as cur:
+        await cur.execute(query.recipes_by_ids_query, (ids, ids))
+        rows = await cur.fetchall()
+    if rows[0]['version'] != version:
+        wsgi.SEARCH_RESULT_CACHE.clear()
+        return None
+    return [row for row in rows if row['id'] is not None]
+
+
+async def query_text_embedding(cache_key, search_query):
+    embedding = wsgi.QUERY_EMBEDDING_CACHE.get(cache_key)
+    if embedding is MISSING:
+        embedding = (await embed(wsgi.TEXT_BATCHER, search_query)).astype(float).tolist()
+        wsgi.QUERY_EMBEDDING_CACHE.put(cache_key, embedding)
+    return embedding
+
+
+@quart_app.route('/metrics')
+async def metrics():
+    return jsonify(db_pool=db.pool_stats(),
+                   async_db_pool=db.async_pool_stats(),
+                   query_embedding_cache=wsgi.QUERY_EMBEDDING_CACHE.stats(),
+                   search_result_cache=wsgi.SEARCH_RESULT_CACHE.stats(),
+                   image_embedding_cache=wsgi.IMAGE_EMBEDDING_CACHE.stats(),
+                   clip_batcher=wsgi.IMAGE_BATCHER.stats(),
+                   mpnet_batcher=wsgi.TEXT_BATCHER.stats(),
+                   image_index=wsgi.image_index.get_image_index().stats() if wsgi.IMAGE_INDEX_ENABLED else None)
+
+
+@quart_app.route('/image_search', methods=['GET', 'POST'])
+async def image_search():
+    if request.method == 'POST':
+        files = await request.files
+        if 'file' not in files:
+            await flash('No file part')
+            return redirect(request.url)
+        file = files['file']
+        if file.filename == "":
+            await flash('No selected file')
+            return redirect(request.url)
+
+        if file and wsgi.allowed_file(file.filename):
+            filename = secure_filename(file.filename)
+            data = file.read(wsgi.MAX_UPLOAD_BYTES + 1)
+            if len(data) > wsgi.MAX_UPLOAD_BYTES:
+                await flash('Uploaded file is too large')
+                return redirect(request.url)
+
+            try:
+                img = await run_blocking(decode_image, data)
+            except (UnidentifiedImageError, Image.DecompressionBombError, OSError):
+                await flash('Uploaded file is not a valid image')
+                return redirect(request.url)
+
+            content_hash = hashlib.sha256(data).hexdigest()
+            img_embedding = wsgi.IMAGE_EMBEDDING_CACHE.get(content_hash)
+            if img_embedding is MISSING:
+                img_embedding = (await embed(wsgi.IMAGE_BATCHER, img)).tolist()
+                wsgi.IMAGE_EMBEDDING_CACHE.put(content_hash, img_embedding)
+
+            if wsgi.SAVE_UPLOADS:
+                img_filepath = os.path.join(wsgi.UPLOAD_FOLDER, filename)
+                await run_blocking(_write_file, img_filepath, data)
+                image_src = url_for('static', filename='uploads/' + filename)
+            else:
+                image_src = await run_blocking(wsgi.thumbnail_data_uri, img)
+
+            values = await request.values
+            nearest = await run_blocking(wsgi.nearest_images, img_embedding)
+            async with db.async_cursor() as cur:
+                if nearest is None:
+                    results = await vector_search(cur, wsgi.IMAGE_SIMILARITY_SQL, {"embedding": img_embedding, "k": wsgi.IMAGE_RESULTS},
+                                                  wsgi.requested_ef_search(values))
+                else:
+                    await cur.execute(query.images_by_ids_query, nearest)
+                    results = await cur.fetchall()
+            return await render_template('image_result.html', image_src=image_src, similar_images=results)
+        else:
+            await flash('File type not allowed!')
+            return redirect(request.url)
+    return await render_template("image_search.html")
+
+
+def _write_file(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+@quart_app.route('/recipe_search', methods=['GET', 'POST'])
+async def recipe_search():
+    if request.method == 'POST':
+        values = await request.values
+        search_query = values.get('search_query', '')
+        mode = values.get('mode', 'semantic')
+        if mode not in wsgi.SEARCH_MODES:
+            mode = 'semantic'
+        cache_key = normalize_query(search_query)
+
+        if mode == 'exact':
+            pattern = query.like_pattern(search_query)
+            async with db.async_cursor() as cur:
+                await cur.execute(query.recipe_exact_search_query, (pattern, pattern))
+                recipes = await cur.fetchall()
+        else:
+            ef_search = wsgi.requested_ef_search(values)
+            weights = (wsgi.requested_weight(values, 'semantic_weight'), wsgi.requested_weight(values, 'lexical_weight'))
+            result_key = (cache_key, mode, ef_search, weights)
+            recipes = await cached_search_results(result_key)
+            if recipes is None:
+                embedding = await query_text_embedding(cache_key, search_query)
+                async with db.async_cursor() as cur:
+                    recipes = await vector_search(cur, *wsgi.recipe_search_sql(mode, search_query, embedding, ef_search, weights), ef_search)
+                if len(recipes) > 0:
+                    wsgi.SEARCH_RESULT_CACHE.put(result_key, (recipes[0]['version'], [r['id'] for r in recipes]))
+        text = "" if len(recipes) > 0 else "No results found"
+        return await render_template('recipe_search.html', search_results=recipes, query=search_query, mode=mode, text=text)
+    return await render_template('recipe_search.html', search_results=[], query='', mode='semantic', text="")
+
+
+@quart_app.route('/advanced_search', methods=['GET', 'POST'])
+async def advanced_search():
+    if request.method == 'POST':
+        sql, params = wsgi.advanced_search_params(await request.form)
+        async with db.async_cursor() as cur:
+            await cur.execute(sql, params)
+            recipes = await cur.fetchall()
+        text = "" if len(recipes) > 0 else "No results found"
+        return await render_template('advanced_search.html', search_results=recipes, query=True, text=text)
+    return await render_template('advanced_search.html', search_results=[], query='', text="")
+
+
+def _served_by_flask(**kwargs):
+    raise RuntimeError("this route is served by the Flask app")
+
+# Register the Flask app's other routes too, so url_for() in the shared
+# templates can build links to them. Requests for them never reach Quart.
+for rule in wsgi.app.url_map.iter_rules():
+    if rule.endpoint not in quart_app.view_functions:
+        quart_app.add_url_rule(rule.rule, endpoint=rule.endpoint, view_func=_served_by_flask, methods=['GET'])
+
+flask_asgi = WsgiToAsgi(wsgi.app)
+
+
+async def application(scope, receive, send):
+    """
+    Sends the async routes (and lifespan events) to Quart, everything else to
+    the Flask app running in a thread pool.
+    """
+    if scope["type"] != "http" or scope["path"] in ASYNC_PATHS:
+        await quart_app(scope, receive, send)
+    else:
+        await flask_asgi(scope, receive, send)
@@ -0,0 +1,136 @@
+"""
+Micro-batching for model inference.
+Requests running on different threads submit single items; a background
+thread per process collects whatever arrives within a short window (up to a
+maximum batch size) and runs one batched forward pass for all of them.
+"""
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class MicroBatcher:
+    """
+    Runs `batch_fn(items) -> results` on batches of submitted items.
+    `max_wait_ms` is how long the worker keeps collecting after the first item
+    of a batch arrives; 0 means it only takes what is already queued, which
+    adds no latency but still batches requests that arrive together.
+    """
+
+    def __init__(self, batch_fn, max_batch=16, max_wait_ms=0.0, name="batcher"):
+        self.batch_fn = batch_fn
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait_ms / 1000
+        self.name = name
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "batches": 0,
+            "items": 0,
+            "max_batch_size": 0,
+            "errors": 0,
+            "queue_wait_seconds": 0.0,
+            "max_queue_wait_seconds": 0.0,
+            "inference_seconds": 0.0,
+        }
+        self._batch_sizes = {}  # batch size -> count
+
+    def _ensure_worker(self):
+        # Threads do not survive a fork, so each gunicorn worker starts its own.
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def submit(self, item) -> Future:
+        """
+        Queues one item and returns a Future for its result. Cancelling the
+        Future before its batch starts drops the item; after that, cancel()
+        returns False and the batch runs as usual.
+        """
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((item, future, time.monotonic()))
+        return future
+
+    def __call__(self, item, timeout=None):
+        """
+        Submits one item and waits for its result; raises
+        concurrent.futures.TimeoutError after `timeout` seconds.
+        """
+        return self.submit(item).result(timeout=timeout)
+
+    def _collect(self):
+        batch = []
+        while not batch:
+            self._take(batch, self._queue.get())
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    self._take(batch, self._queue.get(timeout=remaining))
+                else:
+                    self._take(batch, self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    @staticmethod
+    def _take(batch, entry):
+        # Marking the future running means it can no longer be cancelled, so
+        # setting its result later cannot fail. Items whose caller has
+        # already given up (e.g. an async request that timed out or was
+        # disconnected) are dropped.
+        if entry[1].set_running_or_notify_cancel():
+            batch.append(entry)
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            started = time.monotonic()
+            waits = [started - queued_at for _, _, queued_at in batch]
+            try:
+                results = list(self.batch_fn([item for item, _, _ in batch]))
+                if len(results) != len(batch):
+                    raise ValueError(f"{self.name}: batch_fn returned {len(results)} results for {len(batch)} items")
+                for (_, future, _), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                with self._stats_lock:
+                    self._stats["errors"] += 1
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            self._record(len(batch), waits, time.monotonic() - started)
+
+    def _record(self, size, waits, inference_seconds):
+        with self._stats_lock:
+            stats = self._stats
+            stats["batches"] += 1
+            stats["items"] += size
+            stats["max_batch_size"] = max(stats["max_batch_size"], size)
+            stats["queue_wait_seconds"] += sum(waits)
+            stats["max_queue_wait_seconds"] = max(stats["max_queue_wait_seconds"], max(waits))
+            stats["inference_seconds"] += inference_seconds
+            self._batch_sizes[size] = self._batch_sizes.get(size, 0) + 1
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+            stats["batch_sizes"] = dict(sorted(self._batch_sizes.items()))
+        stats["mean_batch_size"] = stats["items"] / stats["batches"] if stats["batches"] else 0.0
+        stats["mean_queue_wait_seconds"] = stats["queue_wait_seconds"] / stats["items"] if stats["items"] else 0.0
+        stats["queued"] = self._queue.qsize() if self._queue is not None else 0
+        stats["max_batch"] = self.max_batch
+        stats["max_wait_ms"] = self.max_wait * 1000
+        return stats
@@ -0,0 +1,455 @@
+#!python
+"""
+Small benchmarks for the search and embedding code paths.
+Run from the flask folder, e.g. `python benchmark.py models`.
+"""
+import argparse
+import os
+import statistics
+import time
+
+from dotenv import load_dotenv
+
+SAMPLE_QUERIES = [
+    "chocolate cake",
+    "chicken thighs",
+    "vegetarian lasagna",
+    "quick weeknight pasta",
+    "lemon garlic salmon",
+]
+
+
+def timed(fn, *args, **kwargs):
+    """
+    Runs fn once and returns (seconds, result).
+    """
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def report(label, samples):
+    """
+    Prints min/median/p95 of a list of durations in seconds.
+    """
+    samples = sorted(samples)
+    p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+    print(f"{label:<32} n={len(samples):<5} min={samples[0] * 1000:9.2f} ms  "
+          f"median={statistics.median(samples) * 1000:9.2f} ms  p95={p95 * 1000:9.2f} ms")
+
+
+def bench_models(args):
+    """
+    Cold vs warm latency of a single /recipe_search query embedding.
+    'per-call load' reproduces the old behaviour of building a new
+    SentenceTransformer for every request.
+    """
+    import embeddings
+
+    embeddings._models.clear()
+    cold, _ = timed(embeddings.create_text_embedding, [SAMPLE_QUERIES[0]])
+    report("cold (first query)", [cold])
+
+    warm = [timed(embeddings.create_text_embedding, [SAMPLE_QUERIES[i % len(SAMPLE_QUERIES)]])[0]
+            for i in range(args.repeat)]
+    report("warm (registry)", warm)
+
+    per_call = [timed(lambda q: embeddings.init_text_model().encode([q], normalize_embeddings=True),
+                      SAMPLE_QUERIES[i % len(SAMPLE_QUERIES)])[0]
+                for i in range(min(args.repeat, 3))]
+    report("per-call load (old)", per_call)
+
+
+def bench_explain(args):
+    """
+    Checks that the recipe_embeddings HNSW index is built for the metric the
+    search query uses, and that EXPLAIN shows an index scan on it.
+    Sequential scans are disabled for the check because on a small dev
+    catalog the planner may rightly prefer one; what matters is that the
+    index is usable at all (with a mismatched operator it never is).
+    """
+    import random
+    import db
+    import queries as query
+
+    expected_opclass = query.index_opclass(query.RECIPE_EMBEDDING_METRIC, args.index)
+    sql = query.recipe_semantic_search_sql(index=args.index)
+    ef_search = query.ann_ef_search(args.ef_search, args.index)
+    embedding = [random.uniform(-1, 1) for _ in range(768)]
+    with db.cursor() as cur:
+        cur.execute(query.hnsw_opclass_query, ("recipe_embeddings",))
+        indexes = cur.fetchall()
+        assert indexes, "no HNSW index on recipe_embeddings"
+        assert any(row["opclass"] == expected_opclass for row in indexes), \
+            f"HNSW index opclass {[row['opclass'] for row in indexes]} does not match {expected_opclass}"
+
+        cur.execute("SET LOCAL enable_seqscan = off;")
+        cur.execute(query.set_ef_search_query, (str(ef_search),))
+        cur.execute("EXPLAIN " + sql, {"embedding": embedding, "k": 10})
+        plan = "\n".join(row[0] for row in cur.fetchall())
+    print(plan)
+    index_names = [row["index_name"] for row in indexes]
+    assert any(f"Index Scan using {name}" in plan for name in index_names), \
+        "recipe search does not use the HNSW index"
+    print(f"OK: recipe search uses HNSW index ({expected_opclass})")
+
+    timings = []
+    with db.cursor() as cur:
+        for _ in range(args.repeat):
+            embedding = [random.uniform(-1, 1) for _ in range(768)]
+            cur.execute(query.set_ef_search_query, (str(ef_search),))
+            seconds, _ = timed(cur.execute, sql, {"embedding": embedding, "k": 10})
+            timings.append(seconds)
+    report(f"ANN query ({args.index}, ef_search={ef_search})", timings)
+
+
+def bench_load(args):
+    """
+    Fires concurrent /recipe_search requests at a running server and reports
+    throughput and latency. Run it once against gunicorn (app:app) and once
+    against uvicorn (asgi:application) with the same settings to compare.
+    """
+    import requests
+    from concurrent.futures import ThreadPoolExecutor
+
+    url = args.url.rstrip("/") + "/recipe_search"
+
+    def one(i):
+        # Vary the text so the result cache does not answer everything.
+        data = {"search_query": f"{SAMPLE_QUERIES[i % len(SAMPLE_QUERIES)]} {i}", "mode": args.mode}
+        start = time.perf_counter()
+        response = requests.post(url, data=data, timeout=120)
+        return time.perf_counter() - start, response.status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(one, range(args.requests)))
+    elapsed = time.perf_counter() - start
+    errors = sum(1 for _, status in results if status != 200)
+    report(f"{args.mode} @ concurrency {args.concurrency}", [seconds for seconds, _ in results])
+    print(f"throughput: {len(results) / elapsed:.1f} req/s, errors: {errors}")
+
+
+def bench_bulkload(args):
+    """
+    Rows per second writing random embeddings to recipe_embeddings and image,
+    one INSERT per row with list-of-float vectors (old) vs binary COPY into a
+    staging table plus one merge (bulkload.py). Runs inside a transaction that
+    is rolled back, against existing recipe ids.
+    """
+    import numpy as np
+    import bulkload
+    import db
+
+    with db.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id FROM recipe ORDER BY id LIMIT %s;", (args.rows,))
+        ids = [row[0] for row in cur.fetchall()]
+        assert ids, "recipe table is empty"
+        cur.execute("SELECT set_config('recipes.skip_embedding_queue', 'on', true);")
+        tables = [
+            ("recipe_embeddings", ["recipeId", "description_embedding"], ["bigint", "vector"], ["recipeId"],
+             [(i, np.random.rand(768).astype(np.float32)) for i in ids]),
+            ("image", ["recipeId", "imageLocation", "embedding"], ["bigint", "text", "vector"], ["recipeId", "imageLocation"],
+             [(i, f"bench://{i}", np.random.rand(512).astype(np.float32)) for i in ids]),
+        ]
+        for table, columns, kinds, keys, rows in tables:
+            columns_str = ", ".join(columns)
+            placeholders = ", ".join(["%s"] * len(columns))
+            updates = ", ".join(f"{col} = EXCLUDED.{col}" for col in columns if col not in keys)
+            insert = (f"INSERT INTO {table} ({columns_str}) VALUES ({placeholders}) "
+                      f"ON CONFLICT ({', '.join(keys)}) DO UPDATE SET {updates};")
+
+            def per_row():
+                for row in rows:
+                    cur.execute(insert, row[:-1] + (row[-1].astype(float).tolist(),))
+
+            for label, fn in [("per-row INSERT (old)", per_row),
+                              ("binary COPY + merge", lambda: bulkload.upsert_rows(cur, table, columns, kinds, keys, rows))]:
+                samples = []
+                for _ in range(args.repeat):
+                    cur.execute("SAVEPOINT bench;")
+                    samples.append(timed(fn)[0])
+                    cur.execute("ROLLBACK TO SAVEPOINT bench;")
+                report(f"{table}: {label}", samples)
+                print(f"{'':<32} {len(rows) / statistics.median(samples):,.0f} rows/s")
+        conn.rollback()
+
+
+def bench_fetch(args):
+    """
+    Downloads from a local stand-in HTTP server that answers after a fixed
+    delay, fails every --flaky'th URL with a 503 on its first request and
+    returns 404 for every --missing'th: sequential requests.get (old) vs
+    fetcher.Fetcher. Checks that flaky URLs succeed on retry and only the
+    missing ones are recorded as failures.
+    """
+    import io
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    import requests
+    from PIL import Image
+    from fetcher import Fetcher
+
+    buffer = io.BytesIO()
+    Image.new("RGB", (256, 256), "orange").save(buffer, format="JPEG")
+    body = buffer.getvalue()
+    seen = set()
+    seen_lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(args.latency / 1000)
+            n = int(self.path.strip("/"))
+            with seen_lock:
+                first = self.path not in seen
+                seen.add(self.path)
+            if args.missing and n % args.missing == 0:
+                self.send_error(404)
+            elif args.flaky and n % args.flaky == 0 and first:
+                self.send_error(503)
+            else:
+                self.send_response(200)
+                self.send_header("Content-Type", "image/jpeg")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    urls = [f"http://127.0.0.1:{server.server_port}/{n}" for n in range(1, args.urls + 1)]
+    expected_failures = sum(1 for n in range(1, args.urls + 1) if args.missing and n % args.missing == 0)
+
+    def sequential():
+        for url in urls:
+            requests.get(url, timeout=30)
+
+    fetcher = Fetcher(workers=args.workers, per_host=args.per_host, backoff=0.05)
+    seconds, _ = timed(lambda: list(fetcher.map(fetcher.get, urls)))
+    fetcher.close()
+    seen.clear()
+    sequential_seconds, _ = timed(sequential)
+    server.shutdown()
+
+    print(f"sequential (old): {sequential_seconds:.2f} s, {len(urls) / sequential_seconds:.1f} urls/s")
+    print(f"Fetcher ({args.workers} workers, {args.per_host} per host): {seconds:.2f} s, "
+          f"{len(urls) / seconds:.1f} urls/s, stats {fetcher.stats()}")
+    assert len(fetcher.failures) == expected_failures, \
+        f"expected {expected_failures} failures, got {len(fetcher.failures)}: {fetcher.failures[:5]}"
+    print(f"OK: {expected_failures} missing urls recorded as failures, flaky urls recovered")
+
+
+def bench_backends(args):
+    """
+    Parity and speed of the ONNX backends against PyTorch. Embeds a batch of
+    sample texts and images (from the image cache, or random ones if it is
+    empty) with every backend, checks that each backend's embeddings have at
+    least --threshold cosine similarity with the PyTorch ones, and reports
+    latency per batch and throughput.
+    """
+    import glob
+    import numpy as np
+    import torch
+    from PIL import Image
+    import embeddings
+
+    paths = sorted(glob.glob(os.path.join(embeddings.CACHE_DIR, "blobs", "*", "*.jpg")))[:args.batch]
+    if paths:
+        images = [Image.open(path).convert("RGB") for path in paths]
+    else:
+        rng = np.random.default_rng(0)
+        images = [Image.fromarray(rng.integers(0, 256, (256, 256, 3), dtype=np.uint8)) for _ in range(args.batch)]
+    pixels = torch.stack([embeddings.preprocess_image(img) for img in images])
+    texts = [f"{SAMPLE_QUERIES[i % len(SAMPLE_QUERIES)]} with a side of recipe {i}" for i in range(args.batch)]
+
+    reference = {}
+    failed = []
+    for backend in embeddings.BACKENDS:
+        encoders = {
+            "clip": lambda: embeddings.embed_pixels(pixels, backend=backend),
+            "mpnet": lambda: np.stack(embeddings.create_text_embedding(texts, backend=backend)),
+        }
+        for name, encode in encoders.items():
+            result = encode()  # loads (and for ONNX exports) the model first
+            samples = [timed(encode)[0] for _ in range(args.repeat)]
+            report(f"{name} {backend} (batch {len(result)})", samples)
+            print(f"{'':<32} {len(result) / statistics.median(samples):,.1f} items/s")
+            if backend == "torch":
+                reference[name] = result
+                continue
+            cosine = np.sum(reference[name] * result, axis=1)
+            print(f"{'':<32} cosine vs torch: min={cosine.min():.5f} mean={cosine.mean():.5f}")
+            if cosine.min() < args.threshold:
+                failed.append(f"{name} {backend}")
+    assert not failed, f"below cosine threshold {args.threshold}: {', '.join(failed)}"
+    print(f"OK: every backend agrees with torch to cosine >= {args.threshold}")
+
+
+def bench_quantized(args):
+    """
+    Recall@k and latency of the vector, halfvec and bit indexes on
+    recipe_embeddings or image, plus each index's size. Queries are stored
+    embeddings with a little noise added; the exact top k comes from a
+    sequential scan. Missing indexes are built for the run, inside a
+    transaction that is rolled back at the end.
+    """
+    import json
+    import numpy as np
+    import psycopg2.extras
+    import db
+    import queries as query
+
+    table, key, column, dims = {
+        "recipe_embeddings": ("recipe_embeddings", "recipeid", "description_embedding", 768),
+        "image": ("image", "id", "embedding", 512),
+    }[args.table]
+    metric = query.RECIPE_EMBEDDING_METRIC if table == "recipe_embeddings" else query.IMAGE_EMBEDDING_METRIC
+    expressions = {
+        "vector": column,
+        "halfvec": f"({column}::halfvec({dims}))",
+        "bit": f"(binary_quantize({column})::bit({dims}))",
+    }
+    rng = np.random.default_rng(0)
+
+    with db.connection() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur.execute(f"SELECT {column}::text FROM {table} ORDER BY random() LIMIT %s;", (args.queries,))
+        queries = []
+        for (text,) in cur.fetchall():
+            vector = np.array(json.loads(text)) + rng.normal(0, args.noise, dims)
+            queries.append((vector / np.linalg.norm(vector)).tolist())
+        assert queries, f"{table} is empty"
+
+        def run(index, vector):
+            sql = query.ann_sql(table, key, column, dims, metric, index, "%(embedding)s", "%(k)s")
+            cur.execute(sql, {"embedding": vector, "k": args.k})
+            return {row[0] for row in cur.fetchall()}
+
+        cur.execute("SET LOCAL enable_indexscan = off;")
+        exact = [run("vector", vector) for vector in queries]
+        cur.execute("SET LOCAL enable_indexscan = on;")
+
+        cur.execute(query.hnsw_opclass_query, (table,))
+        existing = {row["opclass"]: row["index_name"] for row in cur.fetchall()}
+        for index in query.VECTOR_INDEXES:
+            opclass = query.index_opclass(metric, index)
+            index_name = existing.get(opclass)
+            if index_name is None:
+                index_name = f"bench_{table}_{index}_idx"
+                seconds, _ = timed(cur.execute, f"CREATE INDEX {index_name} ON {table} USING hnsw ({expressions[index]} {opclass});")
+                print(f"built {index_name} in {seconds:.1f} s")
+            cur.execute("SELECT pg_relation_size(%s::regclass);", (index_name,))
+            size = cur.fetchone()[0]
+
+            cur.execute(query.set_ef_search_query, (str(query.ann_ef_search(args.ef_search, index)),))
+            timings, recalls = [], []
+            for vector, truth in zip(queries, exact):
+                seconds, found = timed(run, index, vector)
+                timings.append(seconds)
+                recalls.append(len(found & truth) / len(truth))
+            report(f"{table} {index}", timings)
+            print(f"{'':<32} recall@{args.k}={statistics.mean(recalls):.3f}  index size={size / 2**20:.1f} MiB")
+        conn.rollback()
+
+
+def bench_imageindex(args):
+    """
+    Image similarity from pgvector vs the in-process index (image_index.py):
+    latency of each, recall@k of pgvector against the exact in-process
+    result, and how long a full and a no-op sync take. The index is built in
+    a scratch directory.
+    """
+    import json
+    import tempfile
+    import numpy as np
+    import db
+    import image_index
+    import queries as query
+
+    with tempfile.TemporaryDirectory() as directory:
+        index = image_index.ImageIndex(directory)
+        seconds, _ = timed(index.refresh)
+        print(f"full sync: {seconds:.2f} s for {index.stats()['images']} images")
+        index._snapshot = None
+        seconds, _ = timed(index.refresh)
+        print(f"reload with no changes: {seconds * 1000:.1f} ms")
+
+        rng = np.random.default_rng(0)
+        with db.cursor() as cur:
+            cur.execute("SELECT embedding::text FROM image ORDER BY random() LIMIT %s;", (args.queries,))
+            queries = [np.array(json.loads(row[0])) + rng.normal(0, args.noise, image_index.DIMS)
+                       for row in cur.fetchall()]
+        assert queries, "image is empty"
+        sql = query.image_similarity_sql()
+
+        pg_timings, local_timings, recalls = [], [], []
+        with db.cursor() as cur:
+            cur.execute(query.set_ef_search_query, (str(args.ef_search),))
+            for vector in queries:
+                params = {"embedding": vector.tolist(), "k": args.k}
+                seconds, _ = timed(cur.execute, sql, params)
+                pg_timings.append(seconds)
+                pg_ids = {row["id"] for row in cur.fetchall()}
+                seconds, (ids, _) = timed(index.search, vector, args.k)
+                local_timings.append(seconds)
+                recalls.append(len(pg_ids & set(ids.tolist())) / len(ids))
+    report(f"pgvector (ef_search={args.ef_search})", pg_timings)
+    report("in-process top-k (no id lookup)", local_timings)
+    print(f"pgvector recall@{args.k} vs exact: {statistics.mean(recalls):.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the recipe search app")
+    parser.add_argument("-n", "--repeat", type=int, default=20,
+                        help="Number of timed repetitions")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("models", help="Cold vs warm query embedding latency").set_defaults(func=bench_models)
+    explain = sub.add_parser("explain", help="Assert the recipe search uses the HNSW index")
+    explain.add_argument("--ef-search", type=int, default=40, help="hnsw.ef_search to use")
+    explain.add_argument("--index", default=os.getenv("VECTOR_INDEX", "vector"), choices=["vector", "halfvec", "bit"],
+                         help="Kind of HNSW index the search should use")
+    explain.set_defaults(func=bench_explain)
+    load = sub.add_parser("load", help="Concurrent /recipe_search load test against a running server")
+    load.add_argument("--url", default="http://localhost:5000", help="Base URL of the server")
+    load.add_argument("-c", "--concurrency", type=int, default=32, help="Requests in flight")
+    load.add_argument("-r", "--requests", type=int, default=500, help="Total requests")
+    load.add_argument("--mode", default="semantic", choices=["semantic", "hybrid", "exact"])
+    load.set_defaults(func=bench_load)
+    bulkload = sub.add_parser("bulkload", help="Rows/sec of per-row INSERT vs binary COPY for embeddings")
+    bulkload.add_argument("--rows", type=int, default=1000, help="Rows per write (capped at the recipe count)")
+    bulkload.set_defaults(func=bench_bulkload)
+    fetch = sub.add_parser("fetch", help="Sequential vs concurrent image downloads from a local stand-in server")
+    fetch.add_argument("--urls", type=int, default=200, help="Number of urls to fetch")
+    fetch.add_argument("--latency", type=float, default=50, help="Server delay per request in ms")
+    fetch.add_argument("--workers", type=int, default=16, help="Fetcher threads")
+    fetch.add_argument("--per-host", type=int, default=8, help="Concurrent requests to the one test host")
+    fetch.add_argument("--flaky", type=int, default=10, help="Every n'th url returns 503 once (0: none)")
+    fetch.add_argument("--missing", type=int, default=50, help="Every n'th url returns 404 (0: none)")
+    fetch.set_defaults(func=bench_fetch)
+    backends = sub.add_parser("backends", help="Parity and latency of the torch/ONNX/int8 embedding backends")
+    backends.add_argument("--batch", type=int, default=32, help="Texts and images per batch")
+    backends.add_argument("--threshold", type=float, default=0.99, help="Minimum cosine similarity to torch")
+    backends.set_defaults(func=bench_backends)
+    quantized = sub.add_parser("quantized", help="Recall and latency of the vector, halfvec and bit indexes")
+    quantized.add_argument("--table", default="recipe_embeddings", choices=["recipe_embeddings", "image"])
+    quantized.add_argument("--queries", type=int, default=100, help="Number of query vectors")
+    quantized.add_argument("-k", type=int, default=10, help="Neighbours per query")
+    quantized.add_argument("--noise", type=float, default=0.02, help="Std-dev of noise added to each query")
+    quantized.add_argument("--ef-search", type=int, default=40, help="hnsw.ef_search (scaled up for bit)")
+    quantized.set_defaults(func=bench_quantized)
+    imageindex = sub.add_parser("imageindex", help="pgvector vs in-process image similarity search")
+    imageindex.add_argument("--queries", type=int, default=100, help="Number of query vectors")
+    imageindex.add_argument("-k", type=int, default=5, help="Neighbours per query")
+    imageindex.add_argument("--noise", type=float, default=0.02, help="Std-dev of noise added to each query")
+    imageindex.add_argument("--ef-search", type=int, default=40, help="hnsw.ef_search for pgvector")
+    imageindex.set_defaults(func=bench_imageindex)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    load_dotenv(override=True)
+    main()
@@ -0,0 +1,100 @@
+"""
+Bulk writes of embedding rows with binary COPY.
+Rows are streamed into a temporary staging table in PostgreSQL's binary COPY
+format, each vector sent in pgvector's own binary layout straight from its
+NumPy buffer, and then merged into the target table with one
+INSERT ... ON CONFLICT. This avoids both the per-float Python conversion of
+`embedding.tolist()` and the server parsing a text literal for every vector.
+`copy_out_vectors()` reads (id, vector) rows back the same way.
+"""
+import io
+import struct
+
+import numpy as np
+
+COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+COPY_TRAILER = struct.pack("!h", -1)
+NULL_FIELD = struct.pack("!i", -1)
+
+
+def encode_vector(embedding) -> bytes:
+    """
+    pgvector's binary format: int16 dimensions, int16 unused, then the values
+    as big-endian float4.
+    """
+    values = np.asarray(embedding, dtype=">f4").ravel()
+    return struct.pack("!hh", values.shape[0], 0) + values.tobytes()
+
+
+_ENCODERS = {
+    "bigint": lambda value: struct.pack("!q", value),
+    "text": lambda value: value.encode("utf-8"),
+    "vector": encode_vector,
+}
+
+
+def binary_copy_buffer(rows, kinds) -> io.BytesIO:
+    """
+    Encodes rows as a `COPY ... FROM STDIN WITH (FORMAT binary)` stream.
+    kinds names the type of each column ("bigint", "text" or "vector").
+    """
+    encoders = [_ENCODERS[kind] for kind in kinds]
+    field_count = struct.pack("!h", len(kinds))
+    buffer = io.BytesIO()
+    buffer.write(COPY_HEADER)
+    for row in rows:
+        buffer.write(field_count)
+        for value, encode in zip(row, encoders):
+            if value is None:
+                buffer.write(NULL_FIELD)
+            else:
+                data = encode(value)
+                buffer.write(struct.pack("!i", len(data)))
+                buffer.write(data)
+    buffer.write(COPY_TRAILER)
+    buffer.seek(0)
+    return buffer
+
+
+def upsert_rows(cur, table, columns, kinds, key_columns, rows):
+    """
+    COPYs rows into a staging table with the same column types as `table`,
+    then merges them with INSERT ... ON CONFLICT (key_columns) DO UPDATE.
+    The staging table is reused for later batches in the same transaction
+    and dropped on commit. Rows must be unique on key_columns.
+    Returns the number of rows merged.
+    """
+    staging = f"staging_{table}"
+    columns_str = ", ".join(columns)
+    cur.execute(f"CREATE TEMP TABLE IF NOT EXISTS {staging} ON COMMIT DROP AS "
+                f"SELECT {columns_str} FROM {table} WITH NO DATA;")
+    cur.execute(f"TRUNCATE {staging};")
+    cur.copy_expert(f"COPY {staging} ({columns_str}) FROM STDIN WITH (FORMAT binary);",
+                    binary_copy_buffer(rows, kinds))
+    updates = ", ".join(f"{col} = EXCLUDED.{col}" for col in columns if col not in key_columns)
+    cur.execute(f"INSERT INTO {table} ({columns_str}) SELECT {columns_str} FROM {staging} "
+                f"ON CONFLICT ({', '.join(key_columns)}) DO UPDATE SET {updates};")
+    return cur.rowcount
+
+
+def copy_out_vectors(cur, select_sql, dims):
+    """
+    Runs `select_sql`, which must return (bigint id, vector(dims)) rows with
+    no NULLs, as a binary COPY and decodes it in one pass with NumPy.
+    Returns (ids int64 array, vectors float32 array of shape (n, dims)).
+    """
+    buffer = io.BytesIO()
+    cur.copy_expert(f"COPY ({select_sql}) TO STDOUT WITH (FORMAT binary);", buffer)
+    data = buffer.getbuffer()
+    # Header: signature, flags, then a length-prefixed extension area.
+    extension_length, = struct.unpack_from("!i", data, len(COPY_HEADER) - 4)
+    start = len(COPY_HEADER) + extension_length
+    end = len(data) - len(COPY_TRAILER)
+    # Every row has the same size, so the body is one structured array.
+    row = np.dtype([("fields", ">i2"), ("id_length", ">i4"), ("id", ">i8"),
+                    ("vector_length", ">i4"), ("dims", ">i2"), ("unused", ">i2"),
+                    ("vector", ">f4", (dims,))])
+    rows = np.frombuffer(data[start:end], dtype=row)
+    if ((rows["id_length"] != 8) | (rows["dims"] != dims)).any():
+        raise ValueError(f"expected (bigint, vector({dims})) rows")
+    return rows["id"].astype(np.int64), rows["vector"].astype(np.float32)
@@ -0,0 +1,85 @@
+"""
+Small in-process caches shared by the request handlers.
+Each gunicorn worker has its own copy, so they only hold data that is cheap to
+recompute and safe to serve slightly stale (bounded by the TTL).
+"""
+import threading
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+
+def normalize_query(text: str) -> str:
+    """
+    Cache key for a free-text search: lower case with whitespace collapsed,
+    so "Chocolate  Cake" and "chocolate cake" share an entry.
+    """
+    return " ".join(text.lower().split())
+
+
+class LRUCache:
+    """
+    Thread-safe LRU cache with an entry limit and an optional time-to-live.
+    `get()` returns MISSING on a miss so that None can be cached.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return MISSING
+            expires_at, value = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return MISSING
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,344 @@
+"""
+Shared PostgreSQL connection pool used by both app.py and embeddings.py.
+
+Connections are handed out through the `connection()` and `cursor()` context
+managers, which return them to the pool afterwards instead of closing them.
+The pool is created lazily, once per process, so every gunicorn worker gets
+its own pool after the fork.
+
+The async server (asgi.py) uses a psycopg 3 AsyncConnectionPool with the same
+settings, opened with `open_async_pool()` and used through `async_cursor()`.
+
+Pool behaviour can be tuned with these environment variables (.env works too):
+    DB_POOL_MIN            connections opened up front per worker (default 1);
+                           connections opened later are kept for reuse too
+    DB_POOL_MAX            max connections per worker (default 10)
+    DB_MAX_CONNECTIONS     total budget shared by all workers; when set together
+                           with WEB_CONCURRENCY it replaces DB_POOL_MAX
+    DB_POOL_TIMEOUT        seconds to wait for a free connection (default 30)
+    DB_POOL_RECYCLE        seconds before a connection is replaced (default 1800)
+    DB_POOL_CHECK_IDLE     connections idle longer than this are pinged with
+                           `SELECT 1` before being handed out (default 30)
+"""
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager, asynccontextmanager
+
+import psycopg2
+import psycopg2.extras
+import psycopg2.pool
+
+DEFAULT_DB_PORT = 5432
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+_slots = None
+_conn_info = {}  # id(conn) -> {"created": float, "last_used": float}
+_async_pool = None
+_stats_lock = threading.Lock()
+_stats = {
+    "checkouts": 0,
+    "waits": 0,
+    "timeouts": 0,
+    "created": 0,
+    "recycled": 0,
+    "broken": 0,
+    "in_use": 0,
+}
+
+
+def _env_int(name, default):
+    value = os.getenv(name)
+    return int(value) if value not in (None, "") else default
+
+
+def _pool_size():
+    """
+    Returns (minconn, maxconn) for this worker.
+    If a total connection budget is given, it is split evenly across the
+    gunicorn workers so all of them together never exceed max_connections.
+    """
+    maxconn = _env_int("DB_POOL_MAX", 10)
+    total = _env_int("DB_MAX_CONNECTIONS", 0)
+    workers = _env_int("WEB_CONCURRENCY", 0)
+    if total and workers:
+        maxconn = max(1, total // workers)
+    minconn = min(_env_int("DB_POOL_MIN", 1), maxconn)
+    return minconn, maxconn
+
+
+def connect_params():
+    """
+    Connection settings read from the environment, shared with the async pool.
+    """
+    return dict(
+        host=os.getenv("HOST"),
+        database=os.getenv("DATABASE"),
+        port=os.getenv("PORT", DEFAULT_DB_PORT),
+        user=os.getenv("USER"),
+        password=os.getenv("PASSWORD")
+    )
+
+
+def get_pool():
+    """
+    Returns the pool for the current process, creating it on first use.
+    A pool inherited from a parent process (e.g. gunicorn --preload) is
+    dropped, since its sockets are shared with the parent.
+    """
+    global _pool, _pool_pid, _slots
+    if _pool is not None and _pool_pid == os.getpid():
+        return _pool
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            minconn, maxconn = _pool_size()
+            _conn_info.clear()
+            _pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, **connect_params())
+            # putconn() closes any connection returned while `minconn` are
+            # already idle; keep every one instead, so concurrent requests
+            # reuse connections rather than paying connect and auth again.
+            _pool.minconn = maxconn
+            _pool_pid = os.getpid()
+            _slots = threading.BoundedSemaphore(maxconn)
+            with _stats_lock:
+                _stats["in_use"] = 0
+    return _pool
+
+
+def _count(name, amount=1):
+    with _stats_lock:
+        _stats[name] += amount
+
+
+def _is_healthy(conn, info):
+    """
+    Checks a pooled connection before it is handed out.
+    """
+    if conn.closed:
+        return False
+    if time.monotonic() - info["last_used"] < _env_int("DB_POOL_CHECK_IDLE", 30):
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1;")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def _checkout(pool):
+    now = time.monotonic()
+    recycle = _env_int("DB_POOL_RECYCLE", 1800)
+    while True:
+        conn = pool.getconn()
+        info = _conn_info.get(id(conn))
+        if info is None:
+            # First time this connection is handed out.
+            _conn_info[id(conn)] = {"created": now, "last_used": now}
+            _count("created")
+            return conn
+        if now - info["created"] > recycle:
+            _count("recycled")
+        elif _is_healthy(conn, info):
+            return conn
+        else:
+            _count("broken")
+        _conn_info.pop(id(conn), None)
+        pool.putconn(conn, close=True)
+
+
+def _release(pool, conn):
+    info = _conn_info.get(id(conn))
+    if info is not None:
+        info["last_used"] = time.monotonic()
+    if conn.closed:
+        pool.putconn(conn, close=True)
+    else:
+        pool.putconn(conn)
+    if conn.closed:
+        # Closed by us or by the pool: forget it, so /metrics stays accurate
+        # and a new connection that reuses its id() starts fresh.
+        _conn_info.pop(id(conn), None)
+
+
+@contextmanager
+def connection():
+    """
+    Borrows a connection from the pool.
+    Commits when the block finishes normally and rolls back if it raises,
+    the same as using a psycopg2 connection as a context manager.
+    Blocks up to DB_POOL_TIMEOUT seconds if every connection is in use.
+    """
+    pool = get_pool()
+    slots = _slots
+    if not slots.acquire(blocking=False):
+        _count("waits")
+        if not slots.acquire(timeout=_env_int("DB_POOL_TIMEOUT", 30)):
+            _count("timeouts")
+            raise psycopg2.pool.PoolError("timed out waiting for a database connection")
+    try:
+        conn = _checkout(pool)
+    except Exception:
+        slots.release()
+        raise
+    _count("checkouts")
+    _count("in_use")
+    try:
+        yield conn
+        if not conn.closed:
+            conn.commit()
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        _count("in_use", -1)
+        _release(pool, conn)
+        slots.release()
+
+
+@contextmanager
+def cursor(cursor_factory=psycopg2.extras.DictCursor):
+    """
+    Shortcut for the common case of a single cursor on a pooled connection.
+    """
+    with connection() as conn:
+        cur = conn.cursor(cursor_factory=cursor_factory)
+        try:
+            yield cur
+        finally:
+            cur.close()
+
+
+class _ChunkWriter:
+    """
+    File-like target for copy_expert() that hands each chunk to a bounded
+    queue, so a slow reader slows the COPY down instead of buffering it.
+    """
+
+    def __init__(self, chunks, stop):
+        self.chunks = chunks
+        self.stop = stop
+
+    def write(self, data):
+        while True:
+            if self.stop.is_set():
+                raise IOError("COPY reader went away")
+            try:
+                self.chunks.put(data, timeout=1)
+                return len(data)
+            except queue.Full:
+                pass
+
+
+def copy_out_stream(sql, max_chunks=16):
+    """
+    Runs a `COPY ... TO STDOUT` statement on a pooled connection and yields its
+    output chunk by chunk as Postgres produces it, without holding the whole
+    result in memory. Meant to be returned as a streaming Flask response.
+    """
+    chunks = queue.Queue(maxsize=max_chunks)
+    stop = threading.Event()
+    done = object()
+
+    def run():
+        try:
+            with connection() as conn:
+                with conn.cursor() as cur:
+                    cur.copy_expert(sql, _ChunkWriter(chunks, stop))
+            item = done
+        except Exception as e:
+            item = e
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    threading.Thread(target=run, name="copy-out", daemon=True).start()
+    try:
+        while True:
+            item = chunks.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+def pool_stats():
+    """
+    Snapshot of the pool counters for this worker, served by /metrics.
+    """
+    minconn, maxconn = _pool_size()
+    with _stats_lock:
+        stats = dict(_stats)
+    stats.update(pid=os.getpid(), min_size=minconn, max_size=maxconn, open=len(_conn_info))
+    return stats
+
+
+def close_pool():
+    """
+    Closes every connection in this process's pool.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.closeall()
+        _pool = None
+        _conn_info.clear()
+
+
+async def open_async_pool():
+    """
+    Opens the async pool for this process. psycopg 3 is only needed for the
+    async server, so it is imported here rather than at module level.
+    """
+    global _async_pool
+    from psycopg_pool import AsyncConnectionPool
+
+    minconn, maxconn = _pool_size()
+    params = connect_params()
+    params["dbname"] = params.pop("database")
+    _async_pool = AsyncConnectionPool(
+        kwargs=params,
+        min_size=minconn,
+        max_size=maxconn,
+        timeout=_env_int("DB_POOL_TIMEOUT", 30),
+        max_lifetime=_env_int("DB_POOL_RECYCLE", 1800),
+        check=AsyncConnectionPool.check_connection,
+        open=False,
+    )
+    await _async_pool.open()
+    return _async_pool
+
+
+async def close_async_pool():
+    global _async_pool
+    if _async_pool is not None:
+        await _async_pool.close()
+        _async_pool = None
+
+
+@asynccontextmanager
+async def async_cursor():
+    """
+    Async counterpart of `cursor()`: commits on success, rolls back on error.
+    Rows are dicts, so templates can use them like DictCursor rows.
+    """
+    from psycopg.rows import dict_row
+
+    async with _async_pool.connection() as conn:
+        async with conn.cursor(row_factory=dict_row) as cur:
+            yield cur
+
+
+def async_pool_stats():
+    return _async_pool.get_stats() if _async_pool is not None else {}
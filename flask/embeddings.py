@@ -6,32 +6,113 @@ import psycopg2.extras
 from transformers import CLIPProcessor, CLIPModel
 from PIL import Image
 import os
+import io
 import hashlib
+import select
+import threading
+import time
+import argparse
+import numpy as np
 import requests
 from sentence_transformers import SentenceTransformer
+from transformers import AutoTokenizer
 from dotenv import load_dotenv
+import bulkload
+import db
+from fetcher import Fetcher
+from image_cache import ImageCache, IMAGE_CACHE_MAX_MB, IMAGE_CACHE_MAX_AGE, IMAGE_CACHE_PIXELS
 
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 CACHE_DIR = "static/image_cache"
+CLIP_MODEL_NAME = "openai/clip-vit-base-patch32"
+TEXT_MODEL_NAME = "all-mpnet-base-v2"
+TEXT_MAX_LENGTH = 384
+# "torch" runs the PyTorch models; "onnx" runs them exported to ONNX under
+# ONNX Runtime, and "onnx-int8" additionally quantizes their weights to int8.
+BACKENDS = ("torch", "onnx", "onnx-int8")
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+if EMBEDDING_BACKEND not in BACKENDS:
+    raise ValueError(f"EMBEDDING_BACKEND must be one of {', '.join(BACKENDS)}, not {EMBEDDING_BACKEND!r}")
+ONNX_DIR = os.getenv("ONNX_DIR", "onnx_models")
+ONNX_THREADS = int(os.getenv("ONNX_THREADS", 0))
+_BACKEND_SUFFIX = "" if EMBEDDING_BACKEND == "torch" else f"+{EMBEDDING_BACKEND}"
+CLIP_MODEL_VERSION = os.getenv("CLIP_MODEL_VERSION", CLIP_MODEL_NAME + _BACKEND_SUFFIX)
+TEXT_MODEL_VERSION = os.getenv("TEXT_MODEL_VERSION", TEXT_MODEL_NAME + _BACKEND_SUFFIX)
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", 64))
+REFRESH_BATCH_SIZE = 32
+REFRESH_POLL_SECONDS = 60
+REFRESH_DEBOUNCE_SECONDS = 2
+REFRESH_RECONNECT_SECONDS = 5
+REFRESH_MAX_ATTEMPTS = int(os.getenv("REFRESH_MAX_ATTEMPTS", 5))
 os.makedirs(CACHE_DIR, exist_ok=True)
 
-def query_image_urls(conn: psycopg2.extensions.connection):
-    """
-    Queries for all image urls in recipe and step tables in locally running 
-    PostgreSQL database.
-    Returns tuple[list, list]
-    """
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    cur.execute("SELECT id, mainImage FROM recipe")
-    recipes = cur.fetchall()
-    recipes = [[id, img_url, get_image_from_url(img_url, verbose=True)]
-                for id, img_url in recipes if img_url != "None"]
-    cur.execute("SELECT recipeId, imageLocation FROM step")
-    steps = cur.fetchall()
-    steps = [[id, img_url, get_image_from_url(img_url, verbose=True)]
-              for id, img_url in steps if img_url is not None]
-    cur.close()
-    return (recipes, steps)
+_image_cache = None
+_image_cache_lock = threading.Lock()
+
+def get_image_cache() -> ImageCache:
+    """
+    Returns the process's ImageCache over CACHE_DIR, opening it on first use.
+    """
+    global _image_cache
+    with _image_cache_lock:
+        if _image_cache is None:
+            _image_cache = ImageCache(CACHE_DIR, IMAGE_CACHE_MAX_MB * 1024 * 1024,
+                                      pixels_key=CLIP_MODEL_NAME if IMAGE_CACHE_PIXELS else None)
+    return _image_cache
+
+def cache_image(url: str, verbose=False, fetcher: Fetcher = None) -> str:
+    """
+    Makes sure the image at url is in the image cache as a 256x256 JPEG and
+    returns that JPEG's sha256. Cached urls skip the network unless older
+    than IMAGE_CACHE_MAX_AGE seconds, when they are revalidated with a
+    conditional request. Cache misses are downloaded through `fetcher`
+    (with its retries) if given.
+    """
+    cache = get_image_cache()
+    entry = cache.lookup(url)
+    if entry is None:
+        # Adopt images cached under the old MD5-of-URL file names.
+        legacy_path = os.path.join(CACHE_DIR, f"{hashlib.md5(url.encode('utf-8')).hexdigest()}.jpg")
+        if os.path.exists(legacy_path):
+            with open(legacy_path, "rb") as f:
+                sha256 = cache.put(url, f.read())
+            os.remove(legacy_path)
+            return sha256
+    elif not IMAGE_CACHE_MAX_AGE or time.time() - entry.fetched_at < IMAGE_CACHE_MAX_AGE:
+        if verbose:
+            print(f"Loading cached image for URL: {url[:75]}...")
+        return entry.sha256
+
+    headers = {}
+    if entry is not None and entry.etag:
+        headers["If-None-Match"] = entry.etag
+    if entry is not None and entry.last_modified:
+        headers["If-Modified-Since"] = entry.last_modified
+    if verbose:
+        print(f"Downloading img from url: {url[:75]}...")
+    if fetcher is not None:
+        response = fetcher.request(url, headers)
+    else:
+        response = requests.get(url, headers=headers, timeout=30)
+        response.raise_for_status()
+    if response.status_code == 304 and entry is not None:
+        cache.touch(url)
+        return entry.sha256
+    img = Image.open(io.BytesIO(response.content)).convert("RGB")
+    img = img.resize(size=[256, 256])
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG")
+    return cache.put(url, buffer.getvalue(), response.headers.get("ETag"), response.headers.get("Last-Modified"))
+
+def fetch_image_bytes(url: str, verbose=False, fetcher: Fetcher = None) -> bytes:
+    """
+    Returns the image at url as a 256x256 JPEG, from the image cache when possible.
+    """
+    data = get_image_cache().read(cache_image(url, verbose, fetcher))
+    if data is None:
+        # The cached file vanished; the cache has forgotten it, so fetch again.
+        data = get_image_cache().read(cache_image(url, verbose, fetcher))
+    return data
 
 def get_image_from_url(url: str, verbose=False) -> Image.Image:
     """
@@ -40,21 +121,19 @@ def get_image_from_url(url: str, verbose=False) -> Image.Image:
     All images are resized to 256x256, so this means all images queried in a similarity search
     should also be resized to 256x256.
     """
-    url_hash = hashlib.md5(url.encode("utf-8")).hexdigest()
-    cache_path = os.path.join(CACHE_DIR, f"{url_hash}.jpg")
+    return decode_image(fetch_image_bytes(url, verbose))
 
-    if os.path.exists(cache_path):
-        if verbose:
-            print(f"Loading cached image for URL: {url[:75]}...")
-        return Image.open(cache_path).convert("RGB").resize(size=[256, 256])
-    else:
-        if verbose:
-            print(f"Downloading img from url: {url[:75]}...")
-        img = Image.open(requests.get(url, stream=True, timeout=30).raw).convert("RGB")
-        img = img.resize(size=[256, 256])
-        img.save(cache_path, format="JPEG")
-        return img
 
+def decode_image(data: bytes, size=(256, 256)) -> Image.Image:
+    """
+    Decodes an image held in memory and resizes it like the cached catalog
+    images. For JPEGs, draft mode lets the decoder scale down by up to 8x while
+    decoding, which is much cheaper than decoding a large photo at full size.
+    Raises PIL.UnidentifiedImageError if the bytes are not an image.
+    """
+    img = Image.open(io.BytesIO(data))
+    img.draft("RGB", size)
+    return img.convert("RGB").resize(size=list(size))
 
 def init_CLIP():
     """
@@ -62,144 +141,607 @@ def init_CLIP():
     Returns tuple[CLIPModel, CLIPProcessor]
     """
     print("Initializing CLIP model - this may take a while")
-    model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
-    processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
+    model = CLIPModel.from_pretrained(CLIP_MODEL_NAME)
+    processor = CLIPProcessor.from_pretrained(CLIP_MODEL_NAME)
     return (model, processor)
 
-def create_embedding(img_list: list[Image.Image], model: CLIPModel, processor: CLIPProcessor):
+def init_text_model():
+    """
+    Initializes the SentenceTransformer used for recipe text embeddings.
+    Returns SentenceTransformer
+    """
+    print(f"Initializing {TEXT_MODEL_NAME} model - this may take a while")
+    return SentenceTransformer(TEXT_MODEL_NAME, device=DEVICE)
+
+class ClipImageEncoder(torch.nn.Module):
+    """
+    CLIP image tower plus L2 normalisation, as exported to ONNX.
+    """
+    def __init__(self, model: CLIPModel):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        features = self.model.get_image_features(pixel_values=pixel_values)
+        return features / features.norm(p=2, dim=-1, keepdim=True)
+
+class MeanPooledTextEncoder(torch.nn.Module):
+    """
+    The mpnet transformer with the mean pooling and normalisation that
+    SentenceTransformer applies for all-mpnet-base-v2, as exported to ONNX.
+    """
+    def __init__(self, transformer):
+        super().__init__()
+        self.transformer = transformer
+
+    def forward(self, input_ids, attention_mask):
+        hidden = self.transformer(input_ids=input_ids, attention_mask=attention_mask)[0]
+        mask = attention_mask.unsqueeze(-1).to(hidden.dtype)
+        pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+        return pooled / pooled.norm(p=2, dim=-1, keepdim=True)
+
+def export_onnx(name: str, quantize=False) -> str:
+    """
+    Exports the "clip" image encoder or "text" encoder to ONNX_DIR (once),
+    and with quantize=True also writes a copy with int8 weights
+    (dynamic quantization). Returns the path of the requested model.
+    """
+    os.makedirs(ONNX_DIR, exist_ok=True)
+    path = os.path.join(ONNX_DIR, f"{name}.onnx")
+    if not os.path.exists(path):
+        print(f"Exporting {name} model to ONNX - this may take a while")
+        tmp_path = f"{path}.tmp"
+        if name == "clip":
+            encoder = ClipImageEncoder(CLIPModel.from_pretrained(CLIP_MODEL_NAME)).eval()
+            torch.onnx.export(encoder, (torch.zeros(1, 3, 224, 224),), tmp_path,
+                              input_names=["pixel_values"], output_names=["embedding"],
+                              dynamic_axes={"pixel_values": {0: "batch"}, "embedding": {0: "batch"}},
+                              opset_version=17)
+        else:
+            text_model = SentenceTransformer(TEXT_MODEL_NAME, device="cpu")
+            encoder = MeanPooledTextEncoder(text_model[0].auto_model).eval()
+            sample = text_model.tokenizer(["warm up"], return_tensors="pt")
+            torch.onnx.export(encoder, (sample["input_ids"], sample["attention_mask"]), tmp_path,
+                              input_names=["input_ids", "attention_mask"], output_names=["embedding"],
+                              dynamic_axes={"input_ids": {0: "batch", 1: "sequence"},
+                                            "attention_mask": {0: "batch", 1: "sequence"},
+                                            "embedding": {0: "batch"}},
+                              opset_version=17)
+        os.replace(tmp_path, path)
+    if not quantize:
+        return path
+    int8_path = os.path.join(ONNX_DIR, f"{name}-int8.onnx")
+    if not os.path.exists(int8_path):
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        print(f"Quantizing {name} model to int8")
+        quantize_dynamic(path, f"{int8_path}.tmp", weight_type=QuantType.QInt8)
+        os.replace(f"{int8_path}.tmp", int8_path)
+    return int8_path
+
+def init_onnx_session(name: str, quantize=False):
+    """
+    Opens an ONNX Runtime CPU session for the exported "clip" or "text"
+    encoder, exporting it first if needed.
+    Returns onnxruntime.InferenceSession
+    """
+    import onnxruntime
+    options = onnxruntime.SessionOptions()
+    if ONNX_THREADS:
+        options.intra_op_num_threads = ONNX_THREADS
+    return onnxruntime.InferenceSession(export_onnx(name, quantize), options, providers=["CPUExecutionProvider"])
+
+# Model registry: every model is loaded at most once per process (i.e. once per
+# gunicorn worker) and shared by the request handlers and the offline pipeline.
+# ONNX sessions are registered as "<model>:<backend>".
+_MODEL_LOADERS = {
+    "clip": init_CLIP,
+    "text": init_text_model,
+    "clip_processor": lambda: CLIPProcessor.from_pretrained(CLIP_MODEL_NAME),
+    "text_tokenizer": lambda: AutoTokenizer.from_pretrained(f"sentence-transformers/{TEXT_MODEL_NAME}"),
+    "clip:onnx": lambda: init_onnx_session("clip"),
+    "clip:onnx-int8": lambda: init_onnx_session("clip", quantize=True),
+    "text:onnx": lambda: init_onnx_session("text"),
+    "text:onnx-int8": lambda: init_onnx_session("text", quantize=True),
+}
+_models = {}
+_models_lock = threading.Lock()
+
+def get_model(name: str):
+    """
+    Returns the model registered under `name`, loading it on first use.
+    """
+    model = _models.get(name)
+    if model is None:
+        with _models_lock:
+            model = _models.get(name)
+            if model is None:
+                model = _MODEL_LOADERS[name]()
+                _models[name] = model
+    return model
+
+def get_clip():
+    """
+    Returns tuple[CLIPModel, CLIPProcessor] from the model registry.
+    """
+    return get_model("clip")
+
+def get_clip_processor() -> CLIPProcessor:
+    """
+    Returns the CLIPProcessor, without loading the PyTorch model unless the
+    torch backend needs it anyway.
+    """
+    if EMBEDDING_BACKEND == "torch":
+        return get_clip()[1]
+    return get_model("clip_processor")
+
+def get_text_model():
+    """
+    Returns the shared SentenceTransformer from the model registry.
+    """
+    return get_model("text")
+
+def warm_up(names=("clip", "text")):
+    """
+    Loads the given models and runs one tiny forward pass through each, so the
+    first real request does not pay for lazy initialisation.
+    """
+    if "clip" in names:
+        create_embedding([Image.new("RGB", (256, 256))])
+    if "text" in names:
+        create_text_embedding(["warm up"])
+
+def create_embedding(img_list: list[Image.Image], model: CLIPModel = None, processor: CLIPProcessor = None):
     """
     Given list of Pillow Images, produces list of 512 length embeddings/vectors.
-    Uses CLIPModel and ClipProcessor to produce embeddings.
-    Returns torch Tensor
+    Uses CLIPModel and ClipProcessor to produce embeddings, taken from the
+    model registry (on EMBEDDING_BACKEND) unless given explicitly.
+    Returns numpy array
     """
+    if processor is None:
+        processor = get_clip_processor()
     inputs = processor(images=img_list, return_tensors="pt", padding=True)
-    inputs = {k: v.to(DEVICE) for k, v in inputs.items()}
+    return embed_pixels(inputs["pixel_values"], model)
+
+def preprocess_image(img: Image.Image, processor: CLIPProcessor = None) -> torch.Tensor:
+    """
+    Runs the CLIP processor (resize, crop, normalize) on one image, so it can
+    be done on a worker thread ahead of `embed_pixels()`.
+    Returns tensor of shape (3, 224, 224)
+    """
+    if processor is None:
+        processor = get_clip_processor()
+    return processor(images=[img], return_tensors="pt")["pixel_values"][0]
+
+def embed_pixels(pixel_values: torch.Tensor, model: CLIPModel = None, backend: str = None):
+    """
+    Given a batch of preprocessed CLIP inputs, produces 512 length embeddings/vectors.
+    Runs `model` if given, otherwise the registry's model for `backend`
+    (default EMBEDDING_BACKEND).
+    Returns numpy array
+    """
+    backend = backend or EMBEDDING_BACKEND
+    if model is None and backend != "torch":
+        session = get_model(f"clip:{backend}")
+        return session.run(["embedding"], {"pixel_values": pixel_values.cpu().numpy().astype(np.float32)})[0]
+    if model is None:
+        model, _ = get_clip()
     with torch.no_grad():
-        image_features = model.get_image_features(**inputs)
+        image_features = model.get_image_features(pixel_values=pixel_values.to(DEVICE))
     image_features = image_features / image_features.norm(p=2, dim=-1, keepdim=True)
     return image_features.cpu().numpy()
 
-def get_db_connection(default_port=5432):
+def populate_image_table(rows, conn: psycopg2.extensions.connection):
+    """
+    Upserts generated image embeddings into Image table.
+    rows holds tuples (recipeId, imageLocation, embedding, contentHash).
+    Connects to PostgreSQL DB with pyscopg2 connection.
+    """
+    cur = conn.cursor()
+    skip_embedding_queue(cur)
+    bulkload.upsert_rows(cur, "image",
+                         ["recipeId", "imageLocation", "embedding", "contentHash", "modelVersion"],
+                         ["bigint", "text", "vector", "text", "text"],
+                         ["recipeId", "imageLocation"],
+                         [(recipeId, imageLocation, embedding, contentHash, CLIP_MODEL_VERSION)
+                          for recipeId, imageLocation, embedding, contentHash in rows])
+    cur.close()
+
+
+# The text embedded for each recipe is its description.
+RECIPE_TEXT_SQL = """
+    SELECT r.id, r.description AS text
+      FROM recipe r
+     {recipe_filter}
+     ORDER BY r.id;
+"""
+TEXT_FETCH_SIZE = 500
+
+def query_recipe_descriptions(conn: psycopg2.extensions.connection, recipe_ids=None, itersize=TEXT_FETCH_SIZE):
     """
-    Connects to local Postgres DB, provided that you have set a .env file.
-    Should we have this reused in two different places (app.py, embeddings.py)??
+    Streams the text to embed for every recipe, or only those of `recipe_ids`,
+    in one query read through a server-side cursor `itersize` rows at a time.
+    The cursor is WITH HOLD so callers can commit while iterating.
+    Yields tuples (id, text)
     """
-    conn = psycopg2.connect(
-        host=os.getenv("HOST"),
-        database=os.getenv("DATABASE"),
-        port=os.getenv("PORT", default_port),
-        user=os.getenv("USER"),
-        password=os.getenv("PASSWORD")
-    )
-    return conn
+    if recipe_ids is None:
+        sql = RECIPE_TEXT_SQL.format(recipe_filter="")
+        params = {}
+    else:
+        sql = RECIPE_TEXT_SQL.format(recipe_filter="WHERE r.id = ANY(%(ids)s)")
+        params = {"ids": list(recipe_ids)}
+    cur = conn.cursor(name="recipe_descriptions", withhold=True)
+    cur.itersize = itersize
+    try:
+        cur.execute(sql, params)
+        for recipe_id, text in cur:
+            yield recipe_id, text
+    finally:
+        cur.close()
 
-def replace_img_with_embedding(sql_list, embeddings):
-    for sql_row, embedding in zip(sql_list, embeddings):
-        emb_list = embedding.tolist()
-        sql_row[2] = emb_list
-    
-def populate_image_table(recipes, steps, conn: psycopg2.extensions.connection):
+def create_text_embedding(descriptions: list[str], backend: str = None):
     """
-    Inserts generated image embeddings from Recipe and Step tables into Image table.
-    Connects to PostgreSQL DB with pyscopg2 connection.
+    Given list of strings, produces list of 768 length embeddings/vectors.
+    Uses the shared `SentenceTransformer` from the model registry, or its
+    ONNX export when `backend` (default EMBEDDING_BACKEND) is not "torch".
+    """
+    backend = backend or EMBEDDING_BACKEND
+    if backend != "torch":
+        session = get_model(f"text:{backend}")
+        tokens = get_model("text_tokenizer")(descriptions, padding=True, truncation=True,
+                                             max_length=TEXT_MAX_LENGTH, return_tensors="np")
+        return list(session.run(["embedding"], {"input_ids": tokens["input_ids"].astype(np.int64),
+                                                "attention_mask": tokens["attention_mask"].astype(np.int64)})[0])
+    text_model = get_text_model()
+    return list(text_model.encode(descriptions, normalize_embeddings=True))
+
+def populate_text_embeddings(rows, conn: psycopg2.extensions.connection):
+    """
+    Upserts generated text embeddings into recipe_embeddings.
+    rows holds tuples (recipeId, embedding, contentHash).
+    Connects to PostgreSQL DB with psycopg2 connection.
+    """
+    cur = conn.cursor()
+    bulkload.upsert_rows(cur, "recipe_embeddings",
+                         ["recipeId", "description_embedding", "contentHash", "modelVersion"],
+                         ["bigint", "vector", "text", "text"],
+                         ["recipeId"],
+                         [(recipeId, embedding, contentHash, TEXT_MODEL_VERSION)
+                          for recipeId, embedding, contentHash in rows])
+    cur.close()
+
+def content_hash(data) -> str:
+    """
+    Hash of the exact input an embedding was made from (text or image bytes).
+    """
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+def sync_text_embeddings(conn: psycopg2.extensions.connection, recipe_ids=None,
+                         batch_size=EMBED_BATCH_SIZE, checkpoint=True):
+    """
+    Embeds the text of every recipe (or only `recipe_ids`) whose stored
+    embedding was made from different text or by a different model.
+    With checkpoint=True each batch is committed as soon as it is written,
+    so an interrupted run resumes where it stopped.
+    Returns the number of recipes embedded.
     """
-    print("Populating image table with embeddings!")
     cur = conn.cursor()
-    recipes.extend(steps)
-    for recipe in recipes:
-        recipeId = recipe[0]
-        imageLocation = recipe[1]
-        imageEmbedding = recipe[2]
-        cur.execute("INSERT INTO image (recipeId, imageLocation, embedding) VALUES (%s, %s, %s);",
-                    (recipeId, imageLocation, imageEmbedding)
-        )
-    conn.commit()
+    if recipe_ids is None:
+        cur.execute("SELECT recipeId, contentHash, modelVersion FROM recipe_embeddings;")
+    else:
+        cur.execute("SELECT recipeId, contentHash, modelVersion FROM recipe_embeddings WHERE recipeId = ANY(%s);",
+                    (list(recipe_ids),))
+    stored = {row[0]: (row[1], row[2]) for row in cur.fetchall()}
     cur.close()
 
+    embedded = unchanged = 0
+    pending = []
+
+    def flush():
+        embeddings = create_text_embedding([text for _, text, _ in pending])
+        populate_text_embeddings([(recipe_id, embedding, text_hash)
+                                  for (recipe_id, _, text_hash), embedding in zip(pending, embeddings)], conn)
+        if checkpoint:
+            conn.commit()
 
-def query_recipe_descriptions(conn: psycopg2.extensions.connection):
+    # Texts are hashed as they stream in and handed to the encoder one batch
+    # at a time, so only batch_size texts are held in memory at once.
+    for recipe_id, text in query_recipe_descriptions(conn, recipe_ids):
+        text_hash = content_hash(text)
+        if stored.get(recipe_id) == (text_hash, TEXT_MODEL_VERSION):
+            unchanged += 1
+            continue
+        pending.append((recipe_id, text, text_hash))
+        if len(pending) >= batch_size:
+            flush()
+            embedded += len(pending)
+            pending = []
+    if pending:
+        flush()
+        embedded += len(pending)
+    print(f"Text embeddings: {embedded} embedded, {unchanged} unchanged")
+    return embedded
+
+def sync_image_embeddings(conn: psycopg2.extensions.connection, recipe_ids=None,
+                          batch_size=EMBED_BATCH_SIZE, checkpoint=True):
     """
-    Queries for all recipe descriptions in locally running PostgreSQL database.
-    Returns list of tuples (id, description)
+    Embeds every recipe and step image (or only those of `recipe_ids`) whose
+    stored embedding was made from different image bytes or by a different
+    model, and removes image rows whose url is no longer used.
+    Images that fail to download are skipped and retried on the next run.
+    With checkpoint=True each batch is committed as soon as it is written.
+    Returns the number of images embedded.
     """
-    # Add recipe.name, recipe.description, step.description, ingredient.name into on string, then embed that
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    cur.execute("SELECT id, description, name FROM recipe")
-    recipes = cur.fetchall()
-    for (i, (id, desc, name)) in enumerate(recipes):
-        cur.execute(f"SELECT s.description from step s WHERE s.recipeid = {id}")
-        descriptions = cur.fetchall()
-        cur.execute(f"select i.name from recipe_ingredient ri inner join ingredient i on i.id = ri.ingredientid WHERE ri.recipeid = {id}")
-        ingredients = cur.fetchall()
+    cur = conn.cursor()
+    wanted = query_recipe_image_urls(conn, recipe_ids)
+    if recipe_ids is None:
+        cur.execute("SELECT recipeId, imageLocation, contentHash, modelVersion FROM image;")
+    else:
+        cur.execute("SELECT recipeId, imageLocation, contentHash, modelVersion FROM image WHERE recipeId = ANY(%s);",
+                    (list(recipe_ids),))
+    stored = {(row[0], row[1]): (row[2], row[3]) for row in cur.fetchall()}
 
-        recipes[i][2] = desc + " " + name + " " + " ".join([d[0] for d in descriptions]) + " " + " ".join([i[0] for i in ingredients])
+    stale = set(stored) - wanted
+    if stale:
+        skip_embedding_queue(cur)
+        cur.executemany("DELETE FROM image WHERE recipeId = %s AND imageLocation = %s;", list(stale))
+        if checkpoint:
+            conn.commit()
     cur.close()
-    return recipes
 
-def create_text_embedding(descriptions: list[str]):
+    embedded = unchanged = 0
+    pending = []
+    processor = get_clip_processor()
+    fetcher = Fetcher()
+
+    cache = get_image_cache()
+
+    def prepare(item):
+        # Runs on the fetcher's pool: make sure the image is cached, then for
+        # changed images load its CLIP input from the cache, or decode and
+        # preprocess it (and store the result for next time).
+        image_hash = cache_image(item[1], True, fetcher)
+        if stored.get(item) == (image_hash, CLIP_MODEL_VERSION):
+            return image_hash, None
+        pixels = cache.get_pixels(image_hash)
+        if pixels is None:
+            data = fetch_image_bytes(item[1], True, fetcher)
+            image_hash = content_hash(data)
+            pixels = preprocess_image(decode_image(data), processor).numpy()
+            cache.put_pixels(image_hash, pixels)
+        return image_hash, torch.from_numpy(pixels)
+
+    def flush():
+        embeddings = embed_pixels(torch.stack([pixels for _, _, _, pixels in pending]))
+        populate_image_table([(recipe_id, url, embedding, image_hash)
+                              for (recipe_id, url, image_hash, _), embedding in zip(pending, embeddings)], conn)
+        if checkpoint:
+            conn.commit()
+
+    # Worker threads download, decode and preprocess up to two batches ahead
+    # while this thread runs inference and writes the previous batch, so
+    # memory is bounded by the batch size, not by the number of images.
+    try:
+        for (recipe_id, url), prepared, error in fetcher.map(prepare, sorted(wanted), window=2 * batch_size):
+            if error is not None:
+                print(f"Skipping image for recipe {recipe_id} ({url[:75]}): {error}")
+                continue
+            image_hash, pixels = prepared
+            if pixels is None:
+                unchanged += 1
+                continue
+            pending.append((recipe_id, url, image_hash, pixels))
+            if len(pending) >= batch_size:
+                flush()
+                embedded += len(pending)
+                pending = []
+        if pending:
+            flush()
+            embedded += len(pending)
+    finally:
+        fetcher.close()
+    print(f"Image embeddings: {embedded} embedded, {unchanged} unchanged, {len(stale)} removed, "
+          f"{len(fetcher.failures)} failed ({fetcher.stats()['retries']} retries)")
+    for (recipe_id, url), attempts, error in fetcher.failures:
+        print(f"  failed after {attempts} attempt(s): recipe {recipe_id} {url[:75]}: {error}")
+    print(f"Image cache: {cache.stats()}")
+    return embedded
+
+def skip_embedding_queue(cur):
     """
-    Given list of strings, produces list of 768 length embeddings/vectors.
-    Uses `SentenceTransformer` to produce embeddings.
+    Marks the rest of this transaction as embedding pipeline writes, which the
+    embedding_queue triggers ignore (otherwise writing a recipe's image rows
+    would queue it again).
     """
-    text_model = SentenceTransformer('all-mpnet-base-v2')
-    return list(text_model.encode(descriptions, normalize_embeddings=True))
+    cur.execute("SELECT set_config('recipes.skip_embedding_queue', 'on', true);")
 
-def populate_text_embeddings(recipe_info, conn: psycopg2.extensions.connection):
+def query_recipe_image_urls(conn: psycopg2.extensions.connection, recipe_ids=None):
     """
-    Inserts generated text embeddings from Recipe and Step tables into Text table.
-    Connects to PostgreSQL DB with psycopg2 connection.
+    Main and step image urls of all recipes, or only those of `recipe_ids`.
+    Returns set of tuples (recipeId, url)
+    """
+    cur = conn.cursor()
+    if recipe_ids is None:
+        cur.execute("""
+            SELECT id, mainImage FROM recipe WHERE mainImage IS NOT NULL AND mainImage <> 'None'
+            UNION
+            SELECT recipeId, imageLocation FROM step WHERE imageLocation IS NOT NULL;
+        """)
+    else:
+        cur.execute("""
+            SELECT id, mainImage FROM recipe WHERE id = ANY(%s) AND mainImage IS NOT NULL AND mainImage <> 'None'
+            UNION
+            SELECT recipeId, imageLocation FROM step WHERE recipeId = ANY(%s) AND imageLocation IS NOT NULL;
+        """, (list(recipe_ids), list(recipe_ids)))
+    urls = set(cur.fetchall())
+    cur.close()
+    return urls
+
+def refresh_recipes(conn: psycopg2.extensions.connection, recipe_ids):
+    """
+    Brings recipe_embeddings and image up to date for the given recipes
+    within the caller's transaction, and removes the rows of recipes that
+    no longer exist.
     """
-    print("Populating text table with embeddings!")
     cur = conn.cursor()
-    for recipe in recipe_info:
-        recipeId = recipe[0]
-        textEmbedding = recipe[1].astype(float).tolist()
-        cur.execute("INSERT INTO recipe_embeddings (recipeid, description_embedding) VALUES (%s, %s);", (recipeId, textEmbedding))
+    skip_embedding_queue(cur)
+    cur.execute("SELECT id FROM recipe WHERE id = ANY(%s);", (list(recipe_ids),))
+    live_ids = [row[0] for row in cur.fetchall()]
+    gone_ids = list(set(recipe_ids) - set(live_ids))
+    if gone_ids:
+        cur.execute("DELETE FROM recipe_embeddings WHERE recipeId = ANY(%s);", (gone_ids,))
+        cur.execute("DELETE FROM image WHERE recipeId = ANY(%s);", (gone_ids,))
+    cur.close()
+    if not live_ids:
+        return
+
+    sync_text_embeddings(conn, live_ids, checkpoint=False)
+    sync_image_embeddings(conn, live_ids, checkpoint=False)
+
+def finish_queue_entries(conn, claimed):
+    """
+    Refreshes the claimed (recipeId, queuedAt) entries and removes them from
+    the queue, within the caller's transaction.
+    """
+    ids = [recipe_id for recipe_id, _ in claimed]
+    refresh_recipes(conn, ids)
+    cur = conn.cursor()
+    cur.execute("""
+        DELETE FROM embedding_queue q
+         USING unnest(%s::bigint[], %s::timestamptz[]) AS done(recipeId, queuedAt)
+         WHERE q.recipeId = done.recipeId AND q.queuedAt = done.queuedAt;
+    """, (ids, [queued_at for _, queued_at in claimed]))
+
+def process_embedding_queue(batch_size=REFRESH_BATCH_SIZE):
+    """
+    Re-embeds every recipe in embedding_queue, batch_size recipes per
+    transaction. A recipe changed again while its batch was being embedded
+    keeps its (newer) queue entry and is picked up on the next pass.
+    If a batch fails, its recipes are retried one at a time, so one bad
+    recipe cannot hold up the rest. A recipe that fails is skipped until the
+    next pass, and after REFRESH_MAX_ATTEMPTS failures until it is edited
+    again; its entry records the attempts and the last error.
+    Returns the number of recipes refreshed.
+    """
+    total = 0
+    failed = []
+    while True:
+        with db.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT recipeId, queuedAt FROM embedding_queue
+                 WHERE attempts < %s AND NOT recipeId = ANY(%s)
+                 ORDER BY queuedAt LIMIT %s;
+            """, (REFRESH_MAX_ATTEMPTS, failed, batch_size))
+            claimed = cur.fetchall()
+        if not claimed:
+            return total
+        try:
+            with db.connection() as conn:
+                finish_queue_entries(conn, claimed)
+        except Exception as e:
+            print(f"Error: batch of {len(claimed)} recipes failed ({e}); retrying them one at a time")
+            for entry in claimed:
+                try:
+                    with db.connection() as conn:
+                        finish_queue_entries(conn, [entry])
+                except Exception as e:
+                    recipe_id, queued_at = entry
+                    failed.append(recipe_id)
+                    with db.connection() as conn:
+                        cur = conn.cursor()
+                        cur.execute("""
+                            UPDATE embedding_queue SET attempts = attempts + 1, lastError = %s
+                             WHERE recipeId = %s AND queuedAt = %s
+                            RETURNING attempts;
+                        """, (str(e), recipe_id, queued_at))
+                        row = cur.fetchone()
+                    attempts = row[0] if row else 1
+                    print(f"Error: recipe {recipe_id} failed (attempt {attempts}): {e}")
+                    if attempts >= REFRESH_MAX_ATTEMPTS:
+                        print(f"Giving up on recipe {recipe_id} until it is edited again")
+                else:
+                    total += 1
+        else:
+            total += len(claimed)
+            print(f"Refreshed embeddings for {len(claimed)} recipes")
+
+def listen_embedding_queue():
+    """
+    Opens a dedicated autocommit connection LISTENing for queue NOTIFYs.
+    """
+    listener = psycopg2.connect(**db.connect_params())
+    listener.set_session(autocommit=True)
+    listener.cursor().execute("LISTEN embedding_queue;")
+    return listener
+
+def watch_embedding_queue(poll_seconds=REFRESH_POLL_SECONDS):
+    """
+    Background worker: processes the queue whenever the triggers send a
+    NOTIFY, and at least every poll_seconds in case one was missed. If the
+    LISTEN connection drops (e.g. Postgres restarts), it reconnects.
+    """
+    listener = None
+    print("Watching embedding_queue for changed recipes")
+    while True:
+        if listener is None:
+            try:
+                listener = listen_embedding_queue()
+            except psycopg2.OperationalError as e:
+                print(f"Error: cannot LISTEN ({e}); retrying in {REFRESH_RECONNECT_SECONDS} s")
+                time.sleep(REFRESH_RECONNECT_SECONDS)
+                continue
+        try:
+            process_embedding_queue()
+        except Exception as e:
+            print(f"Error: {e}")
+        try:
+            if select.select([listener], [], [], poll_seconds) != ([], [], []):
+                # Let a burst of edits (e.g. a whole recipe form) land first.
+                time.sleep(REFRESH_DEBOUNCE_SECONDS)
+                listener.poll()
+                listener.notifies.clear()
+        except (psycopg2.Error, OSError, ValueError) as e:
+            print(f"Error: lost the LISTEN connection ({e}); reconnecting")
+            if not listener.closed:
+                listener.close()
+            listener = None
 
 
 
 def main():
-    with get_db_connection() as conn:
+    parser = argparse.ArgumentParser(description="Populate recipe text and image embeddings")
+    parser.add_argument("--refresh", action="store_true",
+                        help="Only re-embed recipes queued in embedding_queue, then exit")
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep running, re-embedding recipes as they are queued")
+    parser.add_argument("--batch-size", type=int, default=EMBED_BATCH_SIZE,
+                        help="Rows embedded and committed per batch")
+    args = parser.parse_args()
+    if args.watch:
+        watch_embedding_queue()
+        return
+    if args.refresh:
+        print(f"Refreshed {process_embedding_queue()} recipes")
+        return
+
+    with db.connection() as conn:
 
         try:
-            # text embeddings
-            descriptions = query_recipe_descriptions(conn)
-            ids = [recipe[0] for recipe in descriptions]
-            text_descriptions = [recipe[1] for recipe in descriptions]
-            embeddings = create_text_embedding(text_descriptions)
-            info = [(ids[i], embeddings[i]) for i in range(len(descriptions))]
-            # print(info[0])
-            # print(descriptions)
-            # print(len(info))
-            # return
-            populate_text_embeddings(info, conn)
-
-            model, processor = init_CLIP()
-
-            recipes, steps = query_image_urls(conn)
-            print("Creating embeddings for mainImage urls in Recipe table")
-            print(recipes)
-            recipe_img_embeddings = create_embedding(
-                [recipe[2] for recipe in recipes],
-                model, 
-                processor
-            )
-            print("Creating embeddings for imageLocation urls in Step table")
-            step_img_embeddings = create_embedding(
-                [step[2] for step in steps],
-                model,
-                processor
-            )
-            print("Updating database with embeddings")
-            replace_img_with_embedding(recipes, recipe_img_embeddings)
-            replace_img_with_embedding(steps, step_img_embeddings)
-            populate_image_table(recipes, steps, conn)
+            cur = conn.cursor()
+            cur.execute("SELECT clock_timestamp();")
+            started = cur.fetchone()[0]
+
+            sync_text_embeddings(conn, batch_size=args.batch_size)
+            sync_image_embeddings(conn, batch_size=args.batch_size)
+            # Everything queued before this run (e.g. by the initial data
+            # load) has just been embedded.
+            cur.execute("DELETE FROM embedding_queue WHERE queuedAt <= %s;", (started,))
             print("Done")
-        except psycopg2.errors.UniqueViolation:
-            print(f"Data appears to be pre-populated.")
-            conn.rollback()
         except Exception as e:
             print(f"Error: {e}")
+            print("Batches written so far were kept; run again to resume.")
             conn.rollback()
 
 
@@ -0,0 +1,154 @@
+"""
+Concurrent HTTP downloads for the embedding pipeline.
+Requests run on a thread pool, with a cap on how many may be open to any one
+host at a time, so one slow host cannot take every worker. Timeouts,
+connection errors and 429/5xx responses are retried with exponential backoff;
+anything else fails the URL straight away. Failures are recorded per URL
+instead of aborting the run.
+"""
+import os
+import random
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+
+FETCH_WORKERS = int(os.getenv("FETCH_WORKERS", 16))
+FETCH_PER_HOST = int(os.getenv("FETCH_PER_HOST", 4))
+FETCH_RETRIES = int(os.getenv("FETCH_RETRIES", 3))
+FETCH_BACKOFF = float(os.getenv("FETCH_BACKOFF", 0.5))
+FETCH_TIMEOUT = float(os.getenv("FETCH_TIMEOUT", 30))
+
+RETRY_STATUS = {408, 429, 500, 502, 503, 504}
+
+FetchFailure = namedtuple("FetchFailure", "item attempts error")
+_END = object()
+
+
+class RetryableError(Exception):
+    pass
+
+
+class FetchError(Exception):
+    def __init__(self, url, attempts, error):
+        super().__init__(f"{url} failed after {attempts} attempt(s): {error}")
+        self.url = url
+        self.attempts = attempts
+        self.error = error
+
+
+class Fetcher:
+    """
+    Thread pool of HTTP downloads with per-host limits and retries.
+    `get()`/`request()` download one URL on the calling thread; `map()` runs
+    a function (which may call them) over many items on the pool.
+    """
+
+    def __init__(self, workers=FETCH_WORKERS, per_host=FETCH_PER_HOST, retries=FETCH_RETRIES,
+                 backoff=FETCH_BACKOFF, timeout=FETCH_TIMEOUT):
+        self.workers = max(1, workers)
+        self.per_host = max(1, per_host)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.failures = []
+        self._executor = None
+        self._hosts = {}
+        self._hosts_lock = threading.Lock()
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._stats = {"requests": 0, "retries": 0, "bytes": 0, "failed": 0}
+
+    def _session(self):
+        # requests.Session is not thread-safe, so each worker keeps its own.
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def _host_slot(self, url):
+        host = urlsplit(url).netloc
+        with self._hosts_lock:
+            slot = self._hosts.get(host)
+            if slot is None:
+                slot = self._hosts[host] = threading.BoundedSemaphore(self.per_host)
+        return slot
+
+    def _count(self, name, amount=1):
+        with self._stats_lock:
+            self._stats[name] += amount
+
+    def request(self, url, headers=None) -> requests.Response:
+        """
+        GETs url and returns the response, which may be a 304 for a
+        conditional request. Raises FetchError once the retries are used up,
+        or at once for errors that retrying will not fix (e.g. 404).
+        """
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                with self._host_slot(url):
+                    self._count("requests")
+                    response = self._session().get(url, headers=headers, timeout=self.timeout)
+                    if response.status_code in RETRY_STATUS:
+                        raise RetryableError(f"HTTP {response.status_code}")
+                    response.raise_for_status()
+                    self._count("bytes", len(response.content))
+                return response
+            except (requests.ConnectionError, requests.Timeout, RetryableError) as e:
+                if attempts > self.retries:
+                    raise FetchError(url, attempts, e) from e
+                self._count("retries")
+                # Back off outside the host slot so other URLs can use it.
+                time.sleep(self.backoff * 2 ** (attempts - 1) * random.uniform(1, 1.5))
+            except requests.RequestException as e:
+                raise FetchError(url, attempts, e) from e
+
+    def get(self, url) -> bytes:
+        """
+        Returns the body of url; see `request()`.
+        """
+        return self.request(url).content
+
+    def map(self, fn, items, window=None):
+        """
+        Runs fn(item) for each item on the pool and yields (item, result,
+        error) in the order of items, with at most `window` calls in flight.
+        Exceptions are recorded in `failures` and yielded, not raised.
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="fetch")
+        window = window or self.workers * 2
+        in_flight = deque()
+        items = iter(items)
+        while True:
+            while len(in_flight) < window:
+                item = next(items, _END)
+                if item is _END:
+                    break
+                in_flight.append((item, self._executor.submit(fn, item)))
+            if not in_flight:
+                return
+            item, future = in_flight.popleft()
+            try:
+                result = future.result()
+            except Exception as e:
+                self._count("failed")
+                error = e.error if isinstance(e, FetchError) else e
+                self.failures.append(FetchFailure(item, getattr(e, "attempts", 1), str(error)))
+                yield item, None, e
+            else:
+                yield item, result, None
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def stats(self):
+        with self._stats_lock:
+            return dict(self._stats)
@@ -0,0 +1,305 @@
+"""
+Size-bounded, content-addressed cache of catalog images for the embedding
+pipeline.
+
+Each distinct image is stored once, named by the SHA-256 of the 256x256 JPEG
+the pipeline keeps, so URLs serving the same picture share a file and the
+hash doubles as the contentHash recorded on image rows. A SQLite index maps
+URLs to their content along with the response's ETag/Last-Modified and fetch
+time, and tracks when each image was last used. Once the cache holds more
+than its byte budget, the least recently used images are evicted.
+
+Optionally the preprocessed CLIP input of each image is kept too, in a
+memory-mapped float32 array with one slot per image, so embedding an image
+again (e.g. with a new CLIP backend, or into a rebuilt database) skips
+decoding and resizing entirely.
+
+Several processes (the --watch worker, a manual --refresh) may share one
+cache directory, so nothing about its contents is kept only in memory: the
+byte total and the free pixel slots are read from and written to the SQLite
+index inside BEGIN IMMEDIATE transactions, which every process takes in turn.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+import numpy as np
+
+IMAGE_CACHE_MAX_MB = int(os.getenv("IMAGE_CACHE_MAX_MB", 2048))
+IMAGE_CACHE_MAX_AGE = float(os.getenv("IMAGE_CACHE_MAX_AGE", 0))
+IMAGE_CACHE_PIXELS = os.getenv("IMAGE_CACHE_PIXELS", "0") == "1"
+PIXEL_SHAPE = (3, 224, 224)
+PIXEL_BYTES = int(np.prod(PIXEL_SHAPE)) * 4
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blob (
+  sha256 TEXT PRIMARY KEY,
+  size INTEGER NOT NULL,
+  lastUsed REAL NOT NULL,
+  pixelSlot INTEGER UNIQUE);
+CREATE INDEX IF NOT EXISTS blob_last_used_idx ON blob (lastUsed);
+CREATE TABLE IF NOT EXISTS url (
+  url TEXT PRIMARY KEY,
+  sha256 TEXT NOT NULL REFERENCES blob(sha256) ON DELETE CASCADE,
+  etag TEXT,
+  lastModified TEXT,
+  fetchedAt REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS url_sha256_idx ON url (sha256);
+CREATE TABLE IF NOT EXISTS meta (
+  key TEXT PRIMARY KEY,
+  value TEXT);
+CREATE TABLE IF NOT EXISTS free_slot (
+  slot INTEGER PRIMARY KEY);
+"""
+
+CacheEntry = namedtuple("CacheEntry", "url sha256 etag last_modified fetched_at")
+
+
+class ImageCache:
+    """
+    Thread-safe image cache in `directory`, holding at most `max_bytes` of
+    images and pixel slots. `pixels_key` names the preprocessing that
+    produced the stored CLIP inputs (None disables them); slots written under
+    a different key are discarded on open.
+    """
+
+    def __init__(self, directory, max_bytes, pixels_key=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(directory, "blobs"), exist_ok=True)
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(os.path.join(directory, "index.sqlite"), timeout=60,
+                                   check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode = WAL;")
+        self._db.execute("PRAGMA foreign_keys = ON;")
+        self._db.executescript(SCHEMA)
+        self._pixels = None
+        self._pixels_path = os.path.join(self.directory, "pixels.f32")
+        if pixels_key is not None:
+            self._open_pixels(pixels_key)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Holds this process's lock and SQLite's write lock, so no other thread
+        or process changes the index until the block ends.
+        """
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE;")
+            try:
+                yield
+            except BaseException:
+                self._db.execute("ROLLBACK;")
+                raise
+            self._db.execute("COMMIT;")
+
+    def _total_bytes(self):
+        size, slots = self._db.execute("SELECT COALESCE(SUM(size), 0), COUNT(pixelSlot) FROM blob;").fetchone()
+        return size + slots * PIXEL_BYTES
+
+    def _blob_path(self, sha256):
+        return os.path.join(self.directory, "blobs", sha256[:2], f"{sha256}.jpg")
+
+    def lookup(self, url):
+        """
+        Returns the CacheEntry for url, or None if it is not cached.
+        """
+        with self._lock:
+            row = self._db.execute("SELECT url, sha256, etag, lastModified, fetchedAt FROM url WHERE url = ?;",
+                                   (url,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return CacheEntry(*row)
+
+    def read(self, sha256):
+        """
+        Returns the cached JPEG bytes for sha256, or None if they are gone.
+        """
+        try:
+            with open(self._blob_path(sha256), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            # Deleted behind our back: forget it so its urls are fetched again.
+            with self._transaction():
+                self._remove(sha256)
+            return None
+        with self._lock:
+            self._db.execute("UPDATE blob SET lastUsed = ? WHERE sha256 = ?;", (time.time(), sha256))
+        return data
+
+    def put(self, url, data, etag=None, last_modified=None):
+        """
+        Stores data as the content of url and returns its sha256.
+        """
+        sha256 = hashlib.sha256(data).hexdigest()
+        now = time.time()
+        with self._transaction():
+            exists = self._db.execute("SELECT 1 FROM blob WHERE sha256 = ?;", (sha256,)).fetchone()
+            if exists:
+                self._db.execute("UPDATE blob SET lastUsed = ? WHERE sha256 = ?;", (now, sha256))
+            else:
+                path = self._blob_path(sha256)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+                self._db.execute("INSERT INTO blob (sha256, size, lastUsed) VALUES (?, ?, ?);",
+                                 (sha256, len(data), now))
+            self._db.execute("INSERT OR REPLACE INTO url (url, sha256, etag, lastModified, fetchedAt) "
+                             "VALUES (?, ?, ?, ?, ?);", (url, sha256, etag, last_modified, now))
+            self._evict(keep=sha256)
+        return sha256
+
+    def touch(self, url):
+        """
+        Marks url as fetched now, e.g. after a 304 Not Modified.
+        """
+        with self._lock:
+            self._db.execute("UPDATE url SET fetchedAt = ? WHERE url = ?;", (time.time(), url))
+
+    def _remove(self, sha256):
+        row = self._db.execute("SELECT size, pixelSlot FROM blob WHERE sha256 = ?;", (sha256,)).fetchone()
+        if row is None:
+            return
+        size, slot = row
+        self._db.execute("DELETE FROM blob WHERE sha256 = ?;", (sha256,))
+        if slot is not None:
+            self._db.execute("INSERT OR IGNORE INTO free_slot (slot) VALUES (?);", (slot,))
+        try:
+            os.remove(self._blob_path(sha256))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self, keep):
+        # Called inside _transaction(), so the total is current for every process.
+        size = self._total_bytes()
+        while size > self.max_bytes:
+            victims = self._db.execute("SELECT sha256, size, pixelSlot FROM blob WHERE sha256 <> ? "
+                                       "ORDER BY lastUsed LIMIT 64;", (keep,)).fetchall()
+            if not victims:
+                return
+            for sha256, blob_size, slot in victims:
+                self._remove(sha256)
+                self.evictions += 1
+                size -= blob_size + (PIXEL_BYTES if slot is not None else 0)
+                if size <= self.max_bytes:
+                    return
+
+    def _open_pixels(self, pixels_key):
+        with self._transaction():
+            row = self._db.execute("SELECT value FROM meta WHERE key = 'pixels_key';").fetchone()
+            if row is None or row[0] != pixels_key:
+                self._db.execute("UPDATE blob SET pixelSlot = NULL;")
+                self._db.execute("DELETE FROM free_slot;")
+                if os.path.exists(self._pixels_path):
+                    os.remove(self._pixels_path)
+                self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('pixels_key', ?);", (pixels_key,))
+                self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('pixel_capacity', '0');")
+            elif self._pixel_capacity() is None:
+                # Caches from before free_slot existed: record their free slots once.
+                capacity = os.path.getsize(self._pixels_path) // PIXEL_BYTES if os.path.exists(self._pixels_path) else 0
+                used = {slot for (slot,) in self._db.execute("SELECT pixelSlot FROM blob WHERE pixelSlot IS NOT NULL;")}
+                self._db.executemany("INSERT OR IGNORE INTO free_slot (slot) VALUES (?);",
+                                     [(slot,) for slot in range(capacity) if slot not in used])
+                self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('pixel_capacity', ?);",
+                                 (str(capacity),))
+        self._pixels = self._map_pixels()
+
+    def _pixel_capacity(self):
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'pixel_capacity';").fetchone()
+        return int(row[0]) if row else None
+
+    def _map_pixels(self):
+        capacity = os.path.getsize(self._pixels_path) // PIXEL_BYTES if os.path.exists(self._pixels_path) else 0
+        if capacity == 0:
+            return np.zeros((0,) + PIXEL_SHAPE, dtype=np.float32)
+        return np.memmap(self._pixels_path, dtype=np.float32, mode="r+", shape=(capacity,) + PIXEL_SHAPE)
+
+    def _pixel_array(self, slot):
+        # Another process may have grown the file since we mapped it.
+        if slot >= len(self._pixels):
+            self._pixels = self._map_pixels()
+        return self._pixels
+
+    def _allocate_slot(self):
+        # Called inside _transaction(): free_slot and pixel_capacity are shared
+        # by every process using the cache.
+        row = self._db.execute("SELECT slot FROM free_slot ORDER BY slot LIMIT 1;").fetchone()
+        if row is not None:
+            self._db.execute("DELETE FROM free_slot WHERE slot = ?;", row)
+            return row[0]
+        capacity = self._pixel_capacity() or 0
+        new_capacity = max(64, capacity * 2)
+        with open(self._pixels_path, "ab") as f:
+            if f.tell() < new_capacity * PIXEL_BYTES:
+                f.truncate(new_capacity * PIXEL_BYTES)
+        self._db.executemany("INSERT INTO free_slot (slot) VALUES (?);",
+                             [(slot,) for slot in range(capacity + 1, new_capacity)])
+        self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('pixel_capacity', ?);",
+                         (str(new_capacity),))
+        return capacity
+
+    def get_pixels(self, sha256):
+        """
+        Returns a copy of the stored CLIP input for sha256, or None.
+        """
+        if self._pixels is None:
+            return None
+        with self._transaction():
+            row = self._db.execute("SELECT pixelSlot FROM blob WHERE sha256 = ?;", (sha256,)).fetchone()
+            if row is None or row[0] is None:
+                return None
+            self._db.execute("UPDATE blob SET lastUsed = ? WHERE sha256 = ?;", (time.time(), sha256))
+            return np.array(self._pixel_array(row[0])[row[0]])
+
+    def put_pixels(self, sha256, pixels):
+        """
+        Stores the CLIP input for a cached image; a no-op when pixel storage
+        is off or the image has been evicted in the meantime.
+        """
+        if self._pixels is None:
+            return
+        with self._transaction():
+            row = self._db.execute("SELECT pixelSlot FROM blob WHERE sha256 = ?;", (sha256,)).fetchone()
+            if row is None:
+                return
+            slot = row[0]
+            if slot is None:
+                slot = self._allocate_slot()
+                self._db.execute("UPDATE blob SET pixelSlot = ? WHERE sha256 = ?;", (slot, sha256))
+            self._pixel_array(slot)[slot] = pixels
+            self._evict(keep=sha256)
+
+    def close(self):
+        with self._lock:
+            if isinstance(self._pixels, np.memmap):
+                self._pixels.flush()
+            self._db.close()
+
+    def stats(self):
+        with self._lock:
+            urls = self._db.execute("SELECT COUNT(*) FROM url;").fetchone()[0]
+            blobs, slots = self._db.execute("SELECT COUNT(*), COUNT(pixelSlot) FROM blob;").fetchone()
+            bytes_used = self._total_bytes()
+        lookups = self.hits + self.misses
+        return {
+            "urls": urls,
+            "images": blobs,
+            "pixel_slots": slots,
+            "bytes": bytes_used,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
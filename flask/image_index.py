@@ -0,0 +1,220 @@
+"""
+In-process exact nearest-neighbour search over the image embeddings.
+
+The `image` table's CLIP embeddings are kept, L2-normalised, in a float32 .npy
+file alongside their ids. Every gunicorn worker memory-maps the same file, so
+the page cache holds one copy for all of them, and answers a query with one
+matrix-vector product and an argpartition. At this catalog's size that is
+both faster than a round trip to pgvector and exact.
+
+A background thread in each worker polls image_embeddings_version (bumped by
+a trigger on image) and, when it moves, brings the files up to date. Only rows
+whose contentHash/modelVersion changed are read back from Postgres. One worker
+at a time syncs, under an flock, writing a new generation directory and then
+pointing CURRENT at it; the other workers just map the new generation.
+
+Enabled with IMAGE_INDEX=1. Until the first sync has finished, or while the
+index is unavailable, searches fall back to the pgvector query.
+"""
+import fcntl
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+
+import bulkload
+import db
+import queries as query
+
+IMAGE_INDEX_ENABLED = os.getenv("IMAGE_INDEX", "0") == "1"
+IMAGE_INDEX_DIR = os.getenv("IMAGE_INDEX_DIR", "image_index")
+IMAGE_INDEX_POLL_SECONDS = float(os.getenv("IMAGE_INDEX_POLL_SECONDS", 30))
+DIMS = 512
+
+# A child of the Flask app's logger ("app"), so messages go to its handlers.
+logger = logging.getLogger("app.image_index")
+
+# ids and stamps are sorted by id; vectors[i] belongs to ids[i].
+Snapshot = namedtuple("Snapshot", "version ids stamps vectors")
+
+_index = None
+_index_pid = None
+_index_lock = threading.Lock()
+
+
+class ImageIndex:
+    """
+    Memory-mapped copy of the image embeddings in `directory`, refreshed from
+    Postgres every `poll_seconds` once `start()` has been called.
+    """
+
+    def __init__(self, directory=IMAGE_INDEX_DIR, poll_seconds=IMAGE_INDEX_POLL_SECONDS):
+        self.directory = directory
+        self.poll_seconds = poll_seconds
+        os.makedirs(directory, exist_ok=True)
+        self._snapshot = None
+        self._thread = None
+        self.searches = 0
+        self.syncs = 0
+        self.rows_fetched = 0
+        self.last_error = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="image-index", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+                self.last_error = None
+            except Exception as e:
+                self.last_error = str(e)
+                logger.warning("Image index refresh failed: %s", e)
+            time.sleep(self.poll_seconds)
+
+    def refresh(self):
+        """
+        Maps the newest generation on disk, syncing it from the image table
+        first if the table has changed since it was written.
+        """
+        with db.cursor() as cur:
+            cur.execute(query.image_embeddings_version_query)
+            version = cur.fetchone()[0]
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.version == version:
+            return
+        snapshot = self._load()
+        if snapshot is None or snapshot.version != version:
+            with open(os.path.join(self.directory, "sync.lock"), "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                # Another worker may have synced while we waited.
+                snapshot = self._load()
+                if snapshot is None or snapshot.version != version:
+                    snapshot = self._sync(snapshot)
+        self._snapshot = snapshot
+
+    def _load(self):
+        try:
+            with open(os.path.join(self.directory, "CURRENT")) as f:
+                generation = os.path.join(self.directory, f.read().strip())
+            with open(os.path.join(generation, "version")) as f:
+                version = int(f.read())
+            return Snapshot(version,
+                            np.load(os.path.join(generation, "ids.npy"), mmap_mode="r"),
+                            np.load(os.path.join(generation, "stamps.npy"), mmap_mode="r"),
+                            np.load(os.path.join(generation, "vectors.npy"), mmap_mode="r"))
+        except FileNotFoundError:
+            return None
+
+    def _sync(self, previous):
+        with db.cursor() as cur:
+            # One snapshot for the version, the stamps and the vectors.
+            cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ;")
+            cur.execute(query.image_embeddings_version_query)
+            version = cur.fetchone()[0]
+            cur.execute(query.image_embedding_stamps_query)
+            rows = cur.fetchall()
+            ids = np.array([row[0] for row in rows], dtype=np.int64)
+            stamps = np.array([row[1] for row in rows], dtype=str)
+
+            # Rows whose id and stamp match the previous generation are copied
+            # from it; everything else is read from the table.
+            kept = np.zeros(len(ids), dtype=bool)
+            if previous is not None and len(previous.ids):
+                positions = np.minimum(np.searchsorted(previous.ids, ids), len(previous.ids) - 1)
+                kept = (previous.ids[positions] == ids) & (previous.stamps[positions] == stamps)
+            changed = ids[~kept]
+            fetched_ids, fetched = np.empty(0, dtype=np.int64), np.empty((0, DIMS), dtype=np.float32)
+            if len(changed):
+                sql = cur.mogrify(query.image_embeddings_by_ids_query, (changed.tolist(),)).decode()
+                fetched_ids, fetched = bulkload.copy_out_vectors(cur, sql, DIMS)
+
+        name = f"v{version}"
+        tmp = os.path.join(self.directory, f"{name}.tmp")
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        vectors = np.lib.format.open_memmap(os.path.join(tmp, "vectors.npy"), mode="w+",
+                                            dtype=np.float32, shape=(len(ids), DIMS))
+        if kept.any():
+            vectors[kept] = previous.vectors[positions[kept]]
+        if len(fetched_ids):
+            norms = np.linalg.norm(fetched, axis=1, keepdims=True)
+            vectors[np.searchsorted(ids, fetched_ids)] = fetched / np.maximum(norms, 1e-12)
+        vectors.flush()
+        del vectors
+        np.save(os.path.join(tmp, "ids.npy"), ids)
+        np.save(os.path.join(tmp, "stamps.npy"), stamps)
+        with open(os.path.join(tmp, "version"), "w") as f:
+            f.write(str(version))
+
+        generation = os.path.join(self.directory, name)
+        shutil.rmtree(generation, ignore_errors=True)
+        os.replace(tmp, generation)
+        pointer = os.path.join(self.directory, "CURRENT.tmp")
+        with open(pointer, "w") as f:
+            f.write(name)
+        os.replace(pointer, os.path.join(self.directory, "CURRENT"))
+        self._prune(keep={name, f"v{previous.version}" if previous else None})
+
+        self.syncs += 1
+        self.rows_fetched += len(fetched_ids)
+        logger.info("Image index synced to version %s: %d images, %d read from the table",
+                    version, len(ids), len(fetched_ids))
+        return self._load()
+
+    def _prune(self, keep):
+        # The previous generation is kept for workers that are still loading
+        # it; mapped files stay readable after they are deleted anyway.
+        for entry in os.listdir(self.directory):
+            if entry.startswith("v") and entry not in keep:
+                shutil.rmtree(os.path.join(self.directory, entry), ignore_errors=True)
+
+    def search(self, embedding, k):
+        """
+        Returns (ids, cosine distances) of the k images nearest to
+        `embedding`, nearest first, or None if no index is loaded yet.
+        """
+        snapshot = self._snapshot
+        if snapshot is None or len(snapshot.ids) == 0:
+            return None
+        self.searches += 1
+        q = np.asarray(embedding, dtype=np.float32)
+        q = q / max(float(np.linalg.norm(q)), 1e-12)
+        scores = snapshot.vectors @ q
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return np.array(snapshot.ids[top]), 1.0 - scores[top].astype(np.float64)
+
+    def stats(self):
+        snapshot = self._snapshot
+        return {
+            "loaded": snapshot is not None,
+            "version": snapshot.version if snapshot else None,
+            "images": len(snapshot.ids) if snapshot else 0,
+            "searches": self.searches,
+            "syncs": self.syncs,
+            "rows_fetched": self.rows_fetched,
+            "last_error": self.last_error,
+        }
+
+
+def get_image_index():
+    """
+    This process's ImageIndex, started on first use (after the gunicorn
+    fork), or None when IMAGE_INDEX is off.
+    """
+    global _index, _index_pid
+    if not IMAGE_INDEX_ENABLED:
+        return None
+    with _index_lock:
+        if _index is None or _index_pid != os.getpid():
+            _index = ImageIndex()
+            _index_pid = os.getpid()
+            _index.start()
+        return _index
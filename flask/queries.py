@@ -1,18 +1,6 @@
 # This Python script contains all of the queries used inside app.py 
 # Hopefully this will make app.py a bit cleaner
 
-image_similarity_query = """\
-    SELECT image.id, recipeId, imageLocation, \
-       (embedding <=> %s::vector(512)) AS cosine_distance, \
-       (1 - (embedding <=> %s::vector(512)) / 2) AS cosine_similarity, \
-       recipe.name as recipe_name
-    FROM image \
-    JOIN recipe on image.recipeid = recipe.id \
-    WHERE embedding IS NOT NULL \
-    ORDER BY cosine_distance \
-    LIMIT 5;
-"""
-
 # recipe_steps_query = """\
 #     SELECT recipe_ingredient.id, unit, recipeid, displayorder,quantity, denominator, ingredient.name, unit.name as unit_name
 #     FROM recipe_ingredient 
@@ -21,20 +9,331 @@ image_similarity_query = """\
 #     WHERE recipeId = %s;
 # """
 
-recipe_steps_query = """
-        select s.description, s.imagelocation
-           from step s
-           inner join recipe r on s.recipeId = r.id
-           where r.id = %s
-           order by s.displayorder;
- """
-
-recipe_ingredients_query = """
-        select ri.quantity as quantity, ri.denominator as denominator, u.notation as notation, i.\"name\" as name, u.unitType as unitType
-          from recipe_ingredient ri
-          inner join recipe r on ri.recipeId = r.id
-          inner join ingredient i on ri.ingredientid = i.id
-          inner join unit u on ri.unit = u.id
-          where r.id = %s
-          order by ri.displayorder;
+# Recipe page: the recipe row plus its ordered ingredients and steps as JSON
+# arrays, in one round trip. Correlated subqueries keep ingredients and steps
+# from multiplying each other's rows. Quantities are formatted here the way
+# the page shows them: "1 1/2", "3 / 4", blank for a bare "to taste" item.
+recipe_detail_query = """
+        select r.*,
+               coalesce((
+                   select json_agg(json_build_object(
+                              'quantity', case
+                                  when ri.denominator is not null and div(ri.quantity, ri.denominator) > 0
+                                      then div(ri.quantity, ri.denominator) || ' ' || mod(ri.quantity, ri.denominator) || '/' || ri.denominator
+                                  when ri.denominator is not null
+                                      then ri.quantity || ' / ' || ri.denominator
+                                  when ri.quantity = 1 and u.unitType = 'use' and u.notation = ''
+                                      then ''
+                                  else ri.quantity::text
+                              end,
+                              'notation', u.notation,
+                              'name', i.name)
+                          order by ri.displayorder)
+                     from recipe_ingredient ri
+                     inner join ingredient i on ri.ingredientid = i.id
+                     inner join unit u on ri.unit = u.id
+                     where ri.recipeid = r.id
+               ), '[]'::json) as ingredients,
+               coalesce((
+                   select json_agg(json_build_object(
+                              'description', s.description,
+                              'imagelocation', s.imagelocation)
+                          order by s.displayorder)
+                     from step s
+                     where s.recipeid = r.id
+               ), '[]'::json) as steps
+          from recipe r
+          where r.id = %s;
+"""
+
+# Admin pages: column names and types of a managed table, in table order.
+table_columns_query = """
+        select column_name, data_type
+          from information_schema.columns
+          where table_name = %s
+          order by ordinal_position;
+"""
+
+# Home page: one keyset-paginated page of recipes, projected to the columns
+# index.html shows, with the description cut down server side. Both queries
+# fetch page_size + 1 rows so the caller can tell whether another page exists.
+# Parameters: (id, page_size + 1).
+recipe_page_after_query = """
+        select id, name, mainimage, left(description, 250) as description,
+               length(description) > 250 as truncated
+          from recipe
+          where id > %s
+          order by id
+          limit %s;
+"""
+
+# Same page, walking backwards from an id; rows come back in descending order.
+recipe_page_before_query = """
+        select id, name, mainimage, left(description, 250) as description,
+               length(description) > 250 as truncated
+          from recipe
+          where id < %s
+          order by id desc
+          limit %s;
+"""
+
+# Advanced search: one filter per non-empty form field, each a predicate on
+# recipe or an EXISTS semi-join into its children, so every field can use its
+# own full-text or trigram index (see init/01-tables.sql) and no recipe row is
+# multiplied by its steps and ingredients. A field matches on whole words
+# (stemmed full-text search) or as a case-insensitive substring.
+# Named parameters: <field> for the text, <field>_pattern for the ILIKE pattern.
+ADVANCED_SEARCH_FILTERS = {
+    "name": """(to_tsvector('english', r.name) @@ websearch_to_tsquery('english', %(name)s)
+                  or r.name ilike %(name_pattern)s)""",
+    "description": """(to_tsvector('english', r.description) @@ websearch_to_tsquery('english', %(description)s)
+                  or r.description ilike %(description_pattern)s)""",
+    "steps": """exists (select 1 from step s
+                   where s.recipeid = r.id
+                     and (to_tsvector('english', s.description) @@ websearch_to_tsquery('english', %(steps)s)
+                          or s.description ilike %(steps_pattern)s))""",
+    "ingredients": """exists (select 1 from recipe_ingredient ri
+                   inner join ingredient i on i.id = ri.ingredientid
+                   where ri.recipeid = r.id
+                     and i.name ilike %(ingredients_pattern)s)""",
+}
+
+def like_pattern(text):
+    """
+    Substring ILIKE pattern for user text, with LIKE wildcards escaped.
+    """
+    escaped = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+def advanced_search_sql(fields):
+    """
+    Builds the advanced search for the given ADVANCED_SEARCH_FILTERS keys.
+    """
+    conditions = [ADVANCED_SEARCH_FILTERS[field] for field in fields] or ["true"]
+    where = "\n           and ".join(conditions)
+    return f"""
+        select r.id, r.name, r.mainimage, r.description
+          from recipe r
+         where {where}
+         order by r.id;
+"""
+
+# pgvector distance operator for each metric, and the HNSW operator class an
+# index must be built with for ORDER BY <operator> to be answered from it.
+# Using any other operator silently falls back to a sequential scan.
+VECTOR_METRICS = {
+    "cosine": ("<=>", "vector_cosine_ops"),
+    "l2": ("<->", "vector_l2_ops"),
+    "inner_product": ("<#>", "vector_ip_ops"),
+}
+
+# Must match the opclasses of the HNSW indexes in init/01-tables.sql.
+RECIPE_EMBEDDING_METRIC = "cosine"
+IMAGE_EMBEDDING_METRIC = "cosine"
+
+# pgvector accepts hnsw.ef_search values from 1 to 1000 (default 40).
+DEFAULT_EF_SEARCH = 40
+MAX_EF_SEARCH = 1000
+
+# Which HNSW indexes the ANN step is answered from (app setting VECTOR_INDEX,
+# created by init/01-tables.sql according to recipes.vector_index):
+#   vector  - the float32 embeddings.
+#   halfvec - the embeddings cast to halfvec, half the index size.
+#   bit     - binary_quantize()d embeddings, 1 bit per dimension. The
+#             Hamming-distance first pass fetches BIT_RERANK_FACTOR times the
+#             rows wanted, which are re-ranked by exact distance on the
+#             float32 columns.
+# The embedding columns stay float32 in every case.
+VECTOR_INDEXES = ("vector", "halfvec", "bit")
+BIT_RERANK_FACTOR = 10
+
+def index_opclass(metric, index="vector"):
+    """
+    HNSW operator class an index of this kind must use to serve `metric`.
+    """
+    _, opclass = VECTOR_METRICS[metric]
+    if index == "halfvec":
+        return opclass.replace("vector_", "halfvec_")
+    if index == "bit":
+        return "bit_hamming_ops"
+    return opclass
+
+def ann_sql(table, key, column, dims, metric, index, embedding, limit):
+    """
+    Subquery returning (key, distance) for the `limit` rows of table nearest
+    to `embedding` (both SQL expressions, e.g. placeholders), read through
+    the given kind of index. distance is always the exact float32 distance.
+    """
+    operator, _ = VECTOR_METRICS[metric]
+    distance = f"{column} {operator} {embedding}::vector({dims})"
+    if index == "vector":
+        return f"""select {key}, {distance} as distance
+              from {table}
+              order by distance
+              limit {limit}"""
+    if index == "halfvec":
+        return f"""select {key}, {distance} as distance
+              from {table}
+              order by {column}::halfvec({dims}) {operator} {embedding}::halfvec({dims})
+              limit {limit}"""
+    if index == "bit":
+        return f"""select {key}, {distance} as distance
+              from (select {key}, {column}
+                      from {table}
+                      order by binary_quantize({column})::bit({dims}) <~> binary_quantize({embedding}::vector({dims}))
+                      limit {limit} * {BIT_RERANK_FACTOR}) candidates
+              order by distance
+              limit {limit}"""
+    raise ValueError(f"unknown vector index {index!r}")
+
+def ann_ef_search(ef_search, index="vector"):
+    """
+    hnsw.ef_search to use for a request. An HNSW scan returns at most
+    ef_search rows, so the bit index's first pass needs it scaled up by the
+    re-rank factor.
+    """
+    if index == "bit":
+        return min(MAX_EF_SEARCH, ef_search * BIT_RERANK_FACTOR)
+    return ef_search
+
+def image_similarity_sql(index="vector", metric=IMAGE_EMBEDDING_METRIC):
+    """
+    Images nearest to a CLIP query vector, with their recipe names.
+    Named parameters: embedding, k.
+    """
+    return f"""
+        with nearest as (
+            {ann_sql("image", "id", "embedding", 512, metric, index, "%(embedding)s", "%(k)s")}
+        )
+        select image.id, image.recipeId, image.imageLocation,
+               n.distance as cosine_distance,
+               (1 - n.distance / 2) as cosine_similarity,
+               recipe.name as recipe_name
+          from nearest n
+          join image on image.id = n.id
+          join recipe on image.recipeid = recipe.id
+          order by n.distance;
+"""
+
+# Rows for image ids found by the in-process image index (image_index.py),
+# with the same columns as image_similarity_sql(). Named parameters: ids,
+# distances (parallel arrays, nearest first).
+images_by_ids_query = """
+        select image.id, image.recipeId, image.imageLocation,
+               n.distance as cosine_distance,
+               (1 - n.distance / 2) as cosine_similarity,
+               recipe.name as recipe_name
+          from unnest(%(ids)s::bigint[], %(distances)s::float8[]) as n(id, distance)
+          join image on image.id = n.id
+          join recipe on image.recipeid = recipe.id
+          order by n.distance;
+"""
+
+image_embeddings_version_query = "select version from image_embeddings_version;"
+
+# What each image row's embedding was made from; a row whose stamp changed
+# must be read again. Rows from before contentHash was recorded fall back to
+# a hash of the embedding itself.
+image_embedding_stamps_query = """
+        select id::bigint, coalesce(contentHash || ':' || modelVersion, md5(embedding::text)) as stamp
+          from image
+          order by id;
+"""
+
+# Fed to bulkload.copy_out_vectors(); mogrify the ids in first.
+image_embeddings_by_ids_query = "select id::bigint, embedding from image where id = any(%s) order by id"
+
+def recipe_semantic_search_sql(metric=RECIPE_EMBEDDING_METRIC, index="vector"):
+    """
+    Nearest recipes to an mpnet query vector. Named parameters: embedding, k.
+    The ANN step runs on recipe_embeddings alone, so the planner can walk the
+    HNSW index, and only the k winners are joined back to recipe.
+    The version column lets the caller tag cached results with the
+    recipe_embeddings version they were computed from.
+    """
+    return f"""
+        with nearest as (
+            {ann_sql("recipe_embeddings", "recipeid", "description_embedding", 768, metric, index, "%(embedding)s", "%(k)s")}
+        )
+        select r.id, r.name, r.mainimage, r.description, n.distance,
+               (select version from recipe_embeddings_version) as version
+          from nearest n
+          inner join recipe r on r.id = n.recipeid
+          order by n.distance;
+"""
+
+recipe_semantic_search_query = recipe_semantic_search_sql()
+
+# Hybrid search: pgvector ANN on recipe_embeddings and full-text search on
+# recipe, fused with reciprocal-rank fusion in a single statement:
+#     score = semantic_weight / (rrf_k + semantic_rank) + lexical_weight / (rrf_k + lexical_rank)
+# A recipe found by only one side just gets that side's term.
+# Named parameters: embedding, text, candidates (per side), semantic_weight,
+# lexical_weight, rrf_k, k.
+RRF_K = 60
+
+def recipe_hybrid_search_sql(metric=RECIPE_EMBEDDING_METRIC, index="vector"):
+    return f"""
+        with semantic as (
+            select recipeid as id, row_number() over (order by distance) as rank
+              from ({ann_sql("recipe_embeddings", "recipeid", "description_embedding", 768, metric, index, "%(embedding)s", "%(candidates)s")}) nearest
+        ),
+        lexical as (
+            select r.id, row_number() over (order by ts_rank_cd(to_tsvector('english', r.name || ' ' || r.description), q) desc) as rank
+              from recipe r, websearch_to_tsquery('english', %(text)s) q
+              where to_tsvector('english', r.name || ' ' || r.description) @@ q
+              order by rank
+              limit %(candidates)s
+        ),
+        fused as (
+            select coalesce(s.id, l.id) as id,
+                   coalesce(%(semantic_weight)s / (%(rrf_k)s + s.rank), 0)
+                   + coalesce(%(lexical_weight)s / (%(rrf_k)s + l.rank), 0) as score
+              from semantic s
+              full outer join lexical l on s.id = l.id
+        )
+        select r.id, r.name, r.mainimage, r.description, f.score,
+               (select version from recipe_embeddings_version) as version
+          from fused f
+          inner join recipe r on r.id = f.id
+          order by f.score desc, r.id
+          limit %(k)s;
+"""
+
+recipe_hybrid_search_query = recipe_hybrid_search_sql()
+
+image_similarity_query = image_similarity_sql()
+
+# Exact search: case-insensitive substring match on name or description,
+# answered from the trigram indexes. Parameters: (pattern, pattern).
+recipe_exact_search_query = """
+        select id, name, mainimage, description
+          from recipe
+          where name ilike %s or description ilike %s
+          order by id;
+"""
+
+# Transaction-local hnsw.ef_search. set_config() rather than SET LOCAL, since
+# SET cannot take a bound parameter (which the async psycopg driver sends).
+# Parameter: (str(ef_search),)
+set_ef_search_query = "SELECT set_config('hnsw.ef_search', %s, true);"
+
+# Operator class of the HNSW index on a table, to check it against the metric.
+hnsw_opclass_query = """
+        select c.relname as index_name, opc.opcname as opclass
+          from pg_index i
+          inner join pg_class c on c.oid = i.indexrelid
+          inner join pg_am am on am.oid = c.relam
+          inner join pg_opclass opc on opc.oid = i.indclass[0]
+          where i.indrelid = %s::regclass and am.amname = 'hnsw';
+"""
+
+# Re-reads cached search results in their cached order. Always returns at least
+# one row, carrying the current recipe_embeddings version, even if every
+# recipe has since been deleted (r.id is then NULL).
+recipes_by_ids_query = """
+        select v.version, r.id, r.name, r.mainimage, r.description
+          from recipe_embeddings_version v
+          left join recipe r on r.id = any(%s)
+          order by array_position(%s, r.id);
 """
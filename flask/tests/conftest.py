@@ -0,0 +1,8 @@
+"""
+The app's modules are imported by their bare names (`import db`), as they are
+when run from the flask folder, so put that folder on the path.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
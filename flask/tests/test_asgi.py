@@ -0,0 +1,45 @@
+"""
+The async serving mode. Importing it loads the whole app, so it is skipped
+where the app's dependencies are not installed.
+"""
+import asyncio
+import threading
+
+import pytest
+
+for module in ("quart", "asgiref", "flask", "torch", "transformers", "sentence_transformers", "psycopg", "psycopg2",
+               "PIL", "dotenv"):
+    pytest.importorskip(module)
+
+import asgi  # noqa: E402
+from batching import MicroBatcher  # noqa: E402
+
+
+def test_cancelled_search_does_not_fail_its_batch(monkeypatch):
+    # A client that disconnects or times out cancels its handler task, and
+    # with it the future embed() is waiting on; the other searches batched
+    # with it must still get their embeddings.
+    started = threading.Event()
+    release = threading.Event()
+
+    def batch_fn(items):
+        started.set()
+        release.wait(5)
+        return [item.upper() for item in items]
+
+    batcher = MicroBatcher(batch_fn, max_batch=8, max_wait_ms=100)
+
+    async def main():
+        monkeypatch.setattr(asgi, "_inference_slots", asyncio.Semaphore(8))
+        tasks = [asyncio.ensure_future(asgi.embed(batcher, text)) for text in ("cake", "soup", "pie")]
+        await asyncio.get_running_loop().run_in_executor(None, started.wait, 5)
+        tasks[1].cancel()
+        await asyncio.sleep(0.05)
+        release.set()
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+    results = asyncio.run(main())
+
+    assert results[0] == "CAKE" and results[2] == "PIE"
+    assert isinstance(results[1], asyncio.CancelledError)
+    assert batcher.stats()["errors"] == 0
@@ -0,0 +1,45 @@
+"""
+Parity of the ONNX backends with PyTorch. Needs the model dependencies and
+downloads the models on first run, so it is skipped where they are missing.
+"""
+import numpy as np
+import pytest
+
+for module in ("torch", "transformers", "sentence_transformers", "onnx", "onnxruntime", "psycopg2", "PIL", "dotenv"):
+    pytest.importorskip(module)
+
+import torch  # noqa: E402
+from PIL import Image  # noqa: E402
+
+import embeddings  # noqa: E402
+
+THRESHOLD = 0.99
+TEXTS = ["chocolate cake", "chicken thighs with lemon and garlic", "vegetarian lasagna"]
+
+
+@pytest.fixture(scope="module")
+def pixels():
+    rng = np.random.default_rng(0)
+    images = [Image.fromarray(rng.integers(0, 256, (256, 256, 3), dtype=np.uint8)) for _ in range(3)]
+    return torch.stack([embeddings.preprocess_image(img) for img in images])
+
+
+@pytest.fixture(scope="module")
+def reference(pixels):
+    return {
+        "clip": embeddings.embed_pixels(pixels, backend="torch"),
+        "text": np.stack(embeddings.create_text_embedding(TEXTS, backend="torch")),
+    }
+
+
+@pytest.mark.parametrize("backend", [backend for backend in embeddings.BACKENDS if backend != "torch"])
+def test_backend_matches_torch(backend, pixels, reference):
+    results = {
+        "clip": embeddings.embed_pixels(pixels, backend=backend),
+        "text": np.stack(embeddings.create_text_embedding(TEXTS, backend=backend)),
+    }
+    for name, result in results.items():
+        assert result.shape == reference[name].shape
+        np.testing.assert_allclose(np.linalg.norm(result, axis=1), 1.0, atol=1e-3)
+        cosine = np.sum(reference[name] * result, axis=1)
+        assert cosine.min() >= THRESHOLD, f"{name} {backend}: cosine {cosine.min():.5f}"
@@ -0,0 +1,154 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+import pytest
+
+from batching import MicroBatcher
+
+
+def test_returns_each_items_result():
+    batcher = MicroBatcher(lambda items: [item * 2 for item in items])
+    assert batcher(21, timeout=5) == 42
+    stats = batcher.stats()
+    assert (stats["batches"], stats["items"], stats["errors"]) == (1, 1, 0)
+
+
+def test_batches_concurrent_items():
+    calls = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def batch_fn(items):
+        calls.append(list(items))
+        started.set()
+        release.wait(5)
+        return [item + 1 for item in items]
+
+    batcher = MicroBatcher(batch_fn, max_batch=4, max_wait_ms=200)
+    # The first item occupies the worker; the next ten queue up behind it.
+    first = batcher.submit(0)
+    started.wait(5)
+    futures = [batcher.submit(n) for n in range(1, 11)]
+    release.set()
+
+    assert first.result(timeout=5) == 1
+    assert [future.result(timeout=5) for future in futures] == list(range(2, 12))
+    assert calls == [[0], [1, 2, 3, 4], [5, 6, 7, 8], [9, 10]]
+    stats = batcher.stats()
+    assert stats["batch_sizes"] == {1: 1, 2: 1, 4: 2}
+    assert stats["max_batch_size"] == 4
+    assert stats["items"] == 11
+
+
+def test_window_collects_items_from_several_threads():
+    sizes = []
+
+    def batch_fn(items):
+        sizes.append(len(items))
+        return items
+
+    batcher = MicroBatcher(batch_fn, max_batch=8, max_wait_ms=500)
+    with ThreadPoolExecutor(8) as pool:
+        assert list(pool.map(lambda n: batcher(n, timeout=5), range(8))) == list(range(8))
+    assert sum(sizes) == 8
+    assert max(sizes) > 1
+
+
+def test_error_fails_the_whole_batch():
+    def batch_fn(items):
+        raise RuntimeError("model failed")
+
+    batcher = MicroBatcher(batch_fn)
+    with pytest.raises(RuntimeError, match="model failed"):
+        batcher(1, timeout=5)
+    assert batcher.stats()["errors"] == 1
+    # The worker keeps serving after a failed batch.
+    batcher.batch_fn = lambda items: items
+    assert batcher(2, timeout=5) == 2
+
+
+def test_short_results_fail_every_item():
+    started = threading.Event()
+    release = threading.Event()
+
+    def batch_fn(items):
+        started.set()
+        release.wait(5)
+        return items[:1]
+
+    batcher = MicroBatcher(batch_fn, max_batch=4)
+    first = batcher.submit(0)
+    started.wait(5)
+    futures = [batcher.submit(n) for n in range(1, 4)]
+    release.set()
+
+    assert first.result(timeout=5) == 0
+    # No item of a short batch is given another item's result.
+    for future in futures:
+        with pytest.raises(ValueError, match="returned 1 results for 3 items"):
+            future.result(timeout=5)
+
+
+def test_call_times_out():
+    release = threading.Event()
+    batcher = MicroBatcher(lambda items: release.wait(5) and items)
+    try:
+        with pytest.raises(TimeoutError):
+            batcher(1, timeout=0.05)
+    finally:
+        release.set()
+
+
+def test_cancelled_item_is_skipped():
+    calls = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def batch_fn(items):
+        calls.append(list(items))
+        started.set()
+        release.wait(5)
+        return items
+
+    batcher = MicroBatcher(batch_fn, max_batch=4)
+    first = batcher.submit(0)
+    started.wait(5)
+    cancelled, kept = batcher.submit(1), batcher.submit(2)
+    assert cancelled.cancel()
+    release.set()
+
+    assert (first.result(timeout=5), kept.result(timeout=5)) == (0, 2)
+    assert calls == [[0], [2]]
+    assert cancelled.cancelled()
+
+
+def test_cancelled_await_does_not_fail_the_batch():
+    # What asgi.embed() does: a request that times out (or whose client goes
+    # away) cancels its future while the batch it is in is running.
+    started = threading.Event()
+    release = threading.Event()
+
+    def batch_fn(items):
+        started.set()
+        release.wait(5)
+        return [item + 1 for item in items]
+
+    batcher = MicroBatcher(batch_fn, max_batch=8, max_wait_ms=100)
+
+    async def embed(item, timeout):
+        return await asyncio.wait_for(asyncio.wrap_future(batcher.submit(item)), timeout)
+
+    async def main():
+        calls = [asyncio.ensure_future(embed(1, 5)), asyncio.ensure_future(embed(2, 0.05)),
+                 asyncio.ensure_future(embed(3, 5)), asyncio.ensure_future(embed(4, 5))]
+        await asyncio.get_running_loop().run_in_executor(None, started.wait, 5)
+        await asyncio.sleep(0.2)
+        release.set()
+        return await asyncio.gather(*calls, return_exceptions=True)
+
+    results = asyncio.run(main())
+
+    assert results[0] == 2 and results[2:] == [4, 5]
+    assert isinstance(results[1], asyncio.TimeoutError)
+    assert batcher.stats()["errors"] == 0
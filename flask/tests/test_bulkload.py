@@ -0,0 +1,101 @@
+import struct
+
+import numpy as np
+import pytest
+
+import bulkload
+
+
+class CopyOutCursor:
+    """
+    Answers copy_expert() with a prepared binary COPY stream, as Postgres
+    would for `COPY (...) TO STDOUT WITH (FORMAT binary)`.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.sql = None
+
+    def copy_expert(self, sql, file):
+        self.sql = sql
+        file.write(self.data)
+
+
+def read_fields(data):
+    """
+    Parses a binary COPY stream into rows of raw field bytes (None for NULL).
+    """
+    assert data.startswith(bulkload.COPY_HEADER)
+    offset = len(bulkload.COPY_HEADER)
+    rows = []
+    while True:
+        count, = struct.unpack_from("!h", data, offset)
+        offset += 2
+        if count == -1:
+            assert offset == len(data)
+            return rows
+        row = []
+        for _ in range(count):
+            length, = struct.unpack_from("!i", data, offset)
+            offset += 4
+            if length == -1:
+                row.append(None)
+            else:
+                row.append(data[offset:offset + length])
+                offset += length
+        rows.append(row)
+
+
+def test_encode_vector():
+    data = bulkload.encode_vector(np.array([1.5, -2.0, 0.25], dtype=np.float32))
+    assert data == struct.pack("!hh3f", 3, 0, 1.5, -2.0, 0.25)
+
+
+def test_binary_copy_buffer_fields():
+    rows = [(7, "crème brûlée", [0.5, 1.0]), (2 ** 40, None, np.array([-1.0, 2.0]))]
+    fields = read_fields(bulkload.binary_copy_buffer(rows, ["bigint", "text", "vector"]).getvalue())
+    assert fields == [
+        [struct.pack("!q", 7), "crème brûlée".encode("utf-8"), struct.pack("!hh2f", 2, 0, 0.5, 1.0)],
+        [struct.pack("!q", 2 ** 40), None, struct.pack("!hh2f", 2, 0, -1.0, 2.0)],
+    ]
+
+
+def test_round_trip():
+    rng = np.random.default_rng(0)
+    ids = np.array([3, 1, 2 ** 33, 42], dtype=np.int64)
+    vectors = rng.standard_normal((len(ids), 512)).astype(np.float32)
+    data = bulkload.binary_copy_buffer(zip(ids.tolist(), vectors), ["bigint", "vector"]).getvalue()
+    cur = CopyOutCursor(data)
+
+    out_ids, out_vectors = bulkload.copy_out_vectors(cur, "select id, embedding from image", 512)
+
+    assert cur.sql == "COPY (select id, embedding from image) TO STDOUT WITH (FORMAT binary);"
+    assert out_ids.dtype == np.int64 and out_vectors.dtype == np.float32
+    np.testing.assert_array_equal(out_ids, ids)
+    np.testing.assert_array_equal(out_vectors, vectors)
+
+
+def test_copy_out_skips_header_extension():
+    data = bulkload.binary_copy_buffer([(1, [1.0, 2.0])], ["bigint", "vector"]).getvalue()
+    header = len(bulkload.COPY_HEADER)
+    extended = data[:header - 4] + struct.pack("!i", 3) + b"abc" + data[header:]
+
+    ids, vectors = bulkload.copy_out_vectors(CopyOutCursor(extended), "select 1", 2)
+
+    assert ids.tolist() == [1]
+    assert vectors.tolist() == [[1.0, 2.0]]
+
+
+def test_copy_out_empty():
+    data = bulkload.binary_copy_buffer([], ["bigint", "vector"]).getvalue()
+    ids, vectors = bulkload.copy_out_vectors(CopyOutCursor(data), "select 1", 512)
+    assert ids.shape == (0,) and vectors.shape == (0, 512)
+
+
+def test_copy_out_rejects_wrong_dims():
+    data = bytearray(bulkload.binary_copy_buffer([(1, [1.0, 2.0])], ["bigint", "vector"]).getvalue())
+    # The vector's dimensions field follows the field count, the id and the
+    # vector's length.
+    struct.pack_into("!h", data, len(bulkload.COPY_HEADER) + 2 + 4 + 8 + 4, 3)
+    with pytest.raises(ValueError, match=r"vector\(2\)"):
+        bulkload.copy_out_vectors(CopyOutCursor(bytes(data)), "select 1", 2)
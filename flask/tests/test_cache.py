@@ -0,0 +1,81 @@
+import pytest
+
+import cache
+from cache import MISSING, LRUCache, normalize_query
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_hit_and_miss():
+    lru = LRUCache(maxsize=2)
+    assert lru.get("a") is MISSING
+    lru.put("a", None)
+    assert lru.get("a") is None
+    stats = lru.stats()
+    assert (stats["hits"], stats["misses"], stats["hit_rate"]) == (1, 1, 0.5)
+
+
+def test_evicts_least_recently_used():
+    lru = LRUCache(maxsize=2)
+    lru.put("a", 1)
+    lru.put("b", 2)
+    lru.get("a")
+    lru.put("c", 3)
+    assert lru.get("b") is MISSING
+    assert (lru.get("a"), lru.get("c")) == (1, 3)
+    assert lru.evictions == 1
+    assert len(lru) == 2
+
+
+def test_entries_expire_after_ttl(clock):
+    lru = LRUCache(maxsize=4, ttl=10)
+    lru.put("a", 1)
+    clock[0] += 9
+    assert lru.get("a") == 1
+    clock[0] += 2
+    assert lru.get("a") is MISSING
+    assert len(lru) == 0
+    stats = lru.stats()
+    assert (stats["hits"], stats["misses"], stats["expirations"]) == (1, 1, 1)
+
+
+def test_put_restarts_ttl(clock):
+    lru = LRUCache(maxsize=4, ttl=10)
+    lru.put("a", 1)
+    clock[0] += 8
+    lru.put("a", 2)
+    clock[0] += 8
+    assert lru.get("a") == 2
+
+
+def test_no_ttl_never_expires(clock):
+    lru = LRUCache(maxsize=4)
+    lru.put("a", 1)
+    clock[0] += 10 ** 9
+    assert lru.get("a") == 1
+
+
+def test_size_zero_disables():
+    lru = LRUCache(maxsize=0)
+    lru.put("a", 1)
+    assert lru.get("a") is MISSING
+    assert len(lru) == 0
+
+
+def test_invalidate_and_clear():
+    lru = LRUCache()
+    lru.put("a", 1)
+    lru.put("b", 2)
+    lru.invalidate("a")
+    assert lru.get("a") is MISSING
+    lru.clear()
+    assert lru.get("b") is MISSING
+
+
+def test_normalize_query():
+    assert normalize_query("  Chocolate \t CAKE\n") == normalize_query("chocolate cake") == "chocolate cake"
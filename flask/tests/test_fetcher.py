@@ -0,0 +1,154 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from fetcher import FetchError, Fetcher
+
+
+class StandInServer:
+    """
+    Local HTTP server whose paths choose the response: /ok/<n> answers 200
+    with a body of n, /flaky/<n> answers 503 to its first request and 200
+    after that, /down/<n> always answers 503 and /missing/<n> answers 404.
+    Counts the requests per path and the most that were open at once.
+    """
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.requests = {}
+        self.open = 0
+        self.max_open = 0
+        self.lock = threading.Lock()
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with stand_in.lock:
+                    count = stand_in.requests[self.path] = stand_in.requests.get(self.path, 0) + 1
+                    stand_in.open += 1
+                    stand_in.max_open = max(stand_in.max_open, stand_in.open)
+                try:
+                    time.sleep(stand_in.delay)
+                    kind, n = self.path.strip("/").split("/")
+                    if kind == "missing":
+                        self.send_error(404)
+                    elif kind == "down" or (kind == "flaky" and count == 1):
+                        self.send_error(503)
+                    else:
+                        body = n.encode()
+                        self.send_response(200)
+                        self.send_header("Content-Length", str(len(body)))
+                        self.end_headers()
+                        self.wfile.write(body)
+                finally:
+                    with stand_in.lock:
+                        stand_in.open -= 1
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.server.server_port}{path}"
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def server():
+    server = StandInServer()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def fetcher():
+    fetcher = Fetcher(workers=4, per_host=2, retries=2, backoff=0, timeout=10)
+    yield fetcher
+    fetcher.close()
+
+
+def test_get_returns_body(server, fetcher):
+    assert fetcher.get(server.url("/ok/42")) == b"42"
+    assert fetcher.stats() == {"requests": 1, "retries": 0, "bytes": 2, "failed": 0}
+
+
+def test_retryable_status_is_retried(server, fetcher):
+    assert fetcher.get(server.url("/flaky/7")) == b"7"
+    assert server.requests["/flaky/7"] == 2
+    assert fetcher.stats()["retries"] == 1
+
+
+def test_gives_up_after_retries(server, fetcher):
+    with pytest.raises(FetchError) as raised:
+        fetcher.get(server.url("/down/1"))
+    assert raised.value.attempts == 3
+    assert server.requests["/down/1"] == 3
+    assert fetcher.stats()["retries"] == 2
+
+
+def test_client_error_is_not_retried(server, fetcher):
+    with pytest.raises(FetchError) as raised:
+        fetcher.get(server.url("/missing/1"))
+    assert raised.value.attempts == 1
+    assert server.requests["/missing/1"] == 1
+    assert fetcher.stats()["retries"] == 0
+
+
+def test_connection_error_is_retried():
+    server = StandInServer()
+    url = server.url("/ok/1")
+    server.close()
+    fetcher = Fetcher(retries=1, backoff=0, timeout=1)
+    with pytest.raises(FetchError) as raised:
+        fetcher.get(url)
+    assert raised.value.attempts == 2
+    assert fetcher.stats() == {"requests": 2, "retries": 1, "bytes": 0, "failed": 0}
+
+
+def test_map_records_failures_in_order(server, fetcher):
+    paths = ["/ok/1", "/missing/2", "/flaky/3", "/down/4", "/ok/5"]
+    results = list(fetcher.map(fetcher.get, [server.url(path) for path in paths]))
+
+    assert [item for item, _, _ in results] == [server.url(path) for path in paths]
+    assert [result for _, result, _ in results] == [b"1", None, b"3", None, b"5"]
+    assert [type(error) for _, _, error in results] == [type(None), FetchError, type(None), FetchError, type(None)]
+    assert [(failure.item, failure.attempts) for failure in fetcher.failures] == [
+        (server.url("/missing/2"), 1),
+        (server.url("/down/4"), 3),
+    ]
+    assert "HTTP 503" in fetcher.failures[1].error
+    stats = fetcher.stats()
+    assert stats["failed"] == 2
+    assert stats["retries"] == 3  # one for /flaky/3, two for /down/4
+    assert stats["requests"] == 1 + 1 + 2 + 3 + 1
+
+
+def test_map_records_exceptions_from_fn(fetcher):
+    def fn(item):
+        if item == 2:
+            raise ValueError("bad item")
+        return item * 10
+
+    results = list(fetcher.map(fn, [1, 2, 3]))
+
+    assert [result for _, result, _ in results] == [10, None, 30]
+    assert [(failure.item, failure.attempts, failure.error) for failure in fetcher.failures] == [(2, 1, "bad item")]
+
+
+def test_per_host_limit():
+    server = StandInServer(delay=0.05)
+    fetcher = Fetcher(workers=8, per_host=2, retries=0, backoff=0, timeout=10)
+    try:
+        urls = [server.url(f"/ok/{n}") for n in range(16)]
+        assert [result for _, result, _ in fetcher.map(fetcher.get, urls)] == [str(n).encode() for n in range(16)]
+        assert server.max_open == 2
+    finally:
+        fetcher.close()
+        server.close()
@@ -0,0 +1,92 @@
+import os
+import re
+
+import pytest
+
+import queries as query
+
+TABLES_SQL = os.path.join(os.path.dirname(__file__), "..", "..", "init", "01-tables.sql")
+
+
+def squash(sql):
+    return " ".join(sql.split())
+
+
+def recipe_ann(index, metric="cosine"):
+    return squash(query.ann_sql("recipe_embeddings", "recipeid", "description_embedding", 768,
+                                metric, index, "%(embedding)s", "%(k)s"))
+
+
+def test_vector_orders_by_exact_distance():
+    assert recipe_ann("vector") == (
+        "select recipeid, description_embedding <=> %(embedding)s::vector(768) as distance "
+        "from recipe_embeddings order by distance limit %(k)s")
+
+
+@pytest.mark.parametrize("metric, operator", [("cosine", "<=>"), ("l2", "<->"), ("inner_product", "<#>")])
+def test_metric_chooses_operator(metric, operator):
+    assert f"description_embedding {operator} %(embedding)s::vector(768) as distance" in recipe_ann("vector", metric)
+
+
+def test_halfvec_orders_by_halfvec_distance():
+    sql = recipe_ann("halfvec")
+    assert "order by description_embedding::halfvec(768) <=> %(embedding)s::halfvec(768) limit %(k)s" in sql
+    # The distance returned is still the float32 one.
+    assert sql.startswith("select recipeid, description_embedding <=> %(embedding)s::vector(768) as distance ")
+
+
+def test_bit_shortlists_then_reranks():
+    sql = recipe_ann("bit")
+    inner = re.search(r"from \((.*)\) candidates", sql).group(1)
+    assert inner == (
+        "select recipeid, description_embedding from recipe_embeddings "
+        "order by binary_quantize(description_embedding)::bit(768) <~> binary_quantize(%(embedding)s::vector(768)) "
+        f"limit %(k)s * {query.BIT_RERANK_FACTOR}")
+    assert sql.startswith("select recipeid, description_embedding <=> %(embedding)s::vector(768) as distance ")
+    assert sql.endswith(") candidates order by distance limit %(k)s")
+
+
+def test_unknown_index():
+    with pytest.raises(ValueError):
+        recipe_ann("pq")
+
+
+@pytest.mark.parametrize("index, expression", [
+    ("vector", "description_embedding vector_cosine_ops"),
+    ("halfvec", "(description_embedding::halfvec(768)) halfvec_cosine_ops"),
+    ("bit", "(binary_quantize(description_embedding)::bit(768)) bit_hamming_ops"),
+])
+def test_index_matches_tables_sql(index, expression):
+    # The ORDER BY can only be answered from an index on the same expression
+    # with the opclass index_opclass() names.
+    with open(TABLES_SQL) as f:
+        tables = squash(f.read())
+    assert expression.endswith(query.index_opclass(query.RECIPE_EMBEDDING_METRIC, index))
+    assert f"ON recipe_embeddings USING hnsw ({expression})" in tables
+
+
+@pytest.mark.parametrize("metric, index, opclass", [
+    ("cosine", "vector", "vector_cosine_ops"),
+    ("l2", "vector", "vector_l2_ops"),
+    ("cosine", "halfvec", "halfvec_cosine_ops"),
+    ("inner_product", "halfvec", "halfvec_ip_ops"),
+    ("cosine", "bit", "bit_hamming_ops"),
+])
+def test_index_opclass(metric, index, opclass):
+    assert query.index_opclass(metric, index) == opclass
+
+
+def test_ann_ef_search():
+    assert query.ann_ef_search(40) == 40
+    assert query.ann_ef_search(40, "halfvec") == 40
+    assert query.ann_ef_search(40, "bit") == 40 * query.BIT_RERANK_FACTOR
+    assert query.ann_ef_search(500, "bit") == query.MAX_EF_SEARCH
+
+
+def test_searches_use_the_ann_subquery():
+    for index in query.VECTOR_INDEXES:
+        ann = recipe_ann(index)
+        assert ann in squash(query.recipe_semantic_search_sql(index=index))
+        assert ann.replace("%(k)s", "%(candidates)s") in squash(query.recipe_hybrid_search_sql(index=index))
+        image_ann = squash(query.ann_sql("image", "id", "embedding", 512, "cosine", index, "%(embedding)s", "%(k)s"))
+        assert image_ann in squash(query.image_similarity_sql(index=index))
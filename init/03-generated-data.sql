@@ -266,7 +266,7 @@ INSERT INTO recipe (name, description, servings, mainImage) VALUES
    ('Chocolate Biscoff Truffles Recipe', 'Another fun way to use Biscoff spread, these truffles are a melt-in-your-mouth combination of dark chocolate and warming spices.', 'makes about 12 truffles', 'https://www.seriouseats.com/thmb/HKZyrOw81xD82rMeGdd6hou81EA=/1500x0/filters:no_upscale():max_bytes(150000):strip_icc()/__opt__aboutcom__coeus__resources__content_migration__serious_eats__seriouseats.com__recipes__images__2012__03__20120314-biscoffcookietruffles-5ac7782b483f42f2a1c9b45cd1eac32f.JPG'),
    ('Shortbread Sandwiches Recipe', 'The beauty of these cookies is their versatility. Play around: you can fill them with jam, Nutella, peanut butter, or chocolate ganache.', 'makes about 15 cookies', 'https://www.seriouseats.com/thmb/9MigN2asaCqVI8r_aYoYnUk_HlQ=/1500x0/filters:no_upscale():max_bytes(150000):strip_icc()/__opt__aboutcom__coeus__resources__content_migration__serious_eats__seriouseats.com__recipes__images__2012__05__20120514-cookie-monster-shortbread-sandwiches-f03cf7ac535e4e169c367bf8e16fa381.JPG'),
    ('Quick Gluten-Free Chocolate Cake Recipe', 'This cake is best served right from the pan. If you''d prefer to remove it from the pan for serving, place a "foil sling" in the pan before baking. To do this, place one piece of foil in the pan,...', 'serves 9', 'https://www.seriouseats.com/thmb/FhEEDN8wA8NaSsGueLoQ-YmSPkE=/1500x0/filters:no_upscale():max_bytes(150000):strip_icc()/__opt__aboutcom__coeus__resources__content_migration__serious_eats__seriouseats.com__recipes__images__2012__01__20120124-188731-GFTues-ChocolateCake-d3bf88462f5f41c0b58e92df6e3ee3bc.jpg'),
-   ('Curry Paste with Peruvian Flair: Red Curry and Pink Peppercorn Meat Sauce Recipe', 'Learn more about pink peppercorns here » During the summer my thoughts turn to spicy fare. It makes you sweat, in a good way, and if you can''t beat the heat, you may as well fight it on its own...', 'None', 'None'),
+   ('Curry Paste with Peruvian Flair: Red Curry and Pink Peppercorn Meat Sauce Recipe', 'Learn more about pink peppercorns here » During the summer my thoughts turn to spicy fare. It makes you sweat, in a good way, and if you can''t beat the heat, you may as well fight it on its own...', 'None', NULL),
    ('Tonkatsu Sauce (Japanese-Style Barbecue Sauce)', 'This tonkatsu sauce is easy to throw together and perfect for serving with golden, crispy panko-crusted cutlets.', 'makes about 1/2 cup', 'https://www.seriouseats.com/thmb/3ojzjVEZOPGlTK7qGeCjUVhXtMA=/1500x0/filters:no_upscale():max_bytes(150000):strip_icc()/__opt__aboutcom__coeus__resources__content_migration__serious_eats__seriouseats.com__recipes__images__2012__09__20120919-223139-tonkatsu-sauce-d0d2ff91373243848605789d1f79b86f.jpg'),
    ('Tonkatsu (Japanese Breaded Pork Cutlets)', 'Crispy, golden-brown, and juicy breaded and fried pork cutlets, Japanese-style.', 'Serves 2', 'https://www.seriouseats.com/thmb/HDqcye0uVz0epNLTqD3g2hCJr60=/1500x0/filters:no_upscale():max_bytes(150000):strip_icc()/20250312PorkTonkatsu-FredHardy-08-26a58d83d15845d998763548d6b4f796.jpg'),
    ('Tomato-Mint Sauce Recipe', 'In essence, this is a simple marinara with the addition of mint, but that one minor change makes a big difference.', 'makes about 4 cups', 'https://www.seriouseats.com/thmb/3PASomCiLZzvhnf0JLYNakqYJBw=/1500x0/filters:no_upscale():max_bytes(150000):strip_icc()/__opt__aboutcom__coeus__resources__content_migration__serious_eats__seriouseats.com__recipes__images__2013__03__20130302-242913-tomato-mint-sauce-c5e0aa08301c42c28d647b9461cde6c9.jpg'),
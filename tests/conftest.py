@@ -0,0 +1,7 @@
+"""
+tx.py is a script in the repository root; put that folder on the path.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
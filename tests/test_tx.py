@@ -0,0 +1,139 @@
+import copy
+import json
+import os
+
+import pytest
+
+import tx
+
+psycopg2_extras = pytest.importorskip("psycopg2.extras")
+
+RECIPES = os.path.join(os.path.dirname(__file__), "..", tx.default_file)
+
+
+class LoadCursor:
+    """
+    Stands in for the database in load_batch(): keeps the recipe,
+    recipe_ingredient and step rows in memory and answers the statements
+    load_batch() sends, the way Postgres would.
+    """
+
+    def __init__(self):
+        self.recipes = {}  # name -> [id, description, servings, mainImage, sourceHash]
+        self.ingredients = {}  # (recipeId, ingredientId, displayOrder) -> (unit, quantity, denominator)
+        self.steps = {}  # (recipeId, displayOrder) -> (description, imageLocation)
+        self.results = []
+
+    def execute(self, sql, params=None):
+        sql = " ".join(sql.split())
+        if sql.startswith("SELECT name, id, description"):
+            self.results = [(name, *row) for name, row in self.recipes.items() if name in params[0]]
+        elif sql.startswith("SELECT set_config"):
+            self.results = []
+        elif sql.startswith("DELETE FROM recipe_ingredient"):
+            self.results = self._delete(self.ingredients, params[0], set(zip(*params[1:])))
+        elif sql.startswith("DELETE FROM step"):
+            self.results = self._delete(self.steps, params[0], set(zip(*params[1:])))
+        else:
+            raise AssertionError(f"unexpected statement: {sql}")
+
+    def _delete(self, table, ids, keep):
+        gone = [key for key in table if key[0] in ids and key not in keep]
+        for key in gone:
+            del table[key]
+        return [(key[0],) for key in gone]
+
+    def fetchall(self):
+        return self.results
+
+    def execute_values(self, sql, rows):
+        sql = " ".join(sql.split())
+        if sql.startswith("INSERT INTO recipe ("):
+            written = []
+            for name, description, servings, main_image, source_hash in rows:
+                row = self.recipes.get(name)
+                if row is None:
+                    self.recipes[name] = [len(self.recipes) + 1, description, servings, main_image, source_hash]
+                elif row[1:4] != [description, servings, main_image]:
+                    row[1:5] = [description, servings, main_image, source_hash]
+                else:
+                    continue
+                written.append((name, self.recipes[name][0]))
+            return written
+        if sql.startswith("UPDATE recipe SET sourceHash"):
+            by_id = {row[0]: row for row in self.recipes.values()}
+            for recipe_id, source_hash in rows:
+                by_id[recipe_id][4] = source_hash
+            return []
+        if sql.startswith("INSERT INTO recipe_ingredient"):
+            return self._upsert(self.ingredients, [(row[:3], row[3:]) for row in rows])
+        if sql.startswith("INSERT INTO step"):
+            return self._upsert(self.steps, [(row[:2], row[2:]) for row in rows])
+        raise AssertionError(f"unexpected statement: {sql}")
+
+    def _upsert(self, table, rows):
+        written = []
+        for key, values in rows:
+            if table.get(key) != values:
+                table[key] = values
+                written.append((key[0],))
+        return written
+
+
+@pytest.fixture
+def cursor(monkeypatch):
+    cur = LoadCursor()
+
+    def execute_values(cur, sql, rows, template=None, fetch=False):
+        result = cur.execute_values(sql, rows)
+        return result if fetch else None
+
+    monkeypatch.setattr(psycopg2_extras, "execute_values", execute_values)
+    return cur
+
+
+@pytest.fixture(scope="module")
+def recipes():
+    with open(RECIPES, encoding="utf-8") as f:
+        return [json.loads(next(f)) for _ in range(2)]
+
+
+def load(cur, batch):
+    ingredient_ids, unit_ids = {}, {}
+    for recipe in batch:
+        for food, _, unit, _, _ in tx.recipe_ingredient_values(recipe):
+            ingredient_ids.setdefault(food, len(ingredient_ids) + 1)
+            unit_ids.setdefault(unit, len(unit_ids) + 1)
+    report = {"added": [], "updated": [], "unchanged": 0}
+    tx.load_batch(cur, batch, ingredient_ids, unit_ids, report)
+    return report
+
+
+def rows_of(cur, recipe_id):
+    return ({key: value for key, value in cur.ingredients.items() if key[0] == recipe_id},
+            {key: value for key, value in cur.steps.items() if key[0] == recipe_id})
+
+
+def test_mixed_batch_keeps_unchanged_recipes_rows(cursor, recipes):
+    assert load(cursor, recipes)["added"] == [recipe["name"] for recipe in recipes]
+    unchanged_id = cursor.recipes[recipes[0]["name"]][0]
+    changed_id = cursor.recipes[recipes[1]["name"]][0]
+    unchanged_rows = rows_of(cursor, unchanged_id)
+    assert all(unchanged_rows)
+
+    edited = copy.deepcopy(recipes[1])
+    edited["steps"] = edited["steps"][:-1]
+    report = load(cursor, [recipes[0], edited])
+
+    assert report == {"added": [], "updated": [edited["name"]], "unchanged": 1}
+    assert rows_of(cursor, unchanged_id) == unchanged_rows
+    ingredients, steps = rows_of(cursor, changed_id)
+    assert len(steps) == len(edited["steps"])
+    assert len(ingredients) == len(edited["ingredients_decomposed"])
+
+
+def test_reload_is_unchanged(cursor, recipes):
+    load(cursor, recipes)
+    before = copy.deepcopy((cursor.recipes, cursor.ingredients, cursor.steps))
+    assert load(cursor, recipes) == {"added": [], "updated": [], "unchanged": 2}
+    assert (cursor.recipes, cursor.ingredients, cursor.steps) == before
@@ -3,9 +3,14 @@ import json
 import os
 import re
 import argparse
+import hashlib
+import tempfile
 
 default_file = "recipes_cleaned.jsonl"
 default_output = "output.sql"
+default_units = "data/data.sql"
+default_env = "flask/.env"
+default_batch_size = 100
 
 def esc(s):
     return s.replace("'", "''")
@@ -55,6 +60,15 @@ def load_file(file_path):
         data = [json.loads(line) for line in file]
     return data
 
+def stream_file(file_path):
+    """
+    Yield the recipes of a JSONL file one line at a time.
+    """
+    with open(file_path, 'r') as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
 conversions = {
         "large": "",
         "14-ounce": "ounce",
@@ -78,103 +92,448 @@ def convert(food, unit):
         unit = "quart"
     return food, unit
 
-def get_ingredients(data):
+def add_ingredients(recipe, foods, simple_names):
+    """
+    Adds the ingredients of one recipe to foods (name -> base unit), keeping
+    the unit of the first recipe that uses each one.
+    """
     # strip out all ingredients: these are "ingredients_decomposed" for each line
+    ingredients = recipe.get("ingredients_decomposed", {})
+    for ingredient in ingredients.values():
+        if "food" in ingredient:
+            food = singularize(ingredient["food"])
+            unit = ingredient["unit"]
+            unit = unit.lower()
+            food, unit = convert(food, unit)
+            simple_name = food.lower()
+            if simple_name in simple_names:
+                if food in foods:
+                    print(f"Duplicate ingredient with different case found: {ingredient['food']}")
+                continue
+            foods.setdefault(food, unit)
+
+def ingredient_values(foods):
+    """
+    Yields (name, base unit) for each row of the ingredient table.
+    """
+    for ingredient,unit in foods.items():
+        if ingredient == "unknown":
+            continue
+        yield singularize(ingredient), unit
+
+def get_ingredients(data):
     foods = {}
     simple_names = set()
     for recipe in data:
-        ingredients = recipe.get("ingredients_decomposed", {})
-        for ingredient in ingredients.values():
-            if "food" in ingredient:
-                food = singularize(ingredient["food"])
-                unit = ingredient["unit"]
-                unit = unit.lower()
-                food, unit = convert(food, unit)
-                simple_name = food.lower()
-                if simple_name in simple_names:
-                    if food in foods:
-                        print(f"Duplicate ingredient with different case found: {ingredient['food']}")
-                    continue
-                foods.setdefault(food, unit)
+        add_ingredients(recipe, foods, simple_names)
     sql = "INSERT INTO ingredient (name, baseUnit) VALUES\n"
     sql_strs = []
-    for ingredient,unit in foods.items():
-        if ingredient == "unknown":
-            continue
-        sql_strs.append(f"  ('{esc(singularize(ingredient))}', (SELECT id FROM unit WHERE name = '{unit}'))")
+    for name,unit in ingredient_values(foods):
+        sql_strs.append(f"  ('{esc(name)}', (SELECT id FROM unit WHERE name = '{unit}'))")
     return [sql + ",\n".join(sql_strs) + ";"]
 
+def recipe_values(recipe):
+    """
+    (name, description, servings, mainImage) of the recipe table row.
+    servings is NOT NULL, so a missing value is kept as text, as the INSERT
+    output has always stored it; a missing mainImage is None (NULL).
+    """
+    return recipe["name"], recipe["description"], str(recipe["servings"]), recipe["mainImageUrl"] or None
+
 def get_recipes(data):
     sql = "INSERT INTO recipe (name, description, servings, mainImage) VALUES\n"
     sql_strs = []
     for recipe in data:
-        name = recipe["name"]
-        description = recipe["description"]
-        servings = recipe["servings"]
-        mainImage = recipe["mainImageUrl"]
-        sql_strs.append(f"   ('{esc(name)}', '{esc(description)}', '{servings}', '{mainImage}')")
+        name, description, servings, mainImage = recipe_values(recipe)
+        mainImagev = "NULL" if mainImage is None else f"'{mainImage}'"
+        sql_strs.append(f"   ('{esc(name)}', '{esc(description)}', '{servings}', {mainImagev})")
     return [sql + ",\n".join(sql_strs) + ";"]
 
+def recipe_ingredient_values(recipe):
+    """
+    Yields (ingredient name, displayOrder, unit name, quantity, denominator)
+    for each ingredient line of a recipe. denominator is "NULL" if there is
+    none.
+    """
+    ingredients = recipe.get("ingredients_decomposed", {})
+    for order,ingredient in ingredients.items():
+        food = singularize(ingredient["food"])
+        quantity = ingredient["quantity"]
+        unit0 = ingredient["unit"]
+        food, unit = convert(food, unit0)
+        if quantity == "":
+            quantity = "1"
+            if unit != "":
+                print(f"Warning: ingredient {food} has empty quantity for unit '{unit}': using 1")
+        quantity = replace_unicode(quantity)
+        frac = re.search(r"([ 0-9]+)/(\d+)", quantity)
+        numerator = ""
+        denominator = "NULL"
+        if om := re.search(r"(\d+)-ounce", unit0):
+            if not unit0.endswith(" can"):
+                numerator = om.group(1)
+        if frac:
+            denominator = frac.group(2)
+            num = frac.group(1)
+            if m := re.search(r"(\d+) +(\d+)", num):
+                a = m.group(1)
+                b = m.group(2)
+                numerator = int(denominator) * int(a) + int(b)
+            else:
+                numerator = num
+        else:
+            try:
+                numerator = int(quantity)
+            except ValueError:
+                try:
+                    food, numerator, unit = fudge(food, quantity, unit)
+                except ValueError:
+                    print(f"Error: ingredient {food} has unknown quantity {quantity}, in {recipe['name']}")
+                    raise
+        yield food, order, unit, numerator, denominator
+
 def get_recipe_ingredients(data):
     sql_str = f"INSERT INTO recipe_ingredient (recipeId, ingredientId, displayOrder, unit, quantity, denominator) VALUES\n"
     sql_strs = []
     for recipe in data:
-        ingredients = recipe.get("ingredients_decomposed", {})
-        for order,ingredient in ingredients.items():
-            food = singularize(ingredient["food"])
-            quantity = ingredient["quantity"]
-            unit0 = ingredient["unit"]
-            food, unit = convert(food, unit0)
-            if quantity == "":
-                quantity = "1"
-                if unit != "":
-                    print(f"Warning: ingredient {food} has empty quantity for unit '{unit}': using 1")
-            quantity = replace_unicode(quantity)
-            frac = re.search(r"([ 0-9]+)/(\d+)", quantity)
-            numerator = ""
-            denominator = "NULL"
-            if om := re.search(r"(\d+)-ounce", unit0):
-                if not unit0.endswith(" can"):
-                    numerator = om.group(1)
-            if frac:
-                denominator = frac.group(2)
-                num = frac.group(1)
-                if m := re.search(r"(\d+) +(\d+)", num):
-                    a = m.group(1)
-                    b = m.group(2)
-                    numerator = int(denominator) * int(a) + int(b)
-                else:
-                    numerator = num
-            else:
-                try:
-                    numerator = int(quantity)
-                except ValueError:
-                    try:
-                        food, numerator, unit = fudge(food, quantity, unit)
-                    except ValueError:
-                        print(f"Error: ingredient {food} has unknown quantity {quantity}, in {recipe['name']}")
-                        raise
+        for food, order, unit, numerator, denominator in recipe_ingredient_values(recipe):
             sql_strs.append(f"  ((SELECT id FROM recipe WHERE name = '{esc(recipe['name'])}'),\n"
                             f"   (SELECT id FROM ingredient WHERE name = '{esc(food)}'), {order},\n"
                             f"   (SELECT id FROM unit WHERE name = '{unit}'), {numerator}, {denominator})")
     return [sql_str + ",\n".join(sql_strs) + ";"]
 
+def step_values(recipe):
+    """
+    Yields (displayOrder, description, imageLocation) for each step of a
+    recipe. imageLocation is None if the step has no image.
+    """
+    for step in recipe["steps"]:
+        image = step["image_url"]
+        yield step["order"], step["description"], image if image and image != "" else None
+
 def get_steps(data):
     sql_str = f"INSERT INTO step (recipeId, displayOrder, description, imageLocation) VALUES\n"
     sql = []
     for recipe in data:
-        steps = recipe["steps"]
         recipe_name = recipe["name"]
-        for step in steps:
-            order = step["order"]
-            description = step["description"]
-            image = step["image_url"]
+        for order, description, image in step_values(recipe):
             imagev = "NULL"
-            if image and image != "":
+            if image is not None:
                 imagev = f"'{image}'"
             sql.append(f"  ((SELECT id FROM recipe WHERE name = '{esc(recipe_name)}'),\n   {order}, '{esc(description)}', {imagev})")
     return [sql_str + ",\n".join(sql) + ";"]
 
+def load_unit_ids(file_path):
+    """
+    Map unit name -> id, as numbered by the unit INSERT in data/data.sql when
+    it runs on an empty table.
+    """
+    with open(file_path, 'r') as file:
+        text = file.read()
+    m = re.search(r"INSERT into unit \(name, unitType, notation\) VALUES(.*?);", text, re.S | re.I)
+    if not m:
+        raise ValueError(f"No unit INSERT found in {file_path}")
+    names = re.findall(r"\(\s*'((?:[^']|'')*)'\s*,\s*'[^']*'\s*,\s*'[^']*'\s*\)", m.group(1))
+    return {name.replace("''", "'"): i for i, name in enumerate(names, start=1)}
+
+def copy_value(value):
+    """
+    A value in COPY's text format; None is NULL.
+    """
+    if value is None:
+        return "\\N"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+def copy_row(*values):
+    return "\t".join(copy_value(v) for v in values) + "\n"
+
+copy_tables = [
+    ("ingredient", "id, name, baseUnit"),
+    ("recipe", "id, name, description, servings, mainImage"),
+    ("recipe_ingredient", "id, recipeId, ingredientId, displayOrder, unit, quantity, denominator"),
+    ("step", "id, recipeId, displayOrder, description, imageLocation"),
+]
+
+def write_copy(recipes, output_path, unit_ids, foods=None):
+    """
+    Write recipes as a psql script of one COPY block per table, with every id
+    assigned here instead of looked up by name on the server. recipes may be
+    a generator; rows are spooled to temporary files per table, so only the
+    ingredient list is held in memory. Pass foods (from add_ingredients) when
+    all recipes are known up front, to number ingredients before any recipe
+    refers to them. The ids assume empty tables, as after data/tables.sql and
+    data/data.sql.
+    Returns the number of recipes written.
+    """
+    if foods is None:
+        foods = {}
+    simple_names = set()
+    ingredient_ids = {}
+    used_units = {}
+    pending = []
+    spools = {table: tempfile.TemporaryFile("w+", encoding="utf-8") for table, _ in copy_tables}
+    counts = dict.fromkeys(spools, 0)
+
+    def unit_id(name):
+        if name not in unit_ids:
+            raise ValueError(f"Unknown unit '{name}'")
+        used_units[name] = unit_ids[name]
+        return unit_ids[name]
+
+    def add_row(table, *values):
+        counts[table] += 1
+        spools[table].write(copy_row(counts[table], *values))
+
+    def number_ingredients():
+        for name, unit in ingredient_values(foods):
+            if name not in ingredient_ids:
+                add_row("ingredient", name, unit_id(unit))
+                ingredient_ids[name] = counts["ingredient"]
+
+    number_ingredients()
+    for recipe in recipes:
+        add_ingredients(recipe, foods, simple_names)
+        number_ingredients()
+        add_row("recipe", *recipe_values(recipe))
+        recipe_id = counts["recipe"]
+        for food, order, unit, numerator, denominator in recipe_ingredient_values(recipe):
+            values = [recipe_id, food, order, unit_id(unit), str(numerator).strip(),
+                      None if denominator == "NULL" else denominator]
+            counts["recipe_ingredient"] += 1
+            # fudge() can rename an ingredient to one that only a later
+            # recipe introduces; those rows wait until the end.
+            if food in ingredient_ids:
+                values[1] = ingredient_ids[food]
+                spools["recipe_ingredient"].write(copy_row(counts["recipe_ingredient"], *values))
+            else:
+                pending.append((counts["recipe_ingredient"], values, recipe["name"]))
+        for order, description, image in step_values(recipe):
+            add_row("step", recipe_id, order, description, image)
+    for row_id, values, recipe_name in pending:
+        if values[1] not in ingredient_ids:
+            raise ValueError(f"Unknown ingredient {values[1]}, in {recipe_name}")
+        values[1] = ingredient_ids[values[1]]
+        spools["recipe_ingredient"].write(copy_row(row_id, *values))
+
+    with open(output_path, 'w') as file:
+        file.write("\\set ON_ERROR_STOP on\nBEGIN;\n\n")
+        if used_units:
+            expected = ",\n".join(f"    ({i}, '{esc(name)}')" for name, i in used_units.items())
+            file.write("-- Unit ids were taken from data/data.sql; stop if this database numbered them differently.\n"
+                       "DO $$\nBEGIN\n"
+                       "  IF EXISTS (SELECT 1 FROM (VALUES\n"
+                       f"{expected}) AS expected (id, name)\n"
+                       "      LEFT JOIN unit USING (id) WHERE unit.name IS DISTINCT FROM expected.name) THEN\n"
+                       "    RAISE EXCEPTION 'unit ids differ from data/data.sql; load the INSERT output instead';\n"
+                       "  END IF;\nEND\n$$;\n\n")
+        for table, columns in copy_tables:
+            file.write(f"COPY {table} ({columns}) FROM stdin;\n")
+            spool = spools[table]
+            spool.seek(0)
+            for line in spool:
+                file.write(line)
+            spool.close()
+            file.write("\\.\n\n")
+        for table, _ in copy_tables:
+            file.write(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), max(id)) FROM {table};\n")
+        file.write("\nCOMMIT;\n")
+    return counts["recipe"]
+
+
+def recipe_rows(recipe):
+    """
+    The recipe's row values, its recipe_ingredient and step rows (ingredient
+    and unit by name), and a hash of all three for spotting changed recipes.
+    """
+    values = recipe_values(recipe)
+    ingredients = [(food, int(order), unit, str(numerator).strip(), None if denominator == "NULL" else int(denominator))
+                   for food, order, unit, numerator, denominator in recipe_ingredient_values(recipe)]
+    steps = [(int(order), description, image) for order, description, image in step_values(recipe)]
+    content = json.dumps([values, ingredients, steps], default=str, ensure_ascii=False)
+    return values, ingredients, steps, hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+def connect(env_path):
+    """
+    Connect to the database named in flask/.env (or the environment), as the
+    web app does.
+    """
+    import psycopg2
+    from dotenv import load_dotenv
+    if os.path.exists(env_path):
+        load_dotenv(env_path, override=True)
+    return psycopg2.connect(host=os.getenv("HOST", "localhost"), database=os.getenv("DATABASE"),
+                            port=os.getenv("PORT", 5432), user=os.getenv("USER"),
+                            password=os.getenv("PASSWORD"))
+
+def load_ingredients(cur, recipes):
+    """
+    Insert the ingredients no recipe has used before. Existing ingredients
+    keep their base unit. Returns (name -> id, names added).
+    """
+    from psycopg2.extras import execute_values
+    foods = {}
+    simple_names = set()
+    for recipe in recipes:
+        add_ingredients(recipe, foods, simple_names)
+    rows = list(ingredient_values(foods))
+    added = execute_values(cur, """
+        INSERT INTO ingredient (name, baseUnit)
+        SELECT v.name, unit.id FROM (VALUES %s) AS v (name, unit)
+          JOIN unit ON unit.name = v.unit
+        ON CONFLICT (name) DO NOTHING
+        RETURNING name;""", rows, fetch=True)
+    if len(added) < len(rows):
+        cur.execute("SELECT name FROM ingredient WHERE name = ANY(%s);", ([name for name, _ in rows],))
+        known = {name for (name,) in cur.fetchall()}
+        missing = [f"{name} ({unit})" for name, unit in rows if name not in known]
+        if missing:
+            raise ValueError(f"Ingredients with unknown units: {', '.join(missing)}")
+    cur.execute("SELECT name, id FROM ingredient;")
+    return dict(cur.fetchall()), [name for (name,) in added]
+
+def load_batch(cur, batch, ingredient_ids, unit_ids, report):
+    """
+    Upsert one batch of recipes, skipping those whose hash matches the one
+    stored by the last load, and record what changed in report.
+    """
+    from psycopg2.extras import execute_values
+    # A recipe repeated within the batch keeps its last version.
+    rows = list({row[0][0]: row for row in map(recipe_rows, batch)}.values())
+    cur.execute("SELECT name, id, description, servings, mainImage, sourceHash FROM recipe WHERE name = ANY(%s);",
+                ([values[0] for values, _, _, _ in rows],))
+    existing = {row[0]: row for row in cur.fetchall()}
+    changed = [row for row in rows if row[0][0] not in existing or existing[row[0][0]][5] != row[3]]
+    report["unchanged"] += len(rows) - len(changed)
+    if not changed:
+        return
+
+    # Only new recipes and ones whose own columns differ are written (and
+    # returned) here, so the embedding queue trigger fires just for those.
+    upserted = dict(execute_values(cur, """
+        INSERT INTO recipe (name, description, servings, mainImage, sourceHash) VALUES %s
+        ON CONFLICT (name) DO UPDATE SET description = EXCLUDED.description, servings = EXCLUDED.servings,
+                                         mainImage = EXCLUDED.mainImage, sourceHash = EXCLUDED.sourceHash
+          WHERE (recipe.description, recipe.servings, recipe.mainImage)
+                IS DISTINCT FROM (EXCLUDED.description, EXCLUDED.servings, EXCLUDED.mainImage)
+        RETURNING name, id;""", [(*values, source_hash) for values, _, _, source_hash in changed], fetch=True))
+    recipe_ids = {name: row[1] for name, row in existing.items()}
+    recipe_ids.update(upserted)
+    touched = {recipe_ids[name] for name in upserted if name in existing}
+
+    # A new hash on its own is bookkeeping, not an edit: keep it out of the queue.
+    cur.execute("SELECT set_config('recipes.skip_embedding_queue', 'on', true);")
+    execute_values(cur, """
+        UPDATE recipe SET sourceHash = v.sourceHash
+          FROM (VALUES %s) AS v (id, sourceHash)
+         WHERE recipe.id = v.id AND recipe.sourceHash IS DISTINCT FROM v.sourceHash;""",
+                   [(recipe_ids[values[0]], source_hash) for values, _, _, source_hash in changed])
+    cur.execute("SELECT set_config('recipes.skip_embedding_queue', 'off', true);")
+
+    recipe_ingredients = []
+    steps = []
+    for values, ingredients, recipe_steps, _ in changed:
+        recipe_id = recipe_ids[values[0]]
+        for food, order, unit, numerator, denominator in ingredients:
+            if food not in ingredient_ids:
+                raise ValueError(f"Unknown ingredient {food}, in {values[0]}")
+            if unit not in unit_ids:
+                raise ValueError(f"Unknown unit '{unit}', in {values[0]}")
+            recipe_ingredients.append((recipe_id, ingredient_ids[food], order, unit_ids[unit], numerator, denominator))
+        steps.extend((recipe_id, order, description, image) for order, description, image in recipe_steps)
+    # Only the changed recipes' rows are rewritten, so only theirs may be
+    # deleted; the unchanged ones in the batch have no rows in the keep-lists.
+    ids = [recipe_ids[values[0]] for values, _, _, _ in changed]
+
+    # Rows are only rewritten when they differ, so unchanged lines neither
+    # show up in the report nor queue the recipe for re-embedding.
+    if recipe_ingredients:
+        touched.update(recipe_id for (recipe_id,) in execute_values(cur, """
+            INSERT INTO recipe_ingredient (recipeId, ingredientId, displayOrder, unit, quantity, denominator)
+            VALUES %s
+            ON CONFLICT (recipeId, ingredientId, displayOrder) DO UPDATE
+              SET unit = EXCLUDED.unit, quantity = EXCLUDED.quantity, denominator = EXCLUDED.denominator
+              WHERE (recipe_ingredient.unit, recipe_ingredient.quantity, recipe_ingredient.denominator)
+                    IS DISTINCT FROM (EXCLUDED.unit, EXCLUDED.quantity, EXCLUDED.denominator)
+            RETURNING recipeId;""", recipe_ingredients, template="(%s, %s, %s, %s, %s::numeric, %s)", fetch=True))
+    cur.execute("""
+        DELETE FROM recipe_ingredient
+         WHERE recipeId = ANY(%s)
+           AND (recipeId, ingredientId, displayOrder) NOT IN
+               (SELECT * FROM unnest(%s::bigint[], %s::bigint[], %s::int[]))
+        RETURNING recipeId;""", (ids, [r[0] for r in recipe_ingredients], [r[1] for r in recipe_ingredients],
+                                 [r[2] for r in recipe_ingredients]))
+    touched.update(recipe_id for (recipe_id,) in cur.fetchall())
+
+    if steps:
+        touched.update(recipe_id for (recipe_id,) in execute_values(cur, """
+            INSERT INTO step (recipeId, displayOrder, description, imageLocation) VALUES %s
+            ON CONFLICT (recipeId, displayOrder) DO UPDATE
+              SET description = EXCLUDED.description, imageLocation = EXCLUDED.imageLocation
+              WHERE (step.description, step.imageLocation)
+                    IS DISTINCT FROM (EXCLUDED.description, EXCLUDED.imageLocation)
+            RETURNING recipeId;""", steps, fetch=True))
+    cur.execute("""
+        DELETE FROM step
+         WHERE recipeId = ANY(%s)
+           AND (recipeId, displayOrder) NOT IN (SELECT * FROM unnest(%s::bigint[], %s::int[]))
+        RETURNING recipeId;""", (ids, [r[0] for r in steps], [r[1] for r in steps]))
+    touched.update(recipe_id for (recipe_id,) in cur.fetchall())
+
+    for values, _, _, _ in changed:
+        name = values[0]
+        if name not in existing:
+            report["added"].append(name)
+        elif recipe_ids[name] in touched:
+            report["updated"].append(name)
+        else:
+            # Same rows, hash not recorded yet (e.g. loaded from output.sql).
+            report["unchanged"] += 1
+
+def load_database(file_path, env_path, batch_size):
+    """
+    Upsert the recipes of a JSONL file straight into the database, one
+    transaction per batch_size recipes. Recipes are matched by name; ones that
+    are not in the file are left alone. The tables stay online throughout, and
+    the triggers queue every changed recipe for the embedding worker.
+    """
+    report = {"added": [], "updated": [], "unchanged": 0}
+    conn = connect(env_path)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT name, id FROM unit;")
+            unit_ids = dict(cur.fetchall())
+            ingredient_ids, new_ingredients = load_ingredients(cur, stream_file(file_path))
+        conn.commit()
+
+        batch = []
+        for recipe in stream_file(file_path):
+            batch.append(recipe)
+            if len(batch) >= batch_size:
+                with conn.cursor() as cur:
+                    load_batch(cur, batch, ingredient_ids, unit_ids, report)
+                conn.commit()
+                batch = []
+        if batch:
+            with conn.cursor() as cur:
+                load_batch(cur, batch, ingredient_ids, unit_ids, report)
+            conn.commit()
+    except Exception:
+        conn.rollback()
+        print("Batches committed so far were kept; run again to finish.")
+        raise
+    finally:
+        conn.close()
+
+    for name in new_ingredients:
+        print(f"New ingredient: {name}")
+    for name in report["added"]:
+        print(f"Added: {name}")
+    for name in report["updated"]:
+        print(f"Updated: {name}")
+    print(f"{len(report['added'])} added, {len(report['updated'])} updated, {report['unchanged']} unchanged; "
+          f"{len(new_ingredients)} new ingredients")
+    return report
+
 
 def main():
     parser = argparse.ArgumentParser(description="Convert JSONL files to SQL")
@@ -182,6 +541,20 @@ def main():
                         help="Path to the JSONL file")
     parser.add_argument("-o", "--output", type=str, default="output.sql",
                         help="Path to the output SQL file")
+    parser.add_argument("--format", choices=["sql", "copy"], default="sql",
+                        help="sql: INSERT statements that look ids up by name; "
+                             "copy: COPY blocks with ids assigned here, for loading into empty tables")
+    parser.add_argument("--stream", action="store_true",
+                        help="Read the JSONL one recipe at a time instead of all at once (implies --format copy)")
+    parser.add_argument("--units", type=str, default=default_units,
+                        help="SQL file whose unit INSERT numbers the units (for --format copy)")
+    parser.add_argument("--load", action="store_true",
+                        help="Upsert straight into the database in --env instead of writing a file, "
+                             "skipping recipes that have not changed since the last load")
+    parser.add_argument("--env", type=str, default=default_env,
+                        help="dotenv file with the database settings (for --load)")
+    parser.add_argument("--batch-size", type=int, default=default_batch_size,
+                        help="Recipes per transaction (for --load)")
     args = parser.parse_args()
     file_path = args.file
     output_path = args.output
@@ -192,6 +565,22 @@ def main():
     if not file_path.endswith(".jsonl"):
         print(f"File {file_path} is not a JSONL file.")
         return
+    if args.load:
+        load_database(file_path, args.env, args.batch_size)
+        return
+    if args.stream or args.format == "copy":
+        unit_ids = load_unit_ids(args.units)
+        if args.stream:
+            count = write_copy(stream_file(file_path), output_path, unit_ids)
+        else:
+            data = load_file(file_path)
+            foods = {}
+            for recipe in data:
+                add_ingredients(recipe, foods, set())
+            count = write_copy(data, output_path, unit_ids, foods)
+        if not count:
+            print(f"File {file_path} is empty.")
+        return
     data = load_file(file_path)
     if not data:
         print(f"File {file_path} is empty.")